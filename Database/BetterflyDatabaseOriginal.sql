@@ -79,10 +79,27 @@ CREATE TABLE `messages` (
   `text` varchar(700) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL DEFAULT '' COMMENT '消息内容',
   `type` varchar(10) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL DEFAULT 'text' COMMENT '消息类型(text, image, gif, file)',
   `is_group` int NOT NULL DEFAULT '0' COMMENT 'to_id是群组还是用户',
+  `seq` bigint NOT NULL AUTO_INCREMENT COMMENT '消息序号，按写入顺序递增，用作历史消息分页的游标',
+  `conv_low` int GENERATED ALWAYS AS (if((`is_group` = 0),least(`from_user_id`,`to_id`),`to_id`)) STORED COMMENT '会话键：私聊为较小的用户id，群聊为群组id',
+  `conv_high` int GENERATED ALWAYS AS (if((`is_group` = 0),greatest(`from_user_id`,`to_id`),0)) STORED COMMENT '会话键：私聊为较大的用户id，群聊为0',
   PRIMARY KEY (`from_user_id`,`to_id`,`timestamp`,`text`,`type`,`is_group`),
+  UNIQUE KEY `messages_seq` (`seq`),
+  KEY `messages_conversation` (`is_group`,`conv_low`,`conv_high`,`seq`),
   CONSTRAINT `messages_ibfk_1` FOREIGN KEY (`from_user_id`) REFERENCES `users` (`user_id`) ON UPDATE RESTRICT
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
+-- ----------------------------
+-- Table structure for unread_counts
+-- ----------------------------
+DROP TABLE IF EXISTS `unread_counts`;
+CREATE TABLE `unread_counts` (
+  `user_id` int NOT NULL COMMENT '接收消息的用户ID',
+  `is_group` int NOT NULL COMMENT '会话是否为群聊',
+  `conv_id` int NOT NULL COMMENT '会话：私聊为对方用户ID，群聊为群组ID',
+  `count` int NOT NULL DEFAULT '0' COMMENT '未读消息数',
+  PRIMARY KEY (`user_id`,`is_group`,`conv_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
 -- ----------------------------
 -- Table structure for user_apns_tokens
 -- ----------------------------
@@ -176,6 +193,23 @@ END
 ;;
 delimiter ;
 
+-- ----------------------------
+-- Procedure structure for insert_files
+-- ----------------------------
+DROP PROCEDURE IF EXISTS `insert_files`;
+delimiter ;;
+CREATE DEFINER=`voltline`@`%` PROCEDURE `insert_files`(IN _files JSON)
+BEGIN
+  INSERT IGNORE INTO files(file_hash, file_suffix)
+	SELECT jt.file_hash, jt.file_suffix
+	FROM JSON_TABLE(_files, '$[*]' COLUMNS(
+		file_hash varchar(128) PATH '$.file_hash',
+		file_suffix varchar(128) PATH '$.file_suffix'
+	)) AS jt;
+END
+;;
+delimiter ;
+
 -- ----------------------------
 -- Procedure structure for insert_group
 -- ----------------------------
@@ -312,6 +346,25 @@ END
 ;;
 delimiter ;
 
+-- ----------------------------
+-- Procedure structure for query_files
+-- ----------------------------
+DROP PROCEDURE IF EXISTS `query_files`;
+delimiter ;;
+CREATE DEFINER=`voltline`@`%` PROCEDURE `query_files`(IN _files JSON)
+BEGIN
+  SELECT f.file_hash, f.file_suffix
+	FROM JSON_TABLE(_files, '$[*]' COLUMNS(
+		file_hash varchar(128) PATH '$.file_hash',
+		file_suffix varchar(128) PATH '$.file_suffix'
+	)) AS jt
+	JOIN files f
+	ON f.file_hash = jt.file_hash
+	AND f.file_suffix = jt.file_suffix;
+END
+;;
+delimiter ;
+
 -- ----------------------------
 -- Procedure structure for query_group
 -- ----------------------------
@@ -340,6 +393,27 @@ END
 ;;
 delimiter ;
 
+-- ----------------------------
+-- Procedure structure for query_history
+-- ----------------------------
+DROP PROCEDURE IF EXISTS `query_history`;
+delimiter ;;
+CREATE DEFINER=`voltline`@`%` PROCEDURE `query_history`(
+	IN _conv_low INT, IN _conv_high INT, IN _is_group INT,
+	IN _before BIGINT, IN _limit INT
+)
+BEGIN
+	-- 按 messages_conversation 索引做 keyset 分页：二级索引带有主键的全部列，不需要回表
+	SELECT from_user_id, to_id, `timestamp`, `text`, type, is_group, seq
+	FROM messages
+	WHERE is_group = _is_group AND conv_low = _conv_low AND conv_high = _conv_high
+	AND seq < IFNULL(_before, 9223372036854775807)
+	ORDER BY seq DESC
+	LIMIT _limit;
+END
+;;
+delimiter ;
+
 -- ----------------------------
 -- Procedure structure for query_sync_message
 -- ----------------------------
@@ -368,6 +442,20 @@ END
 ;;
 delimiter ;
 
+-- ----------------------------
+-- Procedure structure for query_unread
+-- ----------------------------
+DROP PROCEDURE IF EXISTS `query_unread`;
+delimiter ;;
+CREATE DEFINER=`voltline`@`%` PROCEDURE `query_unread`(IN _user_id INT)
+BEGIN
+	SELECT is_group, conv_id, `count`
+	FROM unread_counts
+	WHERE user_id = _user_id AND `count` > 0;
+END
+;;
+delimiter ;
+
 -- ----------------------------
 -- Procedure structure for query_user
 -- ----------------------------
@@ -424,6 +512,37 @@ END
 ;;
 delimiter ;
 
+-- ----------------------------
+-- Procedure structure for update_unread
+-- ----------------------------
+DROP PROCEDURE IF EXISTS `update_unread`;
+delimiter ;;
+CREATE DEFINER=`voltline`@`%` PROCEDURE `update_unread`(IN _counts JSON)
+BEGIN
+	-- 一次写入一批未读数变化：reset 为真时未读数置为 delta(已读后又收到的消息数)，否则累加 delta
+	INSERT INTO unread_counts(user_id, is_group, conv_id, `count`)
+	SELECT jt.user_id, jt.is_group, jt.conv_id, jt.delta
+	FROM JSON_TABLE(_counts, '$[*]' COLUMNS(
+		user_id int PATH '$.user_id',
+		is_group int PATH '$.is_group',
+		conv_id int PATH '$.conv_id',
+		reset int PATH '$.reset',
+		delta int PATH '$.delta'
+	)) AS jt
+	ON DUPLICATE KEY UPDATE `count` = IF(jt.reset, jt.delta, unread_counts.`count` + jt.delta);
+	-- 已读的会话不保留记录
+	DELETE u FROM unread_counts u
+	JOIN JSON_TABLE(_counts, '$[*]' COLUMNS(
+		user_id int PATH '$.user_id',
+		is_group int PATH '$.is_group',
+		conv_id int PATH '$.conv_id'
+	)) AS jt
+	ON u.user_id = jt.user_id AND u.is_group = jt.is_group AND u.conv_id = jt.conv_id
+	WHERE u.`count` <= 0;
+END
+;;
+delimiter ;
+
 -- ----------------------------
 -- Procedure structure for update_user_avatar
 -- ----------------------------
@@ -1,41 +1,96 @@
 import datetime
+import json
 import os
+import threading
+import time
 
 import pymysql as sql
 from dbutils.pooled_db import PooledDB
 
 from Database.db_setting import DBSetting
 from Utils.color_logger import get_logger
+from Utils.metrics import registry
+from Utils.profiling import tracer
 
 logger = get_logger(__name__)
 
+DB_CALL_LATENCY = registry.histogram("betterfly_db_call_seconds", "Stored procedure call latency", ("procedure",))
+DB_POOL_WAIT = registry.histogram("betterfly_db_pool_wait_seconds", "Time spent waiting for a pooled connection")
+
 root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 config_dir = os.path.join(root_dir, "Config")
 config_fp = os.path.join(config_dir, 'database_config.json')
 
 
+def procedure_name(sql_stmt: str) -> str:
+    """'CALL login(%s,%s,%s);' -> 'login'，非存储过程语句返回 'sql'"""
+    if sql_stmt.startswith('CALL '):
+        return sql_stmt[5:sql_stmt.find('(')]
+    return 'sql'
+
+
 class DBOperator:
     """数据库操作类，基于连接池实现"""
 
-    __setting = DBSetting(config_fp)
-    __pool = PooledDB(
-        creator=sql,
-        maxconnections=16,  # 最大连接数
-        mincached=4,       # 初始化时创建的连接数
-        maxcached=16,       # 连接池中最多可用连接数
-        blocking=True,     # 无可用连接时是否阻塞等待
-        ping=1,            # 检查连接可用性
-        host=__setting.ip,
-        port=__setting.port,
-        user=__setting.user,
-        password=__setting.password,
-        database=__setting.database,
-        charset=__setting.charset,
-    )
+    __pool: PooledDB = None
+    __pool_lock = threading.Lock()
+    __max_connections = 16  # 最大连接数
+    __min_cached = 4  # 初始化时创建的连接数
+
+    @classmethod
+    def configure_pool(cls, max_connections: int, min_cached: int = None):
+        """
+        设置连接池大小，连接池已创建时立即生效：扩大后等待连接的线程被唤醒，缩小后多出的连接归还时关闭
+        :param max_connections: 最大连接数
+        :param min_cached: 初始化时创建的连接数，只在连接池创建前设置有效
+        """
+        cls.__max_connections = max_connections
+        if min_cached is not None:
+            cls.__min_cached = min(min_cached, max_connections)
+        pool = cls.__pool
+        if pool is not None:
+            with pool._lock:
+                pool._maxconnections = pool._maxcached = max_connections
+                pool._lock.notify_all()
+
+    @classmethod
+    def _get_pool(cls) -> PooledDB:
+        """首次使用时才读取配置并创建连接池，避免导入模块时就连接数据库"""
+        if cls.__pool is None:
+            with cls.__pool_lock:
+                if cls.__pool is None:
+                    setting = DBSetting(config_fp)
+                    cls.__pool = PooledDB(
+                        creator=sql,
+                        maxconnections=cls.__max_connections,  # 最大连接数
+                        mincached=cls.__min_cached,            # 初始化时创建的连接数
+                        maxcached=cls.__max_connections,       # 连接池中最多可用连接数
+                        blocking=True,     # 无可用连接时是否阻塞等待
+                        ping=1,            # 检查连接可用性
+                        host=setting.ip,
+                        port=setting.port,
+                        user=setting.user,
+                        password=setting.password,
+                        database=setting.database,
+                        charset=setting.charset,
+                    )
+        return cls.__pool
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """
+        :return: 连接池使用情况 {"in_use", "idle", "max"}，连接池尚未创建时全部为0
+        """
+        pool = cls.__pool
+        if pool is None:
+            return {"in_use": 0, "idle": 0, "max": 0}
+        return {"in_use": pool._connections, "idle": len(pool._idle_cache), "max": pool._maxconnections}
 
     def __init__(self):
         # 从连接池中获取连接
-        self.__db = self.__pool.connection()
+        start = time.perf_counter()
+        self.__db = self._get_pool().connection()
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
         self.__cur = self.__db.cursor()
 
     def __del__(self):
@@ -56,6 +111,7 @@ class DBOperator:
         :param args: 参数
         :return: 查询结果元组
         """
+        start = time.perf_counter()
         try:
             self.__cur.execute(sql_stmt, args)
             self.__db.commit()
@@ -72,6 +128,11 @@ class DBOperator:
             logger.error(f"未知错误: {e}", exc_info=True)
             self.__db.rollback()
             raise
+        finally:
+            end = time.perf_counter()
+            DB_CALL_LATENCY.observe(end - start, procedure_name(sql_stmt))
+            if tracer.enabled:
+                tracer.span(f"db:{procedure_name(sql_stmt)}", start, end)
 
     # 以下为原有方法，使用实例化的execute
     def login(self, user_id: int, user_name: str, last_login: str | datetime.datetime) -> str:
@@ -157,11 +218,56 @@ class DBOperator:
         stmt = 'CALL insert_file(%s, %s);'
         self.execute(stmt, False, file_hash, file_suffix)
 
+    def queryFiles(self, files: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        """
+        一次查询多个文件是否存在
+        :param files: [(file_hash, file_suffix)]
+        :return: 已存在的 (file_hash, file_suffix) 集合
+        """
+        stmt = 'CALL query_files(%s);'
+        payload = json.dumps([{"file_hash": h, "file_suffix": sfx} for h, sfx in files])
+        return {(row[0], row[1]) for row in self.execute(stmt, True, payload)}
+
+    def insertFiles(self, files: list[tuple[str, str]]):
+        """向数据库中批量插入文件信息，已存在的文件会被忽略"""
+        stmt = 'CALL insert_files(%s);'
+        payload = json.dumps([{"file_hash": h, "file_suffix": sfx} for h, sfx in files])
+        self.execute(stmt, False, payload)
+
     def querySyncMessage(self, user_id: int, last_login: datetime.datetime | str):
         """查询未登录期间收到的消息"""
         stmt = 'CALL query_sync_message(%s, %s);'
         return self.execute(stmt, True, user_id, last_login)
 
+    def queryHistory(self, conversation: tuple[int, int, int], before: int | None, limit: int):
+        """
+        按游标查询一个会话的历史消息
+        :param conversation: (is_group, conv_low, conv_high)，见 Utils.history.conversation_key
+        :param before: 只返回 seq 小于它的消息，为空则从最新一条开始
+        :return: ((from_user_id, to_id, timestamp, text, type, is_group, seq), ...)，按 seq 从新到旧
+        """
+        stmt = 'CALL query_history(%s, %s, %s, %s, %s);'
+        is_group, conv_low, conv_high = conversation
+        return self.execute(stmt, True, conv_low, conv_high, is_group, before, limit)
+
+    def queryUnread(self, user_id: int):
+        """
+        查询用户有未读消息的会话
+        :return: ((is_group, conv_id, count), ...)
+        """
+        stmt = 'CALL query_unread(%s);'
+        return self.execute(stmt, True, user_id)
+
+    def updateUnread(self, changes: list[tuple[int, int, int, bool, int]]):
+        """
+        批量写入未读数的变化
+        :param changes: [(user_id, is_group, conv_id, reset, delta)]，reset 为真时未读数置为 delta，否则累加 delta
+        """
+        stmt = 'CALL update_unread(%s);'
+        payload = json.dumps([{"user_id": u, "is_group": g, "conv_id": c, "reset": int(r), "delta": d}
+                              for u, g, c, r, d in changes])
+        self.execute(stmt, False, payload)
+
     def queryGroupUser(self, group_id: int):
         """查询一个群聊的所有成员id"""
         stmt = 'CALL query_group_user(%s);'
@@ -0,0 +1,38 @@
+-- 历史消息分页：为已有的 messages 表增加消息序号与会话键，并建立 (会话, 序号) 索引
+-- 新建的数据库直接使用 BetterflyDatabaseOriginal.sql，不需要执行本脚本
+--
+-- 已有消息按 timestamp 编号，同一秒内的消息顺序不保证与到达顺序相同。
+-- 大表上 ALTER TABLE 会重建表，请在低峰期执行。
+
+SET NAMES utf8mb4;
+
+-- 先按时间为已有消息编号，再改为自增列(已有的非零序号保持不变，自增起点为最大序号加一)
+ALTER TABLE `messages` ADD COLUMN `seq` bigint NOT NULL DEFAULT 0;
+SET @seq := 0;
+UPDATE `messages` SET `seq` = (@seq := @seq + 1) ORDER BY `timestamp`, `from_user_id`, `to_id`;
+ALTER TABLE `messages`
+  MODIFY COLUMN `seq` bigint NOT NULL AUTO_INCREMENT COMMENT '消息序号，按写入顺序递增，用作历史消息分页的游标',
+  ADD UNIQUE KEY `messages_seq` (`seq`);
+
+ALTER TABLE `messages`
+  ADD COLUMN `conv_low` int GENERATED ALWAYS AS (if((`is_group` = 0),least(`from_user_id`,`to_id`),`to_id`)) STORED COMMENT '会话键：私聊为较小的用户id，群聊为群组id',
+  ADD COLUMN `conv_high` int GENERATED ALWAYS AS (if((`is_group` = 0),greatest(`from_user_id`,`to_id`),0)) STORED COMMENT '会话键：私聊为较大的用户id，群聊为0',
+  ADD KEY `messages_conversation` (`is_group`,`conv_low`,`conv_high`,`seq`);
+
+DROP PROCEDURE IF EXISTS `query_history`;
+delimiter ;;
+CREATE PROCEDURE `query_history`(
+	IN _conv_low INT, IN _conv_high INT, IN _is_group INT,
+	IN _before BIGINT, IN _limit INT
+)
+BEGIN
+	-- 按 messages_conversation 索引做 keyset 分页：二级索引带有主键的全部列，不需要回表
+	SELECT from_user_id, to_id, `timestamp`, `text`, type, is_group, seq
+	FROM messages
+	WHERE is_group = _is_group AND conv_low = _conv_low AND conv_high = _conv_high
+	AND seq < IFNULL(_before, 9223372036854775807)
+	ORDER BY seq DESC
+	LIMIT _limit;
+END
+;;
+delimiter ;
@@ -0,0 +1,51 @@
+-- 未读消息数：按 (用户, 会话) 保存未读数，由服务器在内存中维护并定期批量写入
+-- 新建的数据库直接使用 BetterflyDatabaseOriginal.sql，不需要执行本脚本
+
+SET NAMES utf8mb4;
+
+CREATE TABLE IF NOT EXISTS `unread_counts` (
+  `user_id` int NOT NULL COMMENT '接收消息的用户ID',
+  `is_group` int NOT NULL COMMENT '会话是否为群聊',
+  `conv_id` int NOT NULL COMMENT '会话：私聊为对方用户ID，群聊为群组ID',
+  `count` int NOT NULL DEFAULT '0' COMMENT '未读消息数',
+  PRIMARY KEY (`user_id`,`is_group`,`conv_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+DROP PROCEDURE IF EXISTS `query_unread`;
+delimiter ;;
+CREATE PROCEDURE `query_unread`(IN _user_id INT)
+BEGIN
+	SELECT is_group, conv_id, `count`
+	FROM unread_counts
+	WHERE user_id = _user_id AND `count` > 0;
+END
+;;
+delimiter ;
+
+DROP PROCEDURE IF EXISTS `update_unread`;
+delimiter ;;
+CREATE PROCEDURE `update_unread`(IN _counts JSON)
+BEGIN
+	-- 一次写入一批未读数变化：reset 为真时未读数置为 delta(已读后又收到的消息数)，否则累加 delta
+	INSERT INTO unread_counts(user_id, is_group, conv_id, `count`)
+	SELECT jt.user_id, jt.is_group, jt.conv_id, jt.delta
+	FROM JSON_TABLE(_counts, '$[*]' COLUMNS(
+		user_id int PATH '$.user_id',
+		is_group int PATH '$.is_group',
+		conv_id int PATH '$.conv_id',
+		reset int PATH '$.reset',
+		delta int PATH '$.delta'
+	)) AS jt
+	ON DUPLICATE KEY UPDATE `count` = IF(jt.reset, jt.delta, unread_counts.`count` + jt.delta);
+	-- 已读的会话不保留记录
+	DELETE u FROM unread_counts u
+	JOIN JSON_TABLE(_counts, '$[*]' COLUMNS(
+		user_id int PATH '$.user_id',
+		is_group int PATH '$.is_group',
+		conv_id int PATH '$.conv_id'
+	)) AS jt
+	ON u.user_id = jt.user_id AND u.is_group = jt.is_group AND u.conv_id = jt.conv_id
+	WHERE u.`count` <= 0;
+END
+;;
+delimiter ;
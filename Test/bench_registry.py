@@ -0,0 +1,122 @@
+"""
+会话表锁竞争压测：多个线程同时按服务器的方式登记、登录、查询与移除会话，比较单锁(--shards 1)与分段锁的吞吐量。
+
+用法(在仓库根目录执行)：
+    python -m Test.bench_registry --threads 1 2 4 8 16
+    python -m Test.bench_registry --python python3.13 --python python3.13t
+指定 --python 时依次用这些解释器运行同样的压测并汇总结果，用于比较有 GIL 与无 GIL(free-threaded)的 CPython。
+有 GIL 时线程数增加不会提高吞吐量，分段主要减少锁的争用；无 GIL 时分段锁的吞吐量应随线程数增长。
+"""
+import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from Utils.session import SESSION_SHARDS, SessionRegistry
+
+LOOKUPS_PER_CYCLE = 8  # 每次连接周期中的投递查询次数(sessions_of)
+SNAPSHOT_EVERY = 200  # 每多少次连接周期做一次全体消息快照(authenticated)
+
+
+def gil_enabled() -> bool:
+    check = getattr(sys, "_is_gil_enabled", None)
+    return True if check is None else check()
+
+
+def worker(registry: SessionRegistry, index: int, users: int, deadline: float, barrier: threading.Barrier,
+           counts: list):
+    """
+    一个线程的负载：新连接、登录、查询若干用户的设备、断开，与工作线程/初始化线程/关闭线程的操作相同
+    """
+    rng = random.Random(index)
+    fileno = index * 10_000_000
+    cycles = 0
+    barrier.wait()
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            fileno += 1
+            session = registry.add(fileno, None)
+            registry.authenticate(session, rng.randrange(users), "user")
+            for _ in range(LOOKUPS_PER_CYCLE):
+                registry.sessions_of(rng.randrange(users))
+            registry.remove(fileno, session)
+            cycles += 1
+            if cycles % SNAPSHOT_EVERY == 0:
+                registry.authenticated()
+    counts[index] = cycles
+
+
+def run_once(threads: int, shards: int, users: int, idle: int, duration: float) -> float:
+    """:return: 每秒完成的连接周期数"""
+    registry = SessionRegistry(shards=shards)
+    # 长期在线的空闲会话，使查询与快照面对真实规模的会话表
+    for i in range(idle):
+        registry.authenticate(registry.add(-1 - i, None), i % users, "idle")
+    counts = [0] * threads
+    barrier = threading.Barrier(threads + 1)
+    deadline = time.perf_counter() + duration + 0.05
+    pool = [threading.Thread(target=worker, args=(registry, i, users, deadline, barrier, counts))
+            for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    barrier.wait()
+    begin = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - begin)
+
+
+def run_local(args) -> dict:
+    results = {}
+    for shards in args.shards:
+        for threads in args.threads:
+            results[f"{shards}/{threads}"] = run_once(threads, shards, args.users, args.idle, args.duration)
+    return {"python": sys.version.split()[0], "executable": sys.executable, "gil": gil_enabled(),
+            "results": results}
+
+
+def print_report(report: dict, args):
+    print(f"{report['executable']} (Python {report['python']}, GIL {'enabled' if report['gil'] else 'disabled'})")
+    print("shards " + "".join(f"{f'{t} thr':>12}" for t in args.threads))
+    for shards in args.shards:
+        print(f"{shards:>6} " + "".join(f"{report['results'][f'{shards}/{t}']:>12,.0f}" for t in args.threads))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure SessionRegistry throughput under thread contention")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, SESSION_SHARDS], help="分段数，1 即单锁")
+    parser.add_argument("--users", type=int, default=100000, help="用户id范围")
+    parser.add_argument("--idle", type=int, default=50000, help="预先登记的空闲会话数")
+    parser.add_argument("--duration", type=float, default=2.0, help="每组参数的运行时间(秒)")
+    parser.add_argument("--python", action="append", default=[], help="用这些解释器分别运行(可多次指定)")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    if not args.python:
+        report = run_local(args)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_report(report, args)
+        return 0
+
+    forwarded = ["--threads", *map(str, args.threads), "--shards", *map(str, args.shards), "--users", str(args.users),
+                 "--idle", str(args.idle), "--duration", str(args.duration), "--json"]
+    for python in args.python:
+        try:
+            output = subprocess.run([python, "-m", "Test.bench_registry", *forwarded], check=True,
+                                    capture_output=True, text=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"{python}: failed to run ({e})")
+            continue
+        print_report(json.loads(output), args)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+全文检索索引压测：生成中英文混合的消息语料，通过 SearchIndex.add 逐条写入(与服务器收到 Post 时相同)，
+统计写入吞吐、段写入与合并完成后的索引大小，以及按用户/群组范围查询的延迟分位数，并抽样与暴力扫描的结果比对。
+
+用法(在仓库根目录执行)：
+    python -m Test.bench_search --messages 1000000
+    python -m Test.bench_search --messages 200000 --queries 5000 --path /tmp/search-bench --keep
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from Utils.search import SEARCH_PAGE_DEFAULT, SearchIndex, scopes_of
+
+ENGLISH_SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "so", "ta", "vi", "be", "do", "ge", "po", "an", "er", "in", "on"]
+
+
+def zipf_weights(n: int, s: float = 1.1) -> list[float]:
+    return list(itertools.accumulate(1 / (i + 1) ** s for i in range(n)))
+
+
+class Corpus:
+    """按 Zipf 分布生成汉字、英文词与活跃用户，接近真实聊天记录的词频分布"""
+
+    def __init__(self, seed: int, users: int, groups: int, group_ratio: float):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.groups = groups
+        self.group_ratio = group_ratio
+        hanzi = list(range(0x4e00, 0x9fa5))
+        self.rng.shuffle(hanzi)
+        self.hanzi = [chr(c) for c in hanzi[:3500]]
+        self.hanzi_weights = zipf_weights(len(self.hanzi), 1.0)
+        words = {"".join(self.rng.choices(ENGLISH_SYLLABLES, k=self.rng.randint(1, 4))) for _ in range(8000)}
+        self.words = sorted(words)
+        self.rng.shuffle(self.words)
+        self.word_weights = zipf_weights(len(self.words))
+        self.user_weights = zipf_weights(users, 0.8)
+
+    def text(self) -> str:
+        rng = self.rng
+        kind = rng.random()
+        if kind < 0.6:
+            return "".join(rng.choices(self.hanzi, cum_weights=self.hanzi_weights, k=rng.randint(2, 30)))
+        if kind < 0.9:
+            return " ".join(rng.choices(self.words, cum_weights=self.word_weights, k=rng.randint(1, 15)))
+        parts = ["".join(rng.choices(self.hanzi, cum_weights=self.hanzi_weights, k=rng.randint(2, 10))),
+                 " ".join(rng.choices(self.words, cum_weights=self.word_weights, k=rng.randint(1, 4)))]
+        rng.shuffle(parts)
+        return " ".join(parts)
+
+    def message(self) -> list:
+        rng = self.rng
+        from_id = 1000 + rng.choices(range(self.users), cum_weights=self.user_weights)[0]
+        if rng.random() < self.group_ratio:
+            to_id, is_group = 500000 + rng.randrange(self.groups), True
+        else:
+            to_id, is_group = 1000 + rng.choices(range(self.users), cum_weights=self.user_weights)[0], False
+        return [from_id, to_id, "2024-12-07 12:00:00", self.text(), "text", int(is_group)]
+
+    def query(self, doc: list) -> str:
+        """从一条消息中取一段作为查询：一个或两个连续的英文词，或 1~4 个连续汉字"""
+        rng = self.rng
+        words = doc[3].split()
+        hanzi = [w for w in words if is_hanzi(w)]
+        if not hanzi or (len(hanzi) < len(words) and rng.random() < 0.5):
+            words = [w for w in words if not is_hanzi(w)]
+            i = rng.randrange(len(words))
+            return " ".join(words[i:i + rng.randint(1, 2)])
+        segment = rng.choice(hanzi)
+        length = min(len(segment), rng.choice((1, 2, 2, 3, 4)))
+        i = rng.randrange(len(segment) - length + 1)
+        return segment[i:i + length]
+
+
+def is_hanzi(word: str) -> bool:
+    return "\u4e00" <= word[0] <= "\u9fff"
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def brute_force(docs: list, scope: str, query: str, limit: int) -> list[int]:
+    """逐条扫描：汉字片段按子串匹配，英文按整词匹配"""
+    runs = query.lower().split()
+    found = []
+    for doc_id in range(len(docs), 0, -1):
+        doc = docs[doc_id - 1]
+        if scope not in scopes_of(doc[0], doc[1], doc[5]):
+            continue
+        words = doc[3].lower().split()
+        if all(any(run in w for w in words) if is_hanzi(run) else run in words for run in runs):
+            found.append(doc_id)
+            if len(found) == limit:
+                break
+    return found
+
+
+def directory_size(path: str, prefix: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path) if n.startswith(prefix))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure SearchIndex size and query latency")
+    parser.add_argument("--messages", type=int, default=1000000, help="语料消息数")
+    parser.add_argument("--users", type=int, default=20000, help="用户数")
+    parser.add_argument("--groups", type=int, default=2000, help="群组数")
+    parser.add_argument("--group-ratio", type=float, default=0.3, help="群聊消息比例")
+    parser.add_argument("--segment-docs", type=int, default=50000, help="内存表写成段的消息数")
+    parser.add_argument("--max-segments", type=int, default=8, help="触发合并的段数")
+    parser.add_argument("--queries", type=int, default=2000, help="查询次数")
+    parser.add_argument("--verify", type=int, default=20, help="与暴力扫描比对的查询数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--path", default=None, help="索引目录，默认使用临时目录")
+    parser.add_argument("--keep", action="store_true", help="结束后保留索引目录")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args(argv)
+
+    path = args.path or tempfile.mkdtemp(prefix="bench-search-")
+    if os.path.exists(path) and os.listdir(path):
+        print(f"{path} is not empty", file=sys.stderr)
+        return 1
+    corpus = Corpus(args.seed, args.users, args.groups, args.group_ratio)
+    docs = [corpus.message() for _ in range(args.messages)]
+    text_bytes = sum(len(doc[3].encode()) for doc in docs)
+
+    index = SearchIndex(path, args.segment_docs, args.max_segments)
+    begin = time.perf_counter()
+    for doc in docs:
+        index.add(*doc)
+    add_seconds = time.perf_counter() - begin
+    index.wait_idle()
+    build_seconds = time.perf_counter() - begin
+    stats = index.stats()
+    segment_bytes = directory_size(path, "seg-")
+    wal_bytes = directory_size(path, "wal-")
+
+    latencies, hits = [], 0
+    for _ in range(args.queries):
+        doc = docs[corpus.rng.randrange(len(docs))]
+        scope = corpus.rng.choice(scopes_of(doc[0], doc[1], doc[5]))
+        start = time.perf_counter()
+        results, _ = index.search([scope], corpus.query(doc), limit=SEARCH_PAGE_DEFAULT)
+        latencies.append(time.perf_counter() - start)
+        hits += len(results)
+
+    mismatches = 0
+    for _ in range(args.verify):
+        doc = docs[corpus.rng.randrange(len(docs))]
+        scope = corpus.rng.choice(scopes_of(doc[0], doc[1], doc[5]))
+        query = corpus.query(doc)
+        results, _ = index.search([scope], query, limit=SEARCH_PAGE_DEFAULT)
+        if [doc_id for doc_id, _ in results] != brute_force(docs, scope, query, SEARCH_PAGE_DEFAULT):
+            mismatches += 1
+            print(f"mismatch for {query!r} in {scope}", file=sys.stderr)
+    index.stop()
+
+    report = {
+        "messages": args.messages, "text_bytes": text_bytes,
+        "add_per_s": round(args.messages / add_seconds), "build_seconds": round(build_seconds, 2),
+        "segments": stats["segments"], "merges": stats["merges"], "memtable": stats["memtable"],
+        "segment_bytes": segment_bytes, "wal_bytes": wal_bytes,
+        "index_bytes_per_message": round(segment_bytes / args.messages, 1),
+        "postings_bytes_per_message": round((segment_bytes - stats["stored_bytes"]) / args.messages, 1),
+        "query_p50_ms": round(percentile(latencies, 0.5), 3), "query_p90_ms": round(percentile(latencies, 0.9), 3),
+        "query_p99_ms": round(percentile(latencies, 0.99), 3), "results_per_query": round(hits / args.queries, 1),
+        "verify_mismatches": mismatches, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+    if not args.keep:
+        shutil.rmtree(path)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+以本地替身启动 EpollChatServer，不依赖 MySQL、COS 与 Apple APNs。
+
+用法(在仓库根目录执行)：
+    python -m Test.bench_server --port 54342 --db-latency 0.002 --apns-latency 0.05 --apns-error-rate 0.01
+然后在另一个终端运行 Test/load_generator.py 对其压测。
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from Test.hermetic import APNsMockServer, FakeCOS, HermeticAPNsClient, MemoryDBOperator
+from Utils.Server import EpollChatServer
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run EpollChatServer against in-process stand-ins")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54342)
+    parser.add_argument("--db-path", default=":memory:", help="SQLite 数据库路径，默认内存库")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="每次数据库调用的模拟延迟(秒)")
+    parser.add_argument("--db-pool-size", type=int, default=16, help="模拟的连接池大小")
+    parser.add_argument("--apns-tokens-per-user", type=int, default=1, help="登录时为每个用户生成的APNs Token数")
+    parser.add_argument("--apns-latency", type=float, default=0.0, help="模拟APNs的响应延迟(秒)")
+    parser.add_argument("--apns-error-rate", type=float, default=0.0, help="模拟APNs返回错误的概率")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Prometheus 指标端口，不指定则不开启")
+    parser.add_argument("--slow-request-ms", type=float, default=None, help="慢请求日志阈值(毫秒)，不指定则不开启追踪")
+    parser.add_argument("--takeover", action="store_true",
+                        help="从同一 handoff_path 上运行中的压测服务器接管所有连接，需配合 --db-path 使用文件数据库")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="覆盖服务器配置项，VALUE 按JSON解析，如 --set heartbeat_timeout=5")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    MemoryDBOperator.configure(latency=args.db_latency, pool_size=args.db_pool_size,
+                               auto_apns_tokens=args.apns_tokens_per_user, path=args.db_path)
+    apns_mock = APNsMockServer(latency=args.apns_latency, error_rate=args.apns_error_rate).start()
+
+    fd, config_path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        config = {"ip": args.host, "port": args.port, "metrics_port": args.metrics_port,
+                  "slow_request_ms": args.slow_request_ms,
+                  "search_index_path": os.path.join(tempfile.gettempdir(), f"betterfly-search-{args.port}")}
+        for item in args.set:
+            key, _, value = item.partition("=")
+            try:
+                config[key] = json.loads(value)
+            except json.JSONDecodeError:
+                config[key] = value
+        json.dump(config, f)
+    logger.info(f"Bench config written to {config_path}, edit it and send SIGHUP to reload")
+
+    server = None
+    try:
+        server = EpollChatServer(config_path, db_operator=MemoryDBOperator, cos=FakeCOS(),
+                                 apns=HermeticAPNsClient(apns_mock.url), takeover=args.takeover)
+        server.run()
+    except KeyboardInterrupt:
+        logger.info("Bench server interrupted")
+    finally:
+        if server is not None:
+            server.shutdown()
+        apns_mock.stop()
+        logger.info(f"APNs mock handled {apns_mock.requests} requests, {apns_mock.failures} failures")
+        os.unlink(config_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+测量空闲连接在服务器中占用的 Python 堆内存：会话对象、会话表索引与时间轮中的超时定时器。
+
+用法(在仓库根目录执行)：
+    python -m Test.bench_sessions --sessions 100000 --devices 2
+每个会话都持有一个 socket.socket 对象。打开 10 万个真实 socket 需要足够大的文件描述符上限，
+因此默认只用少量真实 socket 测出单个 socket 对象的大小，会话本身使用同大小的占位对象；
+指定 --real-sockets 时在描述符上限允许的范围内全部使用真实 socket。
+不包含内核中的 socket 缓冲区，那部分由 net.ipv4.tcp_rmem / tcp_wmem 决定。
+"""
+import argparse
+import gc
+import resource
+import socket
+import sys
+import time
+import tracemalloc
+
+from Utils.session import SESSION_MEMORY_BUDGET, SessionRegistry
+from Utils.timer_wheel import TimerWheel
+
+SOCKET_SAMPLE = 1000
+
+
+def _noop(session):
+    pass
+
+
+def measure(func) -> tuple:
+    """
+    :return: (func 的返回值, 调用期间新增且仍存活的字节数)
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def socket_size(count: int) -> float:
+    """:return: 单个 socket.socket 对象的平均字节数"""
+    sockets, size = measure(lambda: [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)])
+    for sock in sockets:
+        sock.close()
+    return size / count
+
+
+def raise_fd_limit(wanted: int) -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def populate(count: int, devices: int, sockets: list, placeholder_size: int) -> tuple:
+    """
+    按服务器的方式登记 count 个已登录的空闲会话，每 devices 个会话属于同一用户，
+    每个会话在时间轮中有一个心跳超时定时器
+    """
+    registry = SessionRegistry()
+    timers = TimerWheel(time.monotonic())
+    deadline = time.monotonic() + 120
+    for i in range(count):
+        # 占位对象：与一个 socket.socket 对象大小相同的 bytes
+        sock = sockets[i] if i < len(sockets) else bytes(max(placeholder_size - sys.getsizeof(b""), 0))
+        session = registry.add(100000 + i, sock)
+        registry.authenticate(session, i // devices, f"user{i // devices}")
+        timers.schedule(deadline + (i % 60), _noop, session)
+    return registry, timers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure per-session memory of idle connections")
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--devices", type=int, default=1, help="每个用户的设备(会话)数")
+    parser.add_argument("--real-sockets", action="store_true", help="尽可能使用真实 socket 而不是占位对象")
+    args = parser.parse_args(argv)
+
+    per_socket = socket_size(SOCKET_SAMPLE)
+    sockets = []
+    if args.real_sockets:
+        limit = raise_fd_limit(args.sessions + 100)
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(min(args.sessions, limit - 100))]
+
+    # 真实 socket 在测量之前创建，这里单独加上它们的大小
+    (registry, timers), size = measure(lambda: populate(args.sessions, args.devices, sockets, round(per_socket)))
+    size += per_socket * len(sockets)
+    per_session = size / args.sessions
+
+    print(f"sessions={len(registry)} users={registry.user_count} timers={len(timers)} "
+          f"real_sockets={len(sockets)}")
+    print(f"socket object:     {per_socket:8.1f} B")
+    print(f"total:             {size / 1024 / 1024:8.1f} MiB")
+    print(f"per session:       {per_session:8.1f} B (budget {SESSION_MEMORY_BUDGET} B)")
+    for sock in sockets:
+        sock.close()
+    if per_session > SESSION_MEMORY_BUDGET:
+        print("FAIL: per-session memory exceeds SESSION_MEMORY_BUDGET")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,503 @@
+"""
+压测/测试用的本地替身，实现与 DBOperator、COS、APNsClient 相同的接口：
+
+* MemoryDBOperator：基于 SQLite 内存库，按 Database/BetterflyDatabaseOriginal.sql 中存储过程的语义实现
+* FakeCOS：本地 HMAC 签名的预签名链接与内存对象存储
+* APNsMockServer：本地 HTTP/2(h2c) APNs 模拟服务，可配置延迟与错误率
+* HermeticAPNsClient：指向模拟服务、不读取 .p8 密钥的 APNsClient
+
+通过 EpollChatServer(config, db_operator=MemoryDBOperator, cos=FakeCOS(), apns=HermeticAPNsClient(url)) 注入，
+整个服务可以在没有 MySQL、COS 与 Apple 网络的机器上启动。
+"""
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime as dt
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.settings
+
+from Database.db_operator import DB_CALL_LATENCY, DB_POOL_WAIT
+from Utils.profiling import tracer
+from Utils.apns import APNsClient
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+df = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    user_name TEXT NOT NULL,
+    last_login TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    update_time TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    user_avatar TEXT
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    user_id INTEGER NOT NULL,
+    contact_id INTEGER NOT NULL,
+    notify INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (user_id, contact_id)
+);
+CREATE TABLE IF NOT EXISTS `groups` (
+    group_id INTEGER PRIMARY KEY,
+    group_name TEXT NOT NULL,
+    update_time TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    group_avatar TEXT
+);
+CREATE TABLE IF NOT EXISTS group_users (
+    group_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    notify INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (group_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS group_users_user ON group_users(user_id);
+CREATE TABLE IF NOT EXISTS messages (
+    from_user_id INTEGER NOT NULL,
+    to_id INTEGER NOT NULL,
+    `timestamp` TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `text` TEXT NOT NULL DEFAULT '',
+    type TEXT NOT NULL DEFAULT 'text',
+    is_group INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (from_user_id, to_id, `timestamp`, `text`, type, is_group)
+);
+-- 用 rowid 作为消息序号 seq，表达式与 MySQL 的 conv_low/conv_high 生成列一致(索引末尾隐含 rowid)
+CREATE INDEX IF NOT EXISTS messages_conversation ON messages(is_group,
+    (CASE WHEN is_group = 0 THEN min(from_user_id, to_id) ELSE to_id END),
+    (CASE WHEN is_group = 0 THEN max(from_user_id, to_id) ELSE 0 END));
+CREATE TABLE IF NOT EXISTS files (
+    file_hash TEXT PRIMARY KEY,
+    file_suffix TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unread_counts (
+    user_id INTEGER NOT NULL,
+    is_group INTEGER NOT NULL,
+    conv_id INTEGER NOT NULL,
+    `count` INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, is_group, conv_id)
+);
+CREATE TABLE IF NOT EXISTS user_apns_tokens (
+    user_id INTEGER NOT NULL,
+    user_apns_token TEXT NOT NULL,
+    PRIMARY KEY (user_id, user_apns_token)
+);
+INSERT OR IGNORE INTO users(user_id, user_name) VALUES (-1, 'Warning');
+INSERT OR IGNORE INTO users(user_id, user_name) VALUES (0, 'Server');
+INSERT OR IGNORE INTO `groups`(group_id, group_name) VALUES (-1, 'Broadcast');
+"""
+
+
+def _ts(value: dt | str | None) -> str:
+    if value is None:
+        return dt.now().strftime(df)
+    if isinstance(value, dt):
+        return value.strftime(df)
+    return value
+
+
+class MemoryDBOperator:
+    """
+    与 DBOperator 接口一致的 SQLite 实现。所有实例共享同一个内存库，
+    用信号量模拟连接池大小，用 latency 模拟数据库往返延迟。
+    """
+
+    latency = 0.0  # 每次调用附加的延迟(秒)
+    auto_apns_tokens = 0  # 用户登录时自动生成的APNs Token数量，便于压测推送链路
+    __conn: sqlite3.Connection = None
+    __lock = threading.Lock()
+    __pool = threading.BoundedSemaphore(16)
+    __pool_size = 16
+
+    @classmethod
+    def configure(cls, latency: float = 0.0, pool_size: int = 16, auto_apns_tokens: int = 0, path: str = ":memory:"):
+        """
+        :param latency: 每次数据库调用附加的延迟(秒)
+        :param pool_size: 模拟的连接池大小，超过后调用阻塞等待
+        :param auto_apns_tokens: 登录时为用户生成的APNs Token数量
+        :param path: SQLite 数据库路径，默认内存库
+        """
+        cls.latency = latency
+        cls.auto_apns_tokens = auto_apns_tokens
+        cls.__pool = threading.BoundedSemaphore(pool_size)
+        cls.__pool_size = pool_size
+        with cls.__lock:
+            cls.__conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            cls.__conn.executescript(SCHEMA)
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        in_use = cls.__pool_size - cls.__pool._value
+        return {"in_use": in_use, "idle": cls.__pool_size - in_use, "max": cls.__pool_size}
+
+    def __init__(self):
+        if MemoryDBOperator.__conn is None:
+            MemoryDBOperator.configure()
+
+    def close(self):
+        """与 DBOperator 保持一致，共享连接无需归还"""
+
+    def _acquire(self):
+        start = time.perf_counter()
+        MemoryDBOperator.__pool.acquire()
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+        return start
+
+    def _release(self, start: float):
+        MemoryDBOperator.__pool.release()
+        end = time.perf_counter()
+        DB_CALL_LATENCY.observe(end - start, "hermetic")
+        if tracer.enabled:
+            tracer.span("db:hermetic", start, end)
+
+    def _run(self, stmt: str, *args, all: bool = True):
+        start = self._acquire()
+        try:
+            if MemoryDBOperator.latency:
+                time.sleep(MemoryDBOperator.latency)
+            with MemoryDBOperator.__lock:
+                cur = MemoryDBOperator.__conn.execute(stmt, args)
+                return cur.fetchall() if all else cur.fetchone()
+        finally:
+            self._release(start)
+
+    def _script(self, *stmts: tuple):
+        """在一个事务中执行多条语句，对应一个存储过程调用"""
+        start = self._acquire()
+        try:
+            if MemoryDBOperator.latency:
+                time.sleep(MemoryDBOperator.latency)
+            with MemoryDBOperator.__lock:
+                conn = MemoryDBOperator.__conn
+                conn.execute("BEGIN")
+                try:
+                    for stmt, args in stmts:
+                        conn.execute(stmt, args)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        finally:
+            self._release(start)
+
+    def login(self, user_id: int, user_name: str, last_login: str | dt) -> str:
+        if user_id < 1000:
+            return 'user_id不得小于1000'
+        last_login = _ts(last_login)
+        stmts = [
+            ("INSERT INTO users(user_id, user_name, last_login) VALUES (?, ?, ?) "
+             "ON CONFLICT(user_id) DO UPDATE SET last_login = excluded.last_login, "
+             "update_time = CASE WHEN users.user_name <> excluded.user_name THEN CURRENT_TIMESTAMP "
+             "ELSE users.update_time END, user_name = excluded.user_name",
+             (user_id, user_name, last_login)),
+        ]
+        for i in range(MemoryDBOperator.auto_apns_tokens):
+            stmts.append(("INSERT OR IGNORE INTO user_apns_tokens VALUES (?, ?)",
+                          (user_id, hashlib.sha256(f"{user_id}-{i}".encode()).hexdigest())))
+        self._script(*stmts)
+        return ''
+
+    def queryUser(self, user_id: int) -> str:
+        user = self._run("SELECT user_name, user_avatar FROM users WHERE user_id = ?", user_id, all=False)
+        if user is None:
+            return '.'
+        return (user[0] or '') + '.' + (user[1] or '')
+
+    def queryUserName(self, user_id: int) -> str:
+        user = self._run("SELECT user_name FROM users WHERE user_id = ?", user_id, all=False)
+        return '' if user is None or user[0] is None else user[0]
+
+    def insertContact(self, user_id1: int, user_id2: int):
+        self._script(("INSERT OR IGNORE INTO contacts(user_id, contact_id) VALUES (?, ?)", (user_id1, user_id2)),
+                     ("INSERT OR IGNORE INTO contacts(user_id, contact_id) VALUES (?, ?)", (user_id2, user_id1)))
+
+    def queryGroup(self, group_id: int) -> str:
+        group = self._run("SELECT group_name, group_avatar FROM `groups` WHERE group_id = ?", group_id, all=False)
+        if group is None:
+            return '.'
+        return (group[0] or '') + '.' + (group[1] or '')
+
+    def insertGroup(self, group_id: int, group_name: str):
+        # 与存储过程一致：重复的group_id会抛出主键冲突
+        self._run("INSERT INTO `groups`(group_id, group_name) VALUES (?, ?)", group_id, group_name)
+
+    def insertGroupUser(self, group_id: int, user_id: int):
+        if self._run("SELECT 1 FROM `groups` WHERE group_id = ?", group_id, all=False) is None:
+            raise sqlite3.IntegrityError('group_id not in groups')
+        if self._run("SELECT 1 FROM users WHERE user_id = ?", user_id, all=False) is None:
+            raise sqlite3.IntegrityError('user_id not in users')
+        self._run("INSERT OR IGNORE INTO group_users(group_id, user_id) VALUES (?, ?)", group_id, user_id)
+
+    def insertMessage(self, from_user_id: int, to_id: int, timestamp: dt | str, text: str, type: str,
+                      is_group: bool):
+        self._run("INSERT OR IGNORE INTO messages(from_user_id, to_id, `timestamp`, `text`, type, is_group) "
+                  "VALUES (?, ?, ?, ?, ?, ?)", from_user_id, to_id, _ts(timestamp), text, type, int(bool(is_group)))
+
+    def queryFile(self, file_hash: str, file_suffix: str):
+        row = self._run("SELECT file_hash FROM files WHERE file_hash = ? AND file_suffix = ?",
+                        file_hash, file_suffix, all=False)
+        return row is not None
+
+    def insertFile(self, file_hash: str, file_suffix: str):
+        self._run("INSERT INTO files VALUES (?, ?)", file_hash, file_suffix)
+
+    def queryFiles(self, files: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        if not files:
+            return set()
+        placeholders = ",".join("(?, ?)" for _ in files)
+        rows = self._run(f"SELECT file_hash, file_suffix FROM files WHERE (file_hash, file_suffix) IN "
+                         f"(VALUES {placeholders})", *(v for f in files for v in f))
+        return {(row[0], row[1]) for row in rows}
+
+    def insertFiles(self, files: list[tuple[str, str]]):
+        self._script(*(("INSERT OR IGNORE INTO files VALUES (?, ?)", f) for f in files))
+
+    def querySyncMessage(self, user_id: int, last_login: dt | str):
+        rows = self._run(
+            "SELECT from_user_id, to_id, `timestamp`, `text`, type, is_group FROM messages "
+            "WHERE `timestamp` > ? AND ("
+            "  is_group = 0 AND (to_id = ? OR from_user_id = ?)"
+            "  OR is_group <> 0 AND to_id IN (SELECT group_id FROM group_users WHERE user_id = ? UNION SELECT -1))",
+            _ts(last_login), user_id, user_id, user_id)
+        # pymysql 会把 DATETIME 列转换为 datetime 对象
+        return tuple((row[0], row[1], dt.strptime(row[2], df)) + tuple(row[3:]) for row in rows)
+
+    def queryHistory(self, conversation: tuple[int, int, int], before: int | None, limit: int):
+        is_group, conv_low, conv_high = conversation
+        rows = self._run(
+            "SELECT from_user_id, to_id, `timestamp`, `text`, type, is_group, rowid FROM messages "
+            "WHERE is_group = ? AND (CASE WHEN is_group = 0 THEN min(from_user_id, to_id) ELSE to_id END) = ? "
+            "AND (CASE WHEN is_group = 0 THEN max(from_user_id, to_id) ELSE 0 END) = ? AND rowid < ? "
+            "ORDER BY rowid DESC LIMIT ?",
+            is_group, conv_low, conv_high, (1 << 63) - 1 if before is None else before, limit)
+        return tuple((row[0], row[1], dt.strptime(row[2], df)) + tuple(row[3:]) for row in rows)
+
+    def queryUnread(self, user_id: int):
+        return tuple(self._run("SELECT is_group, conv_id, `count` FROM unread_counts WHERE user_id = ? AND `count` > 0",
+                               user_id))
+
+    def updateUnread(self, changes: list[tuple[int, int, int, bool, int]]):
+        stmts = []
+        for user_id, is_group, conv_id, reset, delta in changes:
+            stmts.append(("INSERT INTO unread_counts VALUES (?, ?, ?, ?) ON CONFLICT(user_id, is_group, conv_id) "
+                          "DO UPDATE SET `count` = CASE WHEN ? THEN excluded.`count` "
+                          "ELSE unread_counts.`count` + excluded.`count` END",
+                          (user_id, is_group, conv_id, delta, int(reset))))
+            stmts.append(("DELETE FROM unread_counts WHERE user_id = ? AND is_group = ? AND conv_id = ? "
+                          "AND `count` <= 0", (user_id, is_group, conv_id)))
+        self._script(*stmts)
+
+    def queryGroupUser(self, group_id: int):
+        rows = self._run("SELECT user_id FROM group_users WHERE group_id = ?", group_id)
+        return (row[0] for row in rows)
+
+    def insertUserAPNsToken(self, from_user_id: int, user_apns_token: str):
+        self._run("INSERT OR IGNORE INTO user_apns_tokens VALUES (?, ?)", from_user_id, user_apns_token)
+
+    def queryUserAPNsTokens(self, from_user_id: int):
+        return tuple(self._run("SELECT user_apns_token FROM user_apns_tokens WHERE user_id = ?", from_user_id))
+
+    def deleteUserAPNsToken(self, from_user_id: int, user_apns_token: str):
+        self._run("DELETE FROM user_apns_tokens WHERE user_id = ? AND user_apns_token = ?",
+                  from_user_id, user_apns_token)
+
+    def updateUserAvatar(self, id: int, avatar: str):
+        self._run("UPDATE users SET user_avatar = ? WHERE user_id = ?", avatar, id)
+
+    def updateGroupAvatar(self, id: int, avatar: str):
+        self._run("UPDATE `groups` SET group_avatar = ? WHERE group_id = ?", avatar, id)
+
+
+class FakeCOS:
+    """与 Utils.cos.COS 接口一致的内存对象存储，预签名链接在本地用 HMAC 计算"""
+
+    def __init__(self, secret_key: str = "hermetic", host: str = "cos.local"):
+        self.secret_key = secret_key.encode()
+        self.host = host
+        self.objects = {}  # {(bucket, key): bytes}
+
+    def _sign(self, method: str, bucket: str, key: str, expired: int) -> str:
+        expire_at = int(time.time()) + expired
+        text = f"{method.lower()}\n/{bucket}/{key}\n{expire_at}"
+        signature = hmac.new(self.secret_key, text.encode(), hashlib.sha1).hexdigest()
+        return f"https://{bucket}.{self.host}/{key}?q-key-time={expire_at}&q-signature={signature}"
+
+    def list_buckets(self):
+        return {"Buckets": {"Bucket": [{"Name": name} for name in sorted({b for b, _ in self.objects})]}}
+
+    def file_easy_upload(self, file_path, bucket, key):
+        with open(file_path, 'rb') as fp:
+            return self.file_easy_upload_BytesIO(fp, bucket, key)
+
+    def file_easy_upload_BytesIO(self, file, bucket, key):
+        data = file.read() if hasattr(file, "read") else bytes(file)
+        self.objects[(bucket, key)] = data
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def multipart_upload(self, source, bucket, key, part_size: int = 0, max_workers: int = 0):
+        if isinstance(source, str):
+            return self.file_easy_upload(source, bucket, key)
+        return self.file_easy_upload_BytesIO(source, bucket, key)
+
+    def iter_objects(self, bucket, prefix: str = "", page_size: int = 1000):
+        for (b, key), data in sorted(self.objects.items()):
+            if b == bucket and key.startswith(prefix):
+                yield {"Key": key, "Size": str(len(data))}
+
+    def list_all_objects(self, bucket, prefix: str = ""):
+        return list(self.iter_objects(bucket, prefix))
+
+    def parallel_download(self, bucket, key, file_path, part_size: int = 0, max_workers: int = 0):
+        with open(file_path, 'wb') as f:
+            f.write(self.objects[(bucket, key)])
+
+    def get_object_local(self, bucket, key, file_path):
+        self.parallel_download(bucket, key, file_path)
+
+    def iter_object_chunks(self, bucket, key, chunk_size: int = 1024 * 1024):
+        data = self.objects[(bucket, key)]
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+    def get_object_stream(self, bucket, key):
+        return io.BytesIO(self.objects[(bucket, key)])
+
+    def get_poject_url(self, bucket, key):
+        return f"https://{bucket}.{self.host}/{key}"
+
+    def get_presigned_download_url(self, Bucket, Key, Method='GET', Params=None, Headers=None, SignHost=False,
+                                   Expired=60):
+        return self._sign(Method, Bucket, Key, Expired)
+
+    def get_presigned_upload_url(self, Bucket, Key, Method='PUT', Params=None, Headers=None, SignHost=False,
+                                 Expired=300):
+        return self._sign(Method, Bucket, Key, Expired)
+
+    def get_presigned_urls(self, Bucket, Keys, Method='GET', Expired=60):
+        return [self._sign(Method, Bucket, key, Expired) for key in Keys]
+
+    def delete_object(self, bucket, key):
+        self.objects.pop((bucket, key), None)
+        return {}
+
+
+class _APNsMockProtocol(asyncio.Protocol):
+    def __init__(self, server: "APNsMockServer"):
+        self.server = server
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        self.transport = None
+        self.bodies = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 1000})
+        transport.write(self.conn.data_to_send())
+
+    def data_received(self, data: bytes):
+        try:
+            events = self.conn.receive_data(data)
+        except Exception:
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.bodies[event.stream_id] = b""
+            elif isinstance(event, h2.events.DataReceived):
+                self.bodies[event.stream_id] = self.bodies.get(event.stream_id, b"") + event.data
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id: int):
+        status, reason = await self.server.outcome()
+        self.bodies.pop(stream_id, None)
+        if self.transport.is_closing():
+            return
+        headers = [(":status", str(status)), ("apns-id", str(uuid.uuid4()))]
+        body = json.dumps({"reason": reason}).encode() if reason else b""
+        try:
+            if body:
+                self.conn.send_headers(stream_id, headers + [("content-length", str(len(body)))])
+                self.conn.send_data(stream_id, body, end_stream=True)
+            else:
+                self.conn.send_headers(stream_id, headers, end_stream=True)
+        except Exception:
+            return
+        self.transport.write(self.conn.data_to_send())
+
+
+class APNsMockServer:
+    """
+    本地 APNs 模拟服务(HTTP/2 明文 prior knowledge)，在独立线程中运行。
+    每个请求等待 latency 秒后返回，按 error_rate 的概率从 errors 中随机挑选一个错误返回。
+    """
+
+    DEFAULT_ERRORS = ((429, "TooManyRequests"), (503, "ServiceUnavailable"),
+                      (410, "Unregistered"), (400, "BadDeviceToken"))
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 errors: tuple = DEFAULT_ERRORS):
+        """
+        :param latency: 每个推送请求的响应延迟(秒)
+        :param error_rate: 返回错误的概率
+        :param errors: 可能返回的错误 (状态码, reason) 列表
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors
+        self.requests = 0
+        self.failures = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def outcome(self) -> tuple[int, str]:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.failures += 1
+            return random.choice(self.errors)
+        return 200, ""
+
+    def start(self) -> "APNsMockServer":
+        self.thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            self.loop.create_server(lambda: _APNsMockProtocol(self), self.host, self.port), self.loop)
+        self.server = future.result()
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"APNs mock listening on {self.url}")
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+class HermeticAPNsClient(APNsClient):
+    """连接本地模拟服务的 APNsClient，不读取 .p8 密钥也不签名"""
+
+    def __init__(self, apns_url: str):
+        super().__init__(use_sandbox=True, key_path="", apns_url=apns_url)
+
+    def _generate_jwt(self) -> str:
+        return "hermetic"
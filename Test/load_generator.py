@@ -0,0 +1,533 @@
+"""
+EpollChatServer 压测/容量规划工具
+
+基于 asyncio 同时模拟大量在线用户，每个用户使用当前协议登录后，按照配置的比例发送
+单聊 Post、群聊 Post、全体消息(broadcast)、QueryUser、File、FileBatch、History、Search、ReadAck 与 Ping 请求，统计端到端(发送->对端收到)延迟分位数、
+请求-响应延迟以及消息投递吞吐量，并支持模拟断线重连风暴、刷消息的用户、不读数据的慢速接收方与超时重发的客户端。
+
+用法示例：
+    python Test/load_generator.py --host 127.0.0.1 --port 54342 --users 2000 --duration 60 \
+        --rate 0.5 --mix post=70,group=10,query=10,file=10 --storm-at 30 --storm-fraction 0.5
+    python Test/load_generator.py --users 200 --abusers 2 --abuse-rate 500 --stalled 5
+    python Test/load_generator.py --users 200 --mix post=100 --resend-ratio 0.2  # 20%的消息带同一 client_msg_id 重发
+    python Test/load_generator.py --port 54342 54343 --users 200  # 用户轮流连接集群的两个节点
+
+刷消息的用户(--abusers)的消息不计入投递延迟，用于观察限流与慢速接收方处理对正常用户延迟的影响。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import resource
+import time
+from collections import deque
+from datetime import datetime as dt
+from enum import IntEnum
+
+df = "%Y-%m-%d %H:%M:%S"
+MARK = "lg|"  # 压测消息的前缀，用于从msg中还原发送方与序号
+
+
+class RequestType(IntEnum):
+    """与 Utils/Message.py 中的定义保持一致"""
+    Login = 0
+    Exit = 1
+    Post = 2
+    Key = 3
+    QueryUser = 4
+    InsertContact = 5
+    QueryGroup = 6
+    InsertGroup = 7
+    InsertGroupUser = 8
+    File = 9
+    APNsToken = 10
+    UpdateAvatar = 11
+    FileBatch = 12
+    Ping = 13
+    History = 14
+    Search = 15
+    ReadAck = 16
+
+
+class ResponseType(IntEnum):
+    Refused = 0
+    Server = 1
+    Post = 2
+    File = 3
+    Warn = 4
+    PubKey = 5
+    UserInfo = 6
+    GroupInfo = 7
+    FileBatch = 8
+    Pong = 9
+    History = 10
+    SearchResult = 11
+    UnreadSummary = 12
+
+
+def encode_frame(packet: dict) -> bytes:
+    """与 MessageDealer.encode 相同的 -S-base64-E- 封包"""
+    return b"-S-" + base64.b64encode(json.dumps(packet).encode()) + b"-E-"
+
+
+class FrameReader:
+    """按 -S- -E- 切分字节流，保留跨 recv 的半包"""
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data: bytes) -> list[dict]:
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(b"-S-")
+            if start == -1:
+                self.buffer = b""
+                break
+            end = self.buffer.find(b"-E-", start + 3)
+            if end == -1:
+                self.buffer = self.buffer[start:]
+                break
+            frames.append(json.loads(base64.b64decode(self.buffer[start + 3:end])))
+            self.buffer = self.buffer[end + 3:]
+        return frames
+
+
+class Histogram:
+    """保存原始样本(秒)，结束时计算分位数"""
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, value: float):
+        self.samples.append(value)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {"count": 0}
+        data = sorted(self.samples)
+        n = len(data)
+
+        def pct(p):
+            return round(data[min(n - 1, int(p * n))] * 1000, 3)
+
+        return {"count": n, "p50_ms": pct(0.50), "p90_ms": pct(0.90), "p99_ms": pct(0.99),
+                "p999_ms": pct(0.999), "max_ms": round(data[-1] * 1000, 3)}
+
+
+class Stats:
+    def __init__(self):
+        self.delivery = Histogram()  # 端到端投递延迟
+        self.request = {name: Histogram() for name in ("query", "file", "batch", "history", "search", "ping")}  # 请求-响应延迟
+        self.login = Histogram()  # 登录到收到欢迎消息的延迟
+        self.reconnect = Histogram()  # 重连风暴中的重新登录延迟
+        self.sent = {name: 0 for name in ("post", "group", "broadcast", "query", "file", "batch", "history",
+                                             "search", "read", "ping")}
+        self.delivered = 0
+        self.echoes = 0
+        self.resent = 0  # 模拟超时重发的消息数
+        self.duplicates = 0  # 接收方重复收到的消息数(服务器去重后应为0)
+        self.errors = 0
+        self.disconnects = 0
+        self.warnings = 0  # 收到的 Warn 帧(限流、积压恢复等)
+        self.start = 0.0
+        self.end = 0.0
+
+    def report(self) -> dict:
+        elapsed = max(self.end - self.start, 1e-9)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "sent": self.sent,
+            "delivered": self.delivered,
+            "delivered_per_s": round(self.delivered / elapsed, 2),
+            "echoes": self.echoes,
+            "resent": self.resent,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "disconnects": self.disconnects,
+            "warnings": self.warnings,
+            "delivery_latency": self.delivery.summary(),
+            "query_latency": self.request["query"].summary(),
+            "file_latency": self.request["file"].summary(),
+            "file_batch_latency": self.request["batch"].summary(),
+            "history_latency": self.request["history"].summary(),
+            "search_latency": self.request["search"].summary(),
+            "ping_latency": self.request["ping"].summary(),
+            "login_latency": self.login.summary(),
+            "reconnect_latency": self.reconnect.summary(),
+        }
+
+
+class SimulatedUser:
+    """一个模拟用户：一条连接 + 一个发送循环 + 一个接收循环"""
+
+    def __init__(self, runner: "LoadRunner", user_id: int):
+        self.runner = runner
+        self.user_id = user_id
+        self.name = f"lg{user_id}"
+        self.group_id = None
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.frames = FrameReader()
+        self.welcomed: asyncio.Future | None = None
+        self.pending = {"query": deque(), "file": deque(), "batch": deque(), "history": deque(),
+                        "search": deque(), "ping": deque()}  # 等待响应的请求发送时间(FIFO)
+        self.history_cursors = {}  # {对方id: 下一页游标}，往前翻看历史消息
+        self.received = set()  # 收到的压测消息，用于发现重复投递
+        self.seq = 0
+        self.recv_task: asyncio.Task | None = None
+
+    async def connect(self, histogram: Histogram):
+        args = self.runner.args
+        port = args.port[(self.user_id - args.base_user_id) % len(args.port)]
+        self.reader, self.writer = await asyncio.open_connection(args.host, port)
+        self.frames = FrameReader()
+        self.pending = {"query": deque(), "file": deque(), "batch": deque(), "history": deque(),
+                        "search": deque(), "ping": deque()}
+        self.welcomed = asyncio.get_running_loop().create_future()
+        self.recv_task = asyncio.create_task(self.recv_loop())
+        begin = time.perf_counter()
+        await self.send({"type": RequestType.Login, "from": self.user_id, "name": self.name,
+                         "timestamp": dt.now().strftime(df)})
+        # 服务器在initialize_worker里处理登录，必须等到欢迎消息后才能继续发送其他请求
+        await asyncio.wait_for(self.welcomed, timeout=args.login_timeout)
+        histogram.add(time.perf_counter() - begin)
+
+    async def send(self, packet: dict):
+        self.writer.write(encode_frame(packet))
+        await self.writer.drain()
+
+    async def close(self, abrupt: bool = False):
+        if self.writer is None:
+            return
+        try:
+            if not abrupt:
+                await self.send({"type": RequestType.Exit, "from": self.user_id})
+            self.writer.close()
+        except (ConnectionError, OSError):
+            pass
+        if self.recv_task is not None:
+            self.recv_task.cancel()
+        self.writer = None
+
+    async def recv_loop(self):
+        stats = self.runner.stats
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                for frame in self.frames.feed(data):
+                    self.on_frame(frame, now)
+        except (ConnectionError, OSError, ValueError):
+            stats.errors += 1
+        except asyncio.CancelledError:
+            return
+        stats.disconnects += 1
+        if self.welcomed is not None and not self.welcomed.done():
+            self.welcomed.set_exception(ConnectionError("closed before login"))
+
+    def on_frame(self, frame: dict, now: float):
+        stats = self.runner.stats
+        kind = frame.get("type")
+        if kind == ResponseType.Server:
+            if self.welcomed is not None and not self.welcomed.done():
+                self.welcomed.set_result(True)
+        elif kind == ResponseType.Post:
+            msg = frame.get("msg", "")
+            if not msg.startswith(MARK):
+                return
+            if frame.get("from") == self.user_id:
+                stats.echoes += 1
+                return
+            if msg in self.received:
+                stats.duplicates += 1
+                return
+            self.received.add(msg)
+            sent_at = self.runner.sent_at.get(msg)
+            if sent_at is not None:
+                stats.delivered += 1
+                stats.delivery.add(now - sent_at)
+        elif kind == ResponseType.UserInfo:
+            self.complete("query", now)
+        elif kind == ResponseType.File:
+            self.complete("file", now)
+        elif kind == ResponseType.FileBatch:
+            self.complete("batch", now)
+        elif kind == ResponseType.Pong:
+            self.complete("ping", now)
+        elif kind == ResponseType.History:
+            if frame.get("last"):  # 一页可能拆成多帧，收到最后一帧才算完成
+                self.history_cursors[frame.get("to")] = frame.get("cursor")
+                self.complete("history", now)
+        elif kind == ResponseType.SearchResult:
+            self.complete("search", now)
+        elif kind == ResponseType.Warn:
+            stats.warnings += 1
+        elif kind == ResponseType.Refused:
+            stats.errors += 1
+
+    def complete(self, name: str, now: float):
+        if self.pending[name]:
+            self.runner.stats.request[name].add(now - self.pending[name].popleft())
+
+    async def send_post(self, group: bool, abuse: bool = False, broadcast: bool = False):
+        self.seq += 1
+        msg = f"{MARK}{self.user_id}|{self.seq}"
+        if broadcast:  # 全体消息，发给服务器上的所有在线用户
+            to_id, kind, group = -1, "broadcast", True
+        elif group:
+            to_id, kind = self.group_id, "group"
+        else:
+            to_id, kind = self.runner.pick_peer(self.user_id), "post"
+        if not abuse:
+            self.runner.sent_at[msg] = time.perf_counter()
+        packet = {"type": RequestType.Post, "from": self.user_id, "name": self.name, "is_group": group,
+                  "to": to_id, "msg": msg, "msg_type": "text", "timestamp": dt.now().strftime(df),
+                  "client_msg_id": f"{self.user_id}-{self.seq}"}
+        await self.send(packet)
+        self.runner.stats.sent[kind] += 1
+        if not abuse and random.random() < self.runner.args.resend_ratio:
+            # 模拟客户端没等到回显就超时重发同一条消息
+            await self.send(packet)
+            self.runner.stats.resent += 1
+
+    async def send_query(self):
+        self.pending["query"].append(time.perf_counter())
+        await self.send({"type": RequestType.QueryUser, "from": self.user_id,
+                         "to": self.runner.pick_peer(self.user_id)})
+        self.runner.stats.sent["query"] += 1
+
+    async def send_file(self):
+        file_hash = f"{random.getrandbits(256):064x}"
+        self.pending["file"].append(time.perf_counter())
+        await self.send({"type": RequestType.File, "from": self.user_id, "file_hash": file_hash,
+                         "file_suffix": "jpg", "operation": random.choice(("upload", "download"))})
+        self.runner.stats.sent["file"] += 1
+
+    async def send_file_batch(self):
+        files = [{"file_hash": f"{random.getrandbits(256):064x}", "file_suffix": "jpg"}
+                 for _ in range(self.runner.args.batch_size)]
+        self.pending["batch"].append(time.perf_counter())
+        await self.send({"type": RequestType.FileBatch, "from": self.user_id, "files": files,
+                         "operation": random.choice(("upload", "download"))})
+        self.runner.stats.sent["batch"] += 1
+
+    async def send_history(self):
+        """查看与某个对方的历史消息：一半概率从最新一页开始，否则接着上次的游标往前翻"""
+        peer = self.runner.pick_peer(self.user_id)
+        cursor = self.history_cursors.get(peer) if random.random() < 0.5 else None
+        self.pending["history"].append(time.perf_counter())
+        await self.send({"type": RequestType.History, "from": self.user_id, "to": peer, "is_group": False,
+                         "cursor": cursor, "limit": self.runner.args.history_limit})
+        self.runner.stats.sent["history"] += 1
+
+    async def send_search(self):
+        """在与某个对方的私聊中搜索对方发来的压测消息"""
+        peer = self.runner.pick_peer(self.user_id)
+        self.pending["search"].append(time.perf_counter())
+        await self.send({"type": RequestType.Search, "from": self.user_id, "to": peer, "is_group": False,
+                         "msg": f"lg {peer}"})
+        self.runner.stats.sent["search"] += 1
+
+    async def send_read_ack(self):
+        """已读与某个对方的私聊，服务器不回复"""
+        await self.send({"type": RequestType.ReadAck, "from": self.user_id, "to": self.runner.pick_peer(self.user_id),
+                         "is_group": False})
+        self.runner.stats.sent["read"] += 1
+
+    async def send_ping(self):
+        self.pending["ping"].append(time.perf_counter())
+        await self.send({"type": RequestType.Ping, "from": self.user_id, "timestamp": dt.now().strftime(df)})
+        self.runner.stats.sent["ping"] += 1
+
+    async def traffic_loop(self, deadline: float):
+        args = self.runner.args
+        kinds, weights = self.runner.mix
+        if args.rate <= 0:
+            return
+        await asyncio.sleep(random.expovariate(args.rate))  # 打散各用户的起始时间
+        while time.perf_counter() < deadline:
+            if self.writer is not None and self.welcomed is not None and self.welcomed.done():
+                kind = random.choices(kinds, weights)[0]
+                try:
+                    if kind == "post":
+                        await self.send_post(False)
+                    elif kind == "group" and self.group_id is not None:
+                        await self.send_post(True)
+                    elif kind == "broadcast":
+                        await self.send_post(True, broadcast=True)
+                    elif kind == "query":
+                        await self.send_query()
+                    elif kind == "file":
+                        await self.send_file()
+                    elif kind == "batch":
+                        await self.send_file_batch()
+                    elif kind == "history":
+                        await self.send_history()
+                    elif kind == "search":
+                        await self.send_search()
+                    elif kind == "read":
+                        await self.send_read_ack()
+                    elif kind == "ping":
+                        await self.send_ping()
+                except (ConnectionError, OSError):
+                    self.runner.stats.errors += 1
+            await asyncio.sleep(random.expovariate(args.rate))
+
+    async def abuse_loop(self, deadline: float):
+        """以 abuse_rate 持续发送单聊消息，模拟刷消息的客户端"""
+        interval = 1 / self.runner.args.abuse_rate
+        while time.perf_counter() < deadline:
+            if self.writer is not None:
+                try:
+                    await self.send_post(False, abuse=True)
+                except (ConnectionError, OSError):
+                    self.runner.stats.errors += 1
+                    return
+            await asyncio.sleep(interval)
+
+    def stall(self):
+        """停止从socket读取数据，模拟网络卡住或不读数据的接收方"""
+        if self.writer is not None:
+            self.writer.transport.pause_reading()
+
+
+class LoadRunner:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.stats = Stats()
+        self.users = [SimulatedUser(self, args.base_user_id + i) for i in range(args.users)]
+        self.sent_at = {}  # {msg标记: 发送时间}
+        self.mix = self.parse_mix(args.mix)
+        self.connect_limit = asyncio.Semaphore(args.connect_concurrency)
+
+    @staticmethod
+    def parse_mix(text: str) -> tuple[list[str], list[float]]:
+        kinds, weights = [], []
+        for item in text.split(","):
+            name, _, weight = item.partition("=")
+            name = name.strip()
+            if name not in ("post", "group", "broadcast", "query", "file", "batch", "history", "search", "read",
+                            "ping"):
+                raise ValueError(f"unknown mix entry: {name}")
+            kinds.append(name)
+            weights.append(float(weight or 1))
+        return kinds, weights
+
+    def pick_peer(self, user_id: int) -> int:
+        peer = random.choice(self.users).user_id
+        return peer if peer != user_id or len(self.users) == 1 else self.pick_peer(user_id)
+
+    async def connect_user(self, user: SimulatedUser, histogram: Histogram):
+        async with self.connect_limit:
+            try:
+                await user.connect(histogram)
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                self.stats.errors += 1
+                await user.close(abrupt=True)
+
+    async def setup_groups(self):
+        """按 group_size 把用户分组，每组第一个用户建群，其余用户入群"""
+        args = self.args
+        if args.group_size <= 1:
+            return
+        for index in range(0, len(self.users), args.group_size):
+            members = self.users[index:index + args.group_size]
+            group_id = args.base_group_id + index // args.group_size
+            owner = members[0]
+            if owner.writer is None:
+                continue
+            await owner.send({"type": RequestType.InsertGroup, "from": owner.user_id, "to": group_id,
+                              "msg": f"lg-group-{group_id}"})
+            for member in members:
+                member.group_id = group_id
+            await asyncio.sleep(0.05)  # 保证建群请求先于入群请求落库
+            for member in members[1:]:
+                if member.writer is not None:
+                    await member.send({"type": RequestType.InsertGroupUser, "from": member.user_id,
+                                       "to": group_id})
+        await asyncio.sleep(args.settle)
+
+    async def reconnect_storm(self):
+        """同时断开一部分连接并让它们立即重连，模拟发布/网络抖动后的重连风暴"""
+        args = self.args
+        victims = random.sample(self.users, int(len(self.users) * args.storm_fraction))
+        print(f"[storm] dropping {len(victims)} connections")
+        await asyncio.gather(*(user.close(abrupt=True) for user in victims))
+        begin = time.perf_counter()
+        await asyncio.gather(*(self.connect_user(user, self.stats.reconnect) for user in victims))
+        print(f"[storm] {len(victims)} users reconnected in {time.perf_counter() - begin:.2f}s")
+
+    async def run(self) -> dict:
+        args = self.args
+        begin = time.perf_counter()
+        await asyncio.gather(*(self.connect_user(user, self.stats.login) for user in self.users))
+        connected = sum(1 for user in self.users if user.writer is not None)
+        print(f"[connect] {connected}/{len(self.users)} users logged in in {time.perf_counter() - begin:.2f}s")
+        await self.setup_groups()
+
+        self.stats.start = time.perf_counter()
+        deadline = self.stats.start + args.duration
+        abusers = self.users[:args.abusers]
+        for user in self.users[len(self.users) - args.stalled:] if args.stalled > 0 else ():
+            user.stall()
+        tasks = [asyncio.create_task(user.traffic_loop(deadline)) for user in self.users[args.abusers:]]
+        tasks += [asyncio.create_task(user.abuse_loop(deadline)) for user in abusers]
+        if args.storm_at is not None and 0 <= args.storm_at < args.duration:
+            await asyncio.sleep(args.storm_at)
+            await self.reconnect_storm()
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(args.settle)  # 等待在途消息到达
+        self.stats.end = time.perf_counter()
+        await asyncio.gather(*(user.close() for user in self.users))
+        return self.stats.report()
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Betterfly load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, nargs="+", default=[54342],
+                        help="服务器端口，指定多个(集群的多个节点)时用户依次轮流连接")
+    parser.add_argument("--users", type=int, default=100, help="模拟用户数")
+    parser.add_argument("--base-user-id", type=int, default=100000, help="模拟用户的起始id(需>=1000)")
+    parser.add_argument("--base-group-id", type=int, default=900000, help="压测群组的起始id")
+    parser.add_argument("--group-size", type=int, default=20, help="每个压测群组的人数，<=1 时不建群")
+    parser.add_argument("--duration", type=float, default=30, help="发送阶段时长(秒)")
+    parser.add_argument("--rate", type=float, default=1.0, help="每个用户每秒平均请求数(泊松分布)")
+    parser.add_argument("--mix", default="post=70,group=10,query=10,file=10", help="请求类型权重")
+    parser.add_argument("--batch-size", type=int, default=50, help="批量文件请求(batch)中的文件数")
+    parser.add_argument("--history-limit", type=int, default=50, help="历史消息请求(history)的每页消息数")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="同时进行的登录数")
+    parser.add_argument("--login-timeout", type=float, default=30, help="等待欢迎消息的超时(秒)")
+    parser.add_argument("--storm-at", type=float, default=None, help="在发送阶段第N秒触发重连风暴")
+    parser.add_argument("--storm-fraction", type=float, default=0.5, help="重连风暴中断开的连接比例")
+    parser.add_argument("--settle", type=float, default=2.0, help="阶段切换后的等待时间(秒)")
+    parser.add_argument("--abusers", type=int, default=0, help="刷消息的用户数(取前N个用户)")
+    parser.add_argument("--abuse-rate", type=float, default=200.0, help="每个刷消息用户每秒发送的消息数")
+    parser.add_argument("--stalled", type=int, default=0, help="登录后不再读取数据的用户数(取后N个用户)")
+    parser.add_argument("--resend-ratio", type=float, default=0.0, help="带同一 client_msg_id 重发一次的消息比例")
+    parser.add_argument("--json", dest="json_path", default=None, help="把结果写入JSON文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    report = asyncio.run(LoadRunner(args).run())
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
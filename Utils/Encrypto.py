@@ -59,6 +59,20 @@ class MessageDealer:
         msg_list = re.findall(b"-S-([^-]*?)-E-", message)
         return [base64.b64decode(item) for item in msg_list]
 
+    @staticmethod
+    def split_frames(buffer: bytes) -> tuple[bytes, bytes]:
+        """
+        把收到的字节流分为完整的帧与末尾尚未收完的半包
+        :return: (可直接decode的完整帧, 需与下次收到的数据拼接的半包)
+        """
+        end = buffer.rfind(b"-E-")
+        complete, rest = (b"", buffer) if end == -1 else (buffer[:end + 3], buffer[end + 3:])
+        start = rest.find(b"-S-")
+        if start != -1:
+            return complete, rest[start:]
+        # 保留可能是 -S- 前半部分的结尾
+        return complete, b"-S" if rest.endswith(b"-S") else b"-" if rest.endswith(b"-") else b""
+
     @staticmethod
     def encode(message: str, password=None) -> bytes:
         if type(message) == str:
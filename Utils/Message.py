@@ -21,6 +21,11 @@ class RequestType(IntEnum):
     File = 9  # 文件上传/下载请求
     APNsToken = 10  # 用户APNs Token
     UpdateAvatar = 11  # 上传用户头像或群头像
+    FileBatch = 12  # 批量文件上传/下载请求
+    Ping = 13  # 心跳
+    History = 14  # 按游标分页查询会话的历史消息
+    Search = 15  # 全文搜索消息
+    ReadAck = 16  # 已读回执，清零一个会话的未读数
 
 
 class ResponseType(IntEnum):
@@ -32,6 +37,11 @@ class ResponseType(IntEnum):
     PubKey = 5  # RSA公钥响应信息
     UserInfo = 6  # 告知被查询的用户信息
     GroupInfo = 7  # 告知被查询的群组信息
+    FileBatch = 8  # 批量文件下载/上传链接/已存在通知
+    Pong = 9  # 心跳回复
+    History = 10  # 一页历史消息(可能拆成多帧)
+    SearchResult = 11  # 一页搜索结果
+    UnreadSummary = 12  # 各会话的未读数
 
 
 class RequestMessage:
@@ -48,6 +58,7 @@ class RequestMessage:
         if self.type == RequestType.Post:
             self.name = self.packet_json["name"]
             self.msg_type = self.packet_json["msg_type"]
+            self.client_msg_id = self.packet_json.get("client_msg_id")  # 客户端生成的消息id，用于识别重发
             self.name = ""
 
         elif self.type == RequestType.Login:
@@ -60,9 +71,17 @@ class RequestMessage:
             self.file_suffix = self.packet_json["file_suffix"]
             self.file_operation = self.packet_json["operation"]
 
+        elif self.type == RequestType.FileBatch:
+            self.files = [(f["file_hash"], f["file_suffix"]) for f in self.packet_json["files"]]
+            self.file_operation = self.packet_json["operation"]
+
         elif self.type == RequestType.APNsToken:
             self.apns_token = self.packet_json["apns_token"]
 
+        elif self.type in (RequestType.History, RequestType.Search):
+            self.cursor = self.packet_json.get("cursor")
+            self.limit = self.packet_json.get("limit")
+
     def to_json_str(self):
         return json.dumps(self.packet_json)
 
@@ -73,7 +92,8 @@ class RequestMessage:
 class ResponseMessage:
     def __init__(self, type: ResponseType, from_id: int, msg: str, from_name: str = "",
                  to_id: int = 0, is_group: bool = None, content: str = "",
-                 timestamp: dt | str = None, msg_type: str = None, file_op: str = None):
+                 timestamp: dt | str = None, msg_type: str = None, file_op: str = None, files: list = None,
+                 messages: list = None, cursor: int = None, last: bool = None, unread: dict = None):
         self.type = type
         self.from_id = from_id
         self.msg = msg
@@ -84,6 +104,11 @@ class ResponseMessage:
         self.timestamp = timestamp
         self.msg_type = msg_type
         self.file_op = file_op
+        self.files = files
+        self.messages = messages
+        self.cursor = cursor
+        self.last = last
+        self.unread = unread
 
     @staticmethod
     def make_server_message(msg: str):
@@ -101,9 +126,55 @@ class ResponseMessage:
     def make_download_message(file_full_name: str, content: str):
         return ResponseMessage(ResponseType.File, 0, file_full_name, content=content, file_op="download")
 
+    @staticmethod
+    def make_file_batch_message(file_op: str, files: list[dict]):
+        """
+        :param file_op: "upload"/"download"
+        :param files: [{"name": 文件名, "content": 链接/"Existed"/"Not Exist"}]
+        """
+        return ResponseMessage(ResponseType.FileBatch, 0, "", file_op=file_op, files=files)
+
+    @staticmethod
+    def make_pong_message(timestamp: str = None):
+        """
+        :param timestamp: 原样返回心跳请求中的时间戳，便于客户端计算往返时间
+        """
+        return ResponseMessage(ResponseType.Pong, 0, "", timestamp=timestamp)
+
+    @staticmethod
+    def make_history_message(to_id: int, is_group: bool, messages: list[dict], cursor: int | None, last: bool):
+        """
+        :param to_id: 私聊为对方用户id，群聊为群组id
+        :param messages: [{"seq", "from", "to", "timestamp", "msg", "msg_type", "is_group"}]，按 seq 从新到旧
+        :param cursor: 下一页的游标，没有更早的消息时为None
+        :param last: 是否为本页的最后一帧
+        """
+        return ResponseMessage(ResponseType.History, 0, "", to_id=to_id, is_group=is_group, messages=messages,
+                               cursor=cursor, last=last)
+
+    @staticmethod
+    def make_search_result_message(query: str, to_id: int, is_group: bool, messages: list[dict], cursor: int | None):
+        """
+        :param query: 原样返回的查询串
+        :param messages: [{"id", "from", "to", "timestamp", "msg", "msg_type", "is_group"}]，从新到旧
+        :param cursor: 下一页的游标，没有更多结果时为None
+        """
+        return ResponseMessage(ResponseType.SearchResult, 0, query, to_id=to_id, is_group=is_group,
+                               messages=messages, cursor=cursor)
+
+    @staticmethod
+    def make_unread_summary_message(counts: dict[tuple[int, int], int]):
+        """
+        :param counts: {(is_group, conv_id): 未读数}
+        """
+        unread = {"total": sum(counts.values()),
+                  "users": {str(conv_id): n for (is_group, conv_id), n in counts.items() if not is_group},
+                  "groups": {str(conv_id): n for (is_group, conv_id), n in counts.items() if is_group}}
+        return ResponseMessage(ResponseType.UnreadSummary, 0, "", unread=unread)
+
     @staticmethod
     def make_warn_message(msg: str):
-        return ResponseMessage(ResponseType.Server, -1, msg, "")
+        return ResponseMessage(ResponseType.Warn, -1, msg, "")
 
     @staticmethod
     def make_user_info_message(user_id: int, user_info: str):
@@ -116,11 +187,15 @@ class ResponseMessage:
 
     @staticmethod
     def make_hello_message(from_user_id: int, to_id: int, from_user_name: str = '',
-                           is_group: bool = False, msg: str = "Hello"):
-        """此消息会在创建时录入数据库"""
+                           is_group: bool = False, msg: str = "Hello", db: DBOperator = None):
+        """
+        此消息会在创建时录入数据库
+        :param db: 用于录入消息的数据库操作对象，不传入则新建DBOperator
+        """
         response = ResponseMessage(ResponseType.Post, from_user_id, msg, from_user_name, to_id, is_group,
                                    timestamp=dt.now().strftime(df), msg_type="text")
-        db = DBOperator()
+        if db is None:
+            db = DBOperator()
         db.insertMessage(response.from_id, response.to_id, response.timestamp, response.msg, "text", response.is_group)
         return response
 
@@ -144,6 +219,15 @@ class ResponseMessage:
             info['msg_type'] = self.msg_type
         if self.file_op:
             info['file_op'] = self.file_op
+        if self.files is not None:
+            info['files'] = self.files
+        if self.messages is not None:
+            info['messages'] = self.messages
+            info['cursor'] = self.cursor
+        if self.last is not None:
+            info['last'] = self.last
+        if self.unread is not None:
+            info['unread'] = self.unread
 
         return json.dumps(info)
 
@@ -151,10 +235,12 @@ class ResponseMessage:
         return MessageDealer.encode(self.to_json_str())
 
 
-def datetime_str(t: dt = None) -> str:
+def datetime_str(t: dt | str = None) -> str:
     """
-    :param t: 不传入则获取当前服务器时间的字符串，传入则获取传入时间对应的字符串
+    :param t: 不传入则获取当前服务器时间的字符串，传入则获取传入时间对应的字符串(已是字符串则原样返回)
     """
     if t is None:
         t = dt.now()
+    if isinstance(t, str):
+        return t
     return t.strftime(df)
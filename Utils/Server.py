@@ -1,61 +1,177 @@
 import errno
 import logging
+import json
+import os
 import select
+import signal
 import socket
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from queue import Queue
 
 import Utils.Message
 import Utils.config
-from Database.db_operator import DBOperator
+from Database.db_operator import DB_POOL_WAIT, DBOperator
 from Utils.Encrypto import MessageDealer
 from Utils.Message import ResponseMessage, ResponseType, RequestMessage, RequestType, df
-from Utils.apns import APNsClient, make_notification_payload
-from Utils.color_logger import get_logger
-from Utils.cos import cos_operator as cos
+from Utils.admission import DEFER, NORMAL, OVERLOADED, AdmissionController, DeferredWork, WindowedMean
+from Utils.apns import APNsClient, APNsDispatcher
+from Utils.apns_spool import PushSpool
+from Utils.broadcast import Broadcaster
+from Utils.cluster import SNAPSHOT_INTERVAL, Cluster, MessageBus, SocketBus
+from Utils.color_logger import Lazy, configure_logging, get_logger, message_log
+from Utils.dedup import PostDedup, valid_client_msg_id
+from Utils.handoff import HandoffState, confirm, open_listener, read_request, receive_state, send_state
+from Utils.history import (HISTORY_FRAME_MESSAGES, HISTORY_PAGE_DEFAULT, HISTORY_PAGE_MAX, HistoryCache,
+                           conversation_key)
+from Utils.flow_control import DISCONNECT, PUSH_ONLY, SLOW_CONSUMER_POLICIES, Outbox, RateLimiter, parse_rate_limits
+from Utils.metrics import SIZE_BUCKETS, registry, start_http_server
+from Utils.profiling import profiler, tracer
+from Utils.search import SEARCH_PAGE_DEFAULT, SEARCH_PAGE_MAX, SearchIndex, group_scope, user_scope
+from Utils.session import Session, SessionRegistry
+from Utils.startup import Startup
+from Utils.timer_wheel import TimerWheel
+from Utils.unread import UnreadCounters, unread_conversation
+import Utils.cos
 
 logger = get_logger(__name__)
 
-MAX_WORKER = 16
-MAX_QUEUE = 200
+MAX_FILE_BATCH = 200  # 单个批量文件请求最多包含的文件数
+MAX_PENDING_FRAME = 1 << 20  # 尚未收完的单帧最大字节数，超过视为异常客户端
+COS_BUCKET = "betterfly-1251588291"
+SEND_LOCK_STRIPES = 64  # 发送锁按 fileno 分段，不必给每个会话分配一把锁
+RATE_LIMIT_PRUNE_INTERVAL = 60  # 清理已补满令牌桶的间隔(秒)
+
+REQUEST_LATENCY = registry.histogram("betterfly_request_seconds", "Request handling latency by RequestType", ("type",))
+FANOUT_SIZE = registry.histogram("betterfly_fanout_recipients", "Recipients per delivered message",
+                                 buckets=SIZE_BUCKETS)
+BYTES_RECEIVED = registry.counter("betterfly_received_bytes_total", "Bytes received from clients")
+BYTES_SENT = registry.counter("betterfly_sent_bytes_total", "Bytes sent to clients")
+CONNECTIONS = registry.counter("betterfly_connections_total", "Connection events", ("event",))
+REAPED = registry.counter("betterfly_reaped_connections_total", "Connections closed by the timeout reaper",
+                          ("reason",))
+THROTTLED = registry.counter("betterfly_throttled_requests_total", "Requests rejected by the rate limiter", ("type",))
+SLOW_CONSUMERS = registry.counter("betterfly_slow_consumers_total", "Outbound queue overflows by policy",
+                                  ("policy",))
+LOAD_SHED = registry.counter("betterfly_load_shed_total", "Work shed or deferred by admission control",
+                             ("type", "action"))
+REQUEST_TYPE_NAMES = {t.value: t.name for t in RequestType}
 
 
 class EpollChatServer:
-    def __init__(self, config: str):
+    def __init__(self, config: str, db_operator=DBOperator, cos=None, apns: APNsClient = None,
+                 takeover: bool = False, bus: MessageBus = None):
+        """
+        :param config: 配置文件路径
+        :param db_operator: 数据库操作类(或返回同接口实例的工厂)，默认使用MySQL连接池实现的DBOperator
+        :param cos: 对象存储操作对象，默认使用Utils.cos.cos_operator
+        :param apns: APNs推送客户端，默认连接Apple生产环境
+        :param takeover: 从 handoff_path 上运行中的旧进程接管监听 socket 与所有客户端连接(平滑重启)
+        :param bus: 集群节点间消息总线，默认在配置了 cluster_node_id 时按 cluster_listen/cluster_peers 创建 SocketBus
+        """
+        # 记录各启动阶段耗时与就绪状态，外部依赖在 run 开始服务后于后台并行预热
+        self.startup = Startup()
+
+        # 可替换的外部依赖，压测/测试时可以注入本地实现；默认的 COS 客户端在首次使用时才创建
+        self.db_operator = db_operator
+        self.__cos = cos
+
         # 加载配置
         self.config = Utils.config.Config(config)
         self.host = self.config.ip
         self.port = self.config.port
 
         # 设置日志配置
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        configure_logging(self.config.log_level, self.config.log_json_path, self.config.log_sample_rate)
+        self.startup.mark("config")
 
-        # 创建一个 TCP/IP 套接字
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(MAX_QUEUE)
+        # 平滑重启时从旧进程接管监听 socket 与客户端连接；旧进程会先停止推送线程，之后本进程才打开推送暂存区
+        handoff_conn = handoff_state = None
+        self.handed_off = False
+        if takeover:
+            handoff_conn, handoff_state = receive_state(self.config.handoff_path)
+            self.server_socket = handoff_state.listener
+        else:
+            # 创建一个 TCP/IP 套接字
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(self.config.listen_backlog)
         self.server_socket.setblocking(False)
 
         # 创建 epoll 对象
         self.epoll = select.epoll()
         # 将服务器套接字注册到 epoll 中，用于读取新连接
         self.epoll.register(self.server_socket.fileno(), select.EPOLLIN)
+        self.startup.mark("takeover" if takeover else "listen")
+
+        # 集群模式：发给其他节点上用户的消息按节点合并转发，本节点用户上下线时通知其他节点
+        self.cluster = None
+        if bus is None and self.config.cluster_node_id:
+            bus = SocketBus(self.config.cluster_node_id, self.config.cluster_listen, self.config.cluster_peers,
+                            self.config.cluster_queue_max)
+        if bus is not None:
+            self.cluster = Cluster(bus, self.deliver_forwarded, self.deliver_forwarded_all)
+
+        # sessions 按 fileno 与用户id索引所有连接(含未登录的)，一个用户可以同时登录多个设备
+        self.sessions = SessionRegistry(on_presence=self.cluster.on_presence if self.cluster is not None else None)
+
+        # timers 是事件循环线程中的分层时间轮，负责登录超时、心跳超时与空闲超时
+        self.timers = TimerWheel(time.monotonic())
+
+        # 按用户与请求类型的令牌桶限流
+        self.rate_limiter = RateLimiter(parse_rate_limits(self.config.rate_limits, RequestType))
+        self.timers.schedule(time.monotonic() + RATE_LIMIT_PRUNE_INTERVAL, self.prune_rate_limits)
+
+        # 同一会话的发送需要互斥以保证数据顺序；congested 为有发送积压、等待 EPOLLOUT 的会话
+        self.send_locks = [threading.Lock() for _ in range(SEND_LOCK_STRIPES)]
+        self.congested = set()
+        self.check_slow_consumer_policy()
+
+        # 过载保护：按执行器积压、连接池等待与事件循环耗时计算负载等级，过载时丢弃或推迟非关键请求并拒绝新登录
+        self.admission = AdmissionController()
+        self.configure_admission()
+        self.deferred = DeferredWork(self.admission, self.config.deferred_queue_max)
 
-        # 字典来保存客户端信息
-        self.clients = {}  # {UserID: (Username, FileNo, socket)}
-        self.fno_uid = {}  # {FileNo: UserID}
-        self.temp_clients = {}  # 用于临时存储未分配用户ID的连接 {FileNo: socket}
+        # 在线且活跃的用户不再推送，push_stats 统计推送与被省去的推送数
+        # 多个工作线程同时累加，需持锁(无 GIL 时 += 也不是原子的)
+        self.push_stats = {"pushed": 0, "avoided": 0}
+        self.push_stats_lock = threading.Lock()
 
-        # ThreadPoolExecutor 用于异步处理复杂任务
-        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKER)
+        # ThreadPoolExecutor 用于异步处理复杂任务；在线调整线程数时换用新的执行器，旧执行器处理完已提交的任务后退出
+        self.executor = ThreadPoolExecutor(max_workers=self.config.worker_threads)
+        self.retired_executors = []
+        self.configure_db_pool()
 
-        # disconnect_queue 是一个保存需要关闭的fd的队列，保证线程安全
+        # 最近访问的会话缓存最新的若干条消息，本节点写入消息时失效
+        self.history = HistoryCache(self.config.history_cache_conversations, self.config.history_cache_messages,
+                                    self.config.history_cache_ttl)
+
+        # 全文检索索引随文本消息写入增量更新，启动时重放上次未写成段的消息
+        self.search = None
+        if self.config.search_index_path:
+            self.search = SearchIndex(self.config.search_index_path, self.config.search_segment_docs,
+                                      self.config.search_max_segments)
+        self.startup.mark("search")
+
+        # 未读数在内存中增量维护，定期批量写入数据库，用于推送角标与登录时的未读汇总
+        self.unread = UnreadCounters(self.db_operator, self.config.unread_cache_users, self.config.unread_cache_ttl,
+                                     self.config.unread_flush_interval)
+        self.unread.start()
+
+        # 客户端超时重发的 Post 按 client_msg_id 去重，重复的消息不再写库与扇出
+        self.dedup = PostDedup(self.config.post_dedup_window, self.config.post_dedup_per_user,
+                               self.config.post_dedup_users)
+
+        # 全体消息由独立的写线程按会话表分段并行投递，不占用处理请求的工作线程
+        self.broadcaster = Broadcaster(self.deliver, self.on_broadcast_error, self.config.broadcast_writers)
+
+        # disconnect_queue 是一个保存需要关闭的会话的队列 (Session, abnormal)，保证线程安全
         self.disconnect_queue = Queue()
 
-        # initialize_queue 是一个保存需要连接初始化的fd的队列，保证线程安全
+        # initialize_queue 是一个保存需要连接初始化(登录)的会话的队列，保证线程安全
         self.initialize_queue = Queue()
 
         # disconnect_thread 专门处理关闭连接的任务
@@ -65,39 +181,441 @@ class EpollChatServer:
         self.initialize_thread = threading.Thread(target=self.initialize_worker)
         self.initialize_thread.start()
 
-        # apns_send_queue 是一个保存推送请求的队列，保证线程安全
-        self.apns_send_queue = Queue()
-
-        # apns_send_thread 专门处理向Apple APNs推送的任务
-        self.apns_send_thread = threading.Thread(target=self.apns_send_worker)
-        self.apns_send_thread.start()
+        self.startup.mark("workers")
 
         # apns 用于专门处理苹果设备的推送请求
-        self.apns = APNsClient(use_sandbox=False)
+        self.apns = apns if apns is not None else APNsClient(use_sandbox=self.config.apns_sandbox)
+
+        # apns_spool 是有界且持久化的推送暂存区，满时对提交方形成背压，重启后可恢复
+        self.apns_spool = PushSpool(self.config.apns_spool_path, self.config.apns_spool_max)
+
+        # apns_dispatcher 在独立的事件循环中并发发送推送，并合并同一设备的突发推送
+        self.apns_dispatcher = APNsDispatcher(self.apns, self.apns_spool, on_invalid_token=self.on_apns_invalid_token)
+        self.apns_dispatcher.start()
+        self.deferred.start()
+        self.workers_stopped = False
+        self.startup.mark("push")
+
+        if handoff_state is not None:
+            self.restore_sessions(handoff_state)
+        # 监听新进程的接管请求，handoff_path 为空时不开启
+        self.handoff_listener = None
+        if self.config.handoff_path:
+            self.handoff_listener = open_listener(self.config.handoff_path)
+            self.epoll.register(self.handoff_listener.fileno(), select.EPOLLIN)
+        if handoff_conn is not None:
+            confirm(handoff_conn)
+        if self.cluster is not None:
+            self.cluster.start(self.sessions.user_ids)
+            self.timers.schedule(time.monotonic() + SNAPSHOT_INTERVAL, self.send_presence_snapshot)
+        self.startup.mark("sessions")
+
+        # 请求追踪与慢请求日志，未开启时热路径上只有一次 tracer.enabled 判断
+        tracer.configure(self.config.trace_requests, self.config.slow_request_ms)
+        self.reload_requested = False  # 收到 SIGHUP 后由事件循环在两轮事件之间重新加载配置
+        try:
+            # kill -USR2 <pid> 触发一次采样分析
+            signal.signal(signal.SIGUSR2, self.on_profile_signal)
+            # kill -HUP <pid> 重新加载配置文件中可在线修改的配置项
+            signal.signal(signal.SIGHUP, self.on_reload_signal)
+        except ValueError:
+            logger.warning("Not in main thread, SIGUSR2 profiling and SIGHUP reload triggers disabled")
+
+        # 指标HTTP服务，未配置端口时不开启；同时提供 /debug/profile 与 /debug/slow 管理接口
+        self.metrics_server = None
+        self.register_metrics()
+        if self.config.metrics_port is not None:
+            try:
+                self.metrics_server = start_http_server(self.config.metrics_port, self.config.metrics_host, routes={
+                    "/debug/profile": self.handle_profile_request,
+                    "/debug/slow": lambda query: ("application/json", json.dumps(list(tracer.recent_slow))),
+                    "/debug/broadcast": lambda query: ("application/json", json.dumps(self.broadcaster.recent())),
+                    "/debug/admission": lambda query: ("application/json", json.dumps(
+                        dict(self.admission.state(), deferred=len(self.deferred), deferred_dropped=self.deferred.dropped))),
+                    "/debug/startup": lambda query: ("application/json", json.dumps(self.startup.to_dict())),
+                    # 全部预热完成前返回 503，供负载均衡与部署脚本判断是否就绪
+                    "/ready": lambda query: ("text/plain", self.startup.state, 200 if self.startup.ready else 503),
+                })
+            except OSError as e:
+                logger.error(f"Failed to start metrics endpoint: {e}")
+        self.startup.mark("metrics")
+        self.startup.log_phases()
+
+    @property
+    def cos(self):
+        """对象存储操作对象，未注入时首次访问才读取 cos_config.json 创建默认客户端"""
+        if self.__cos is None:
+            self.__cos = Utils.cos.cos_operator
+        return self.__cos
+
+    def warm_up(self):
+        """
+        在后台并行预热数据库连接池、COS 客户端与 APNs 密钥，不阻塞事件循环；
+        进度与失败重试见日志与 /debug/startup，全部完成后 /ready 返回 200
+        """
+        def warm_db():
+            warm = getattr(self.db_operator, "warm_up", None)
+            if warm is not None:
+                warm()
+            else:
+                self.db_operator().close()
+
+        self.startup.warm_up({"database": warm_db, "cos": lambda: self.cos, "apns": self.apns.warm_up})
+
+    def on_profile_signal(self, signum, frame):
+        if profiler.dump_async(self.config.profile_seconds, self.config.profile_dir):
+            logger.info(f"Profiling all threads for {self.config.profile_seconds}s")
+        else:
+            logger.warning("Profiler is already running")
+
+    def on_reload_signal(self, signum, frame):
+        # 信号处理函数可能在事件循环的任意两条字节码之间执行(例如提交读取任务的中途)，这里只做标记，
+        # 由事件循环在处理完一轮事件后调用 handle_reload
+        self.reload_requested = True
+
+    def handle_reload(self):
+        self.reload_requested = False
+        try:
+            self.reload_config()
+        except Exception as e:
+            logger.error(f"Failed to reload configuration: {e}", exc_info=True)
+
+    def reload_config(self):
+        """重新读取配置文件并应用可在线修改的配置项，其余配置项(超时、积压上限等)在使用时读取，更新后即生效"""
+        changed, ignored = self.config.reload()
+        for key in ignored:
+            logger.warning(f"Configuration {key} changed but only takes effect after a restart")
+        if not changed:
+            logger.info("Configuration reloaded, nothing changed")
+            return
+        logger.info("Configuration reloaded: " + ", ".join(f"{k}={new!r}" for k, (_, new) in changed.items()))
+        if changed.keys() & {'log_level', 'log_json_path', 'log_sample_rate'}:
+            configure_logging(self.config.log_level, self.config.log_json_path, self.config.log_sample_rate)
+        if changed.keys() & {'trace_requests', 'slow_request_ms'}:
+            tracer.configure(self.config.trace_requests, self.config.slow_request_ms)
+        if 'rate_limits' in changed:
+            self.rate_limiter.set_limits(parse_rate_limits(self.config.rate_limits, RequestType))
+        if 'slow_consumer_policy' in changed:
+            self.check_slow_consumer_policy()
+        if 'worker_threads' in changed:
+            old = self.executor
+            self.executor = ThreadPoolExecutor(max_workers=self.config.worker_threads)
+            self.retired_executors.append(old)
+            old.shutdown(wait=False)
+        if 'broadcast_writers' in changed:
+            self.broadcaster.resize(self.config.broadcast_writers)
+        if changed.keys() & {'db_pool_size', 'db_pool_min_cached'}:
+            self.configure_db_pool()
+        if any(key.startswith('history_cache_') for key in changed):
+            self.history.configure(self.config.history_cache_conversations, self.config.history_cache_messages,
+                                   self.config.history_cache_ttl)
+        self.unread.capacity = self.config.unread_cache_users
+        self.dedup.window = self.config.post_dedup_window
+        self.dedup.per_user = self.config.post_dedup_per_user
+        self.dedup.users = self.config.post_dedup_users
+        self.unread.ttl = self.config.unread_cache_ttl
+        self.unread.flush_interval = self.config.unread_flush_interval
+        if self.search is not None:
+            self.search.segment_docs = self.config.search_segment_docs
+            self.search.max_segments = self.config.search_max_segments
+        if 'deferred_queue_max' in changed:
+            self.deferred.max_size = self.config.deferred_queue_max
+        if any(key.startswith('admission_') for key in changed):
+            self.configure_admission()
+
+    def configure_admission(self):
+        """按配置设置过载保护的阈值与降级时丢弃、推迟的请求类型"""
+        self.admission.cooldown = self.config.admission_cooldown
+        self.admission.shed_types = frozenset(self.parse_request_types(self.config.admission_shed_types))
+        self.admission.defer_types = frozenset(
+            self.parse_request_types(self.config.admission_defer_types) & set(self.deferrable_handlers()))
+        self.admission.add_signal("executor_backlog", lambda: self.executor._work_queue.qsize(),
+                                  *self.config.admission_backlog)
+        self.admission.add_signal("db_pool_wait", WindowedMean(DB_POOL_WAIT),
+                                  *(v / 1000 for v in self.config.admission_db_wait_ms))
+        self.admission.add_signal("loop_lag", lambda: self.admission.loop_lag,
+                                  *(v / 1000 for v in self.config.admission_loop_lag_ms))
+
+    def configure_db_pool(self):
+        """按配置设置数据库连接池大小(注入的数据库实现不支持时忽略)"""
+        configure_pool = getattr(self.db_operator, "configure_pool", None)
+        if configure_pool is not None:
+            configure_pool(self.config.db_pool_size, self.config.db_pool_min_cached)
+
+    def check_slow_consumer_policy(self):
+        if self.config.slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            logger.warning(f"Unknown slow_consumer_policy {self.config.slow_consumer_policy!r}, using {PUSH_ONLY}")
+            self.config.slow_consumer_policy = PUSH_ONLY
+
+    @staticmethod
+    def handle_profile_request(query: dict):
+        """GET /debug/profile?seconds=N，采样结束后返回 collapsed stack 文本"""
+        counts = profiler.sample(float(query.get("seconds", ["10"])[0]))
+        if counts is None:
+            return "text/plain; charset=utf-8", "profiler is already running\n"
+        return "text/plain; charset=utf-8", profiler.collapsed(counts)
+
+    def register_metrics(self):
+        """注册抓取时才读取的服务器状态指标"""
+        registry.gauge("betterfly_clients", "Connected clients", lambda: {
+            ("logged_in",): len(self.sessions) - self.sessions.pending_count,
+            ("pending_login",): self.sessions.pending_count,
+            ("users",): self.sessions.user_count}, ("state",))
+        registry.gauge("betterfly_queue_size", "Internal queue backlog", lambda: {
+            ("disconnect",): self.disconnect_queue.qsize(),
+            ("initialize",): self.initialize_queue.qsize(),
+            ("executor",): self.executor._work_queue.qsize(),
+            ("apns_pending",): self.apns_dispatcher.stats()["pending"],
+            ("apns_spool",): len(self.apns_spool)}, ("queue",))
+        registry.gauge("betterfly_db_pool_connections", "Database pool connections",
+                       lambda: {(k,): v for k, v in self.db_operator.pool_stats().items()}, ("state",))
+        registry.gauge("betterfly_apns_dispatcher", "APNs dispatcher counters",
+                       lambda: {(k,): v for k, v in self.apns_dispatcher.stats().items()}, ("stat",))
+        registry.gauge("betterfly_connection_timers", "Pending connection timeout timers", lambda: len(self.timers))
+        registry.gauge("betterfly_outbound_backlog", "Sessions with unsent data and their queued bytes", lambda: {
+            ("sessions",): len(self.congested),
+            ("bytes",): sum(s.outbox.size for s in list(self.congested) if s.outbox is not None)}, ("stat",))
+        registry.gauge("betterfly_rate_limit_buckets", "Active rate limiter buckets", lambda: len(self.rate_limiter))
+        registry.gauge("betterfly_load_level", "Admission control level (0 normal, 1 shedding, 2 overloaded)",
+                       lambda: self.admission.level)
+        registry.gauge("betterfly_load_signal", "Latest admission control signal values",
+                       lambda: {(k,): v for k, v in self.admission.signal_values().items()}, ("signal",))
+        registry.gauge("betterfly_deferred_work", "Deferred work queue", lambda: {
+            ("queued",): len(self.deferred), ("dropped",): self.deferred.dropped}, ("stat",))
+        if self.cluster is not None:
+            registry.gauge("betterfly_cluster_presence", "Online users known per cluster node",
+                           lambda: {(k,): v for k, v in self.cluster.presence.node_counts().items()}, ("node",))
+            if isinstance(self.cluster.bus, SocketBus):
+                registry.gauge("betterfly_cluster_queue", "Bus messages waiting to be sent per peer",
+                               lambda: {(k,): v for k, v in self.cluster.bus.queued().items()}, ("node",))
+        registry.gauge("betterfly_history_cache_conversations", "Conversations in the history page cache",
+                       lambda: len(self.history))
+        registry.gauge("betterfly_post_dedup_entries", "Users and client message ids in the Post dedup window",
+                       lambda: {(k,): v for k, v in self.dedup.stats().items() if k in ("users", "ids")}, ("kind",))
+        registry.gauge("betterfly_unread_counters", "In-memory unread counter state",
+                       lambda: {(k,): v for k, v in self.unread.stats().items()}, ("stat",))
+        if self.search is not None:
+            registry.gauge("betterfly_search_index", "Full-text search index state",
+                           lambda: {(k,): v for k, v in self.search.stats().items()}, ("stat",))
+        registry.gauge("betterfly_broadcasts_in_progress", "Broadcasts still being written",
+                       lambda: self.broadcaster.active())
+        registry.gauge("betterfly_ready", "1 when all dependencies are warmed up", lambda: int(self.startup.ready))
+        registry.gauge("betterfly_startup_phase_seconds", "Time spent in each startup phase",
+                       lambda: {(k,): v for k, v in self.startup.phases.items()}, ("phase",))
+        registry.gauge("betterfly_push_decisions", "Pushes sent or avoided for active recipients",
+                       lambda: {(k,): v for k, v in self.push_stats.items()}, ("decision",))
+
+    @staticmethod
+    def parse_request_types(names: list) -> set:
+        types = set()
+        for name in names or ():
+            try:
+                types.add(RequestType[name].value)
+            except KeyError:
+                logger.warning(f"Ignoring unknown request type {name!r} in admission config")
+        return types
+
+    def deferrable_handlers(self) -> dict:
+        """:return: 可以推迟处理的请求类型及其处理函数(只依赖请求内容，不需要回复发起方)"""
+        return {RequestType.UpdateAvatar.value: self.process_update_avatar,
+                RequestType.APNsToken.value: self.process_user_apns_token}
+
+    def send_bytes(self, sock: socket.socket, data: bytes):
+        """向客户端发送数据并计入发送字节数"""
+        sent = sock.send(data)
+        BYTES_SENT.inc(amount=sent)
+        return sent
+
+    def send_buffers(self, sock: socket.socket, buffers: list):
+        """用一次 sendmsg 发送多个数据块并计入发送字节数"""
+        sent = sock.sendmsg(buffers)
+        BYTES_SENT.inc(amount=sent)
+        return sent
+
+    def traced_send(self, session: Session, message: ResponseMessage | RequestMessage) -> bool:
+        """与 deliver 相同，同时把编码与发送耗时记录到当前请求的追踪中"""
+        start = time.perf_counter()
+        data = message.to_json_encoded_bytes()
+        encoded = time.perf_counter()
+        delivered = self.deliver(session, data)
+        tracer.span("encode", start, encoded)
+        tracer.span("send", encoded, time.perf_counter())
+        return delivered
+
+    def deliver(self, session: Session, data: bytes) -> bool:
+        """
+        向一个会话发送数据。内核发送缓冲区满时剩余部分放入会话的 outbox，由事件循环在 socket 可写时继续发送；
+        积压超过 outbound_queue_max 时按 slow_consumer_policy 处理
+        :return: 数据已发送或已排队返回True，被丢弃返回False
+        """
+        with self.send_locks[session.fileno % SEND_LOCK_STRIPES]:
+            outbox = session.outbox
+            if outbox is None:
+                self._send_or_queue(session, data)
+                return True
+            if outbox.degraded:
+                return False
+            if outbox.size + len(data) > self.config.outbound_queue_max:
+                self.on_slow_consumer(session)
+                return False
+            outbox.append(data)
+            return True
+
+    def _send_or_queue(self, session: Session, data: bytes):
+        """调用方需持有该会话的发送锁，且会话当前没有积压"""
+        try:
+            sent = self.send_bytes(session.sock, data)
+        except BlockingIOError:
+            sent = 0
+        if sent < len(data):
+            # 已发出一部分的消息必须完整排队，否则会破坏分帧
+            outbox = Outbox()
+            outbox.append(memoryview(data)[sent:])
+            session.outbox = outbox
+            try:
+                self.rearm(session)
+            except OSError:
+                session.outbox = None
+                raise
+            self.congested.add(session)
+
+    def on_slow_consumer(self, session: Session):
+        """发送积压已满，调用方需持有该会话的发送锁"""
+        policy = self.config.slow_consumer_policy
+        SLOW_CONSUMERS.inc(policy)
+        session.outbox.degraded = True  # 积压发完之前不再接受新消息
+        if policy == DISCONNECT:
+            logger.warning(f"Disconnecting slow consumer user {session.user_id} with fileno {session.fileno}")
+            self.disconnect_queue.put((session, True))
+        else:
+            logger.warning(f"Outbound queue of user {session.user_id} with fileno {session.fileno} is full, "
+                           f"pausing delivery ({policy})")
+
+    def flush_outbox(self, session: Session):
+        """事件循环在 socket 可写(EPOLLOUT)时继续发送积压的数据"""
+        with self.send_locks[session.fileno % SEND_LOCK_STRIPES]:
+            outbox = session.outbox
+            if outbox is None or self.sessions.get(session.fileno) is not session:
+                return
+            try:
+                if not outbox.flush(lambda buffers: self.send_buffers(session.sock, buffers)):
+                    return
+            except OSError as e:
+                logger.debug("Failed to flush outbox of fileno %s: %s", session.fileno, e)
+                self.disconnect_queue.put((session, True))
+                return
+            session.outbox = None
+            self.congested.discard(session)
+            try:
+                self.rearm(session)
+            except OSError:
+                return
+            if outbox.degraded and self.config.slow_consumer_policy != DISCONNECT:
+                logger.info(f"Resumed delivery to user {session.user_id} with fileno {session.fileno}")
+                self._send_or_queue(session, ResponseMessage.make_warn_message(
+                    "部分消息未能实时送达，请重新同步").to_json_encoded_bytes())
+
+    def rearm(self, session: Session):
+        """
+        按会话状态更新 epoll 关注的事件：已提交读取任务时暂不关注可读，有发送积压时关注可写。
+        调用方需持有该会话的发送锁
+        """
+        events = (0 if session.reading else select.EPOLLIN) | (select.EPOLLOUT if session.outbox is not None else 0)
+        self.epoll.modify(session.fileno, events)
+
+    def begin_read(self, session: Session) -> bool:
+        """
+        事件循环提交读取任务前调用，任务完成前不再为该连接提交新的读取任务(epoll 为水平触发)
+        :return: 已有读取任务在处理时返回False
+        """
+        with self.send_locks[session.fileno % SEND_LOCK_STRIPES]:
+            if session.reading:
+                return False
+            session.reading = True
+            try:
+                self.rearm(session)
+            except OSError:  # 连接已关闭
+                session.reading = False
+                return False
+            return True
+
+    def finish_read(self, session: Session):
+        """读取任务结束，恢复关注可读事件"""
+        with self.send_locks[session.fileno % SEND_LOCK_STRIPES]:
+            session.reading = False
+            if self.sessions.get(session.fileno) is session:
+                try:
+                    self.rearm(session)
+                except OSError:
+                    pass
+
+    def prune_rate_limits(self):
+        """时间轮回调：清理已补满的令牌桶并续期"""
+        now = time.monotonic()
+        self.rate_limiter.prune(now)
+        self.timers.schedule(now + RATE_LIMIT_PRUNE_INTERVAL, self.prune_rate_limits)
+
+    def send_presence_snapshot(self):
+        """定期向其他节点发送本节点在线用户全量快照，修正丢失或乱序的上下线消息"""
+        self.cluster.send_snapshot()
+        self.timers.schedule(time.monotonic() + SNAPSHOT_INTERVAL, self.send_presence_snapshot)
 
     def run(self):
         try:
+            self.warm_up()
             logger.info('Server started successfully')
             while True:
                 try:
                     # 等待事件发生
                     events = self.epoll.poll(timeout=1)
+                    polled_at = time.monotonic()
                     for fileno, event in events:
                         # 新的客户端连接
                         if fileno == self.server_socket.fileno():
                             self.accept_client()
+                            continue
+                        # 新进程请求接管，无论成功与否工作线程都已停止，由 finally 中的 shutdown 收尾
+                        if self.handoff_listener is not None and fileno == self.handoff_listener.fileno():
+                            if self.accept_handoff():
+                                return
+                            continue
+                        # 有发送积压的连接变为可写
+                        if event & select.EPOLLOUT:
+                            session = self.sessions.get(fileno)
+                            if session is not None:
+                                self.flush_outbox(session)
                         # 客户端发来消息
-                        elif event & select.EPOLLIN:
-                            if fileno in self.fno_uid:  # 已初始化用户发来的消息
-                                self.executor.submit(self.receive_data, fileno)
-                            elif fileno in self.temp_clients:  # 未初始化用户发来的消息
-                                self.initialize_queue.put(fileno)
-                            else:
-                                logger.warning(f"Received event for unknown fileno {fileno}, ignoring.")
-                                self.epoll.unregister(fileno)
+                        if event & select.EPOLLIN:
+                            session = self.sessions.get(fileno)
+                            if session is None:
+                                # 同一批事件中的连接可能刚被关闭，close 已自动将其移出 epoll
+                                logger.debug("Received event for unknown fileno %s, ignoring.", fileno)
+                                try:
+                                    self.epoll.unregister(fileno)
+                                except OSError:
+                                    pass
+                            elif not self.begin_read(session):  # 已提交的读取任务尚未完成
+                                pass
+                            elif session.authenticated:  # 已初始化用户发来的消息
+                                try:
+                                    self.executor.submit(self.receive_data, session,
+                                                         time.perf_counter() if tracer.enabled else None)
+                                except RuntimeError:  # 执行器正在关闭，恢复关注可读事件，下一轮再提交
+                                    self.finish_read(session)
+                            else:  # 未初始化用户发来的消息
+                                self.initialize_queue.put(session)
                         # 错误事件
                         elif event & (select.EPOLLHUP | select.EPOLLERR):
-                            self.disconnect_queue.put((fileno, True))
+                            session = self.sessions.get(fileno)
+                            if session is not None:
+                                self.disconnect_queue.put((session, True))
+                    now = time.monotonic()
+                    self.timers.advance(now)
+                    if self.reload_requested:
+                        self.handle_reload()
+                    if events:
+                        self.admission.record_loop(now - polled_at)
+                    self.admission.update(now)
                 except Exception as e:
                     logger.error(f"Error in event loop: {e}", exc_info=True)
         except Exception as e:
@@ -105,52 +623,155 @@ class EpollChatServer:
         finally:
             self.shutdown()
 
+    def accept_handoff(self) -> bool:
+        """
+        旧进程：把监听 socket 与所有连接交给发起接管的新进程
+        :return: 没有待处理的接管请求时返回False
+        """
+        try:
+            conn, _ = self.handoff_listener.accept()
+        except BlockingIOError:
+            return False
+        try:
+            if not read_request(conn):
+                conn.close()
+                return False
+        except Exception as e:
+            logger.warning(f"Ignored handoff connection: {e}")
+            conn.close()
+            return False
+        logger.warning("A new process requested takeover, handing off all connections")
+        conn.setblocking(True)
+        # 不再接受新连接，处理完已提交的任务后停止所有工作线程，推送暂存区随之落盘
+        self.epoll.unregister(self.server_socket.fileno())
+        self.epoll.unregister(self.handoff_listener.fileno())
+        self.handoff_listener.close()
+        self.stop_workers()
+        if self.metrics_server is not None:  # 让新进程可以使用同一端口
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        sessions = self.sessions.all()
+        try:
+            send_state(conn, self.server_socket, sessions)
+            self.handed_off = True
+            logger.info(f"Handed off {len(sessions)} connections to the new process")
+        except Exception as e:
+            logger.error(f"Handoff failed, closing all connections instead: {e}", exc_info=True)
+        finally:
+            conn.close()
+        return True
+
+    def restore_sessions(self, state: HandoffState):
+        """新进程：恢复从旧进程接管的连接"""
+        for handed in state.sessions:
+            sock = handed.sock
+            sock.setblocking(False)
+            meta = handed.meta
+            session = self.sessions.add(sock.fileno(), sock)
+            session.connected_at = meta["connected_at"]
+            session.last_seen = meta["last_seen"]
+            session.last_active = meta["last_active"]
+            if meta["user_id"] is not None:
+                self.sessions.authenticate(session, meta["user_id"], meta["user_name"])
+            session.inbuf = handed.inbuf
+            if handed.outbox:
+                session.outbox = Outbox()
+                for chunk in handed.outbox:
+                    session.outbox.append(chunk)
+                self.congested.add(session)
+            self.epoll.register(session.fileno, select.EPOLLIN | (select.EPOLLOUT if session.outbox else 0))
+            if session.authenticated:
+                deadline = session.last_seen + self.config.heartbeat_timeout
+            else:
+                deadline = session.connected_at + self.config.login_timeout
+            self.timers.schedule(deadline, self.check_connection, session)
+        CONNECTIONS.inc("taken_over", amount=len(state.sessions))
+        logger.info(f"Took over {len(state.sessions)} connections "
+                    f"({len(self.sessions) - self.sessions.pending_count} logged in) from the previous process")
+
     def close_worker(self):
         while True:
-            fileno, abnormal = self.disconnect_queue.get()
-            if fileno is None:
+            session, abnormal = self.disconnect_queue.get()
+            if session is None:
                 break
-            self.close_client(fileno, abnormal)
+            self.close_client(session, abnormal)
 
     def initialize_worker(self):
         while True:
-            fileno = self.initialize_queue.get()
-            if fileno is None:
+            session = self.initialize_queue.get()
+            if session is None:
                 break
-            self.initialize_client(fileno)
+            self.initialize_client(session)
 
-    def apns_send_worker(self):
-        # 需要的消息：(apn_token, user_name, user_msg, user_id)
-        while True:
-            apns_token, user_name, user_msg, user_id = self.apns_send_queue.get()
-            if apns_token is None:
-                break
-            result = self.apns.send_notification(apns_token, make_notification_payload(user_name, user_msg))
-            if not result:  # 发送异常，删除APNs Token
-                db = DBOperator()
-                db.deleteUserAPNsToken(user_id, apns_token)
+    def on_apns_invalid_token(self, user_id: int, apns_token: str):
+        """Apple 告知设备Token已失效(Unregistered/BadDeviceToken)，删除APNs Token"""
+        db = self.db_operator()
+        db.deleteUserAPNsToken(user_id, apns_token)
+
+    def check_connection(self, session: Session):
+        """
+        时间轮回调(事件循环线程)：关闭超时的连接，否则按最近活动时间续期。
+        收到数据时只更新 session.last_seen/last_active，不需要操作时间轮
+        """
+        if self.sessions.get(session.fileno) is not session:  # 连接已关闭，fileno 可能已被复用
+            return
+        if not session.authenticated:
+            self.reap_connection(session, "unauthenticated", False)
+            return
+        now = time.monotonic()
+        deadline = session.last_seen + self.config.heartbeat_timeout
+        if deadline <= now:
+            # 连接可能已半开，不再尝试发送告别消息
+            self.reap_connection(session, "unresponsive", True)
+            return
+        if self.config.idle_timeout is not None:
+            idle_deadline = session.last_active + self.config.idle_timeout
+            if idle_deadline <= now:
+                self.reap_connection(session, "idle", False)
+                return
+            deadline = min(deadline, idle_deadline)
+        self.timers.schedule(deadline, self.check_connection, session)
+
+    def reap_connection(self, session: Session, reason: str, abnormal: bool):
+        logger.info(f"Reaping {reason} connection with fileno {session.fileno}")
+        REAPED.inc(reason)
+        self.disconnect_queue.put((session, abnormal))
 
     def accept_client(self):
         try:
             client_socket, client_address = self.server_socket.accept()
+            if len(self.sessions) >= self.config.max_connections:
+                # 连接数已达上限，立即关闭，避免耗尽描述符后连监听 socket 都无法 accept
+                client_socket.close()
+                CONNECTIONS.inc("rejected")
+                logger.debug("Rejected connection from %s: max_connections (%s) reached",
+                             client_address, self.config.max_connections)
+                return
             client_socket.setblocking(False)
             # 将新的客户端 socket 注册bgnhjm到 epoll 中用于读取数据
             self.epoll.register(client_socket.fileno(), select.EPOLLIN)
-            # 暂时将套接字存储起来，等待分配用户ID
-            self.temp_clients[client_socket.fileno()] = client_socket
+            # 登记为未登录的会话，等待分配用户ID
+            session = self.sessions.add(client_socket.fileno(), client_socket)
+            CONNECTIONS.inc("accepted")
+            # 超时检查时再根据连接当前状态决定是关闭还是续期
+            self.timers.schedule(session.connected_at + self.config.login_timeout, self.check_connection, session)
             logger.info(f"New connection from {client_address}")
         except Exception as e:
             logger.error(f"Error accepting new client: {e}", exc_info=True)
 
-    def initialize_client(self, fileno):
+    def initialize_client(self, session: Session):
+        fileno = session.fileno
+        client_socket = session.sock
         try:
-            client_socket = self.temp_clients.get(fileno)
-            if client_socket is not None:
-                all_dt = client_socket.recv(40960)
+            if self.sessions.get(fileno) is session and not session.authenticated:
+                all_dt = client_socket.recv(self.config.recv_buffer_size)
                 if all_dt:
+                    BYTES_RECEIVED.inc(amount=len(all_dt))
                     datum = MessageDealer.decode(all_dt)
                     has_correct_login_packet = False
                     for data in datum:
+                        start = time.perf_counter()
                         # 解析登录包
                         login_packet = Utils.Message.RequestMessage(data)
                         if login_packet.type == RequestType.Login:
@@ -158,161 +779,260 @@ class EpollChatServer:
                             user_id = login_packet.from_id
                             user_name = login_packet.name
                             last_login = login_packet.timestamp
+                            if user_id and self.admission.level >= OVERLOADED:
+                                # 过载时拒绝新登录，客户端稍后重连
+                                LOAD_SHED.inc("Login", "refused")
+                                logger.info(f"Refusing login of user {user_id} during overload")
+                                self.deliver(session, ResponseMessage.make_warn_message(
+                                    "服务器繁忙，请稍后重新连接").to_json_encoded_bytes())
+                                self.deliver(session, ResponseMessage.make_refused_message("").to_json_encoded_bytes())
+                                self.disconnect_queue.put((session, False))
+                                return
                             if user_id:
-                                self.clients[user_id] = (user_name, fileno, client_socket)
-                                self.fno_uid[fileno] = user_id
-                                self.temp_clients.pop(fileno)  # 从临时存储中删除
+                                session.last_active = session.last_seen = time.monotonic()
+                                if not self.sessions.authenticate(session, user_id, user_name):
+                                    return
                                 logger.info(f"User {user_id} - {user_name} connected with fileno {fileno}")
-                                client_socket.send(ResponseMessage.make_server_message(
+                                self.deliver(session, ResponseMessage.make_server_message(
                                     f"Welcome to Betterfly, {user_name}!").to_json_encoded_bytes())
-                                db = DBOperator()
+                                db = self.db_operator()
                                 db.login(user_id, user_name, last_login)
-                                self.sync_message(user_id, last_login)
+                                self.sync_message(user_id, last_login, session)
+                                self.deliver(session, ResponseMessage.make_unread_summary_message(
+                                    self.unread.summary(user_id, db, refresh=True)).to_json_encoded_bytes())
+                                REQUEST_LATENCY.observe(time.perf_counter() - start, "Login")
                             else:
                                 logger.warning(f"Received empty user ID from fileno {fileno}")
-                                self.disconnect_queue.put((fileno, False))
+                                self.disconnect_queue.put((session, False))
                     if not has_correct_login_packet:  # 未初始化用户发送非登录包，直接关闭连接
                         logger.warning(f"Received invalid request from fileno {fileno}")
-                        self.disconnect_queue.put((fileno, False))
+                        self.disconnect_queue.put((session, False))
                 else:
                     # 客户端已断开连接
-                    self.disconnect_queue.put((fileno, True))
+                    self.disconnect_queue.put((session, True))
         except socket.error as e:
             if e.errno != errno.EAGAIN:
                 logger.error(f"Socket error while initializing client for fileno {fileno}: {e}", exc_info=True)
-                self.disconnect_queue.put((fileno, True))
+                self.disconnect_queue.put((session, True))
         except Exception as e:
             logger.error(f"Error initializing client: {e}", exc_info=True)
-            self.disconnect_queue.put((fileno, False))
-            self.temp_clients.pop(fileno, None)  # 如果存在则从临时存储中删除
-
-    def receive_data(self, fileno):
-        client_socket = None
-        user_id = self.fno_uid.get(fileno)
-        if user_id is not None:
-            client_socket = self.clients.get(user_id)[2]
+            self.disconnect_queue.put((session, False))
+        finally:
+            self.finish_read(session)
 
-        if client_socket is None:
-            logger.error(f"Client socket for fileno {fileno} not found")
+    def receive_data(self, session: Session, queued_at: float = None):
+        """
+        :param queued_at: 事件循环提交该任务的时间，仅在开启请求追踪时传入
+        """
+        fileno = session.fileno
+        user_id = session.user_id
+        client_socket = session.sock
+        if self.sessions.get(fileno) is not session:
+            logger.debug("Session for fileno %s already closed", fileno)
+            session.reading = False
             return
 
         try:
-            all_dt = client_socket.recv(40960)
+            all_dt = client_socket.recv(self.config.recv_buffer_size)
             if all_dt:
-                datum = MessageDealer.decode(all_dt)
+                BYTES_RECEIVED.inc(amount=len(all_dt))
+                seen_at = session.last_seen = time.monotonic()
+                # 帧可能跨多次 recv，末尾的半包留到下次与新数据拼接
+                complete, session.inbuf = MessageDealer.split_frames(
+                    session.inbuf + all_dt if session.inbuf else all_dt)
+                if len(session.inbuf) > MAX_PENDING_FRAME:
+                    logger.warning(f"Frame from user {user_id} exceeds {MAX_PENDING_FRAME} bytes, disconnecting")
+                    self.disconnect_queue.put((session, False))
+                    return
+                datum = MessageDealer.decode(complete) if complete else []
                 for data in datum:
-                    logger.info(f"Received data from user {user_id}: {data}")
+                    start = time.perf_counter()
+                    trace = tracer.begin("Unknown", user_id, queued_at) if tracer.enabled else None
+                    logger.debug("Received data from user %s: %s", user_id, data)
+                    message_log.record("recv", user_id=user_id, size=len(data))
                     task = Utils.Message.RequestMessage(data)
-                    if task.type == RequestType.Exit:  # 执行退出操作
-                        self.disconnect_queue.put((fileno, False))
-                    elif task.type == RequestType.Post:  # 正常发消息
-                        now = dt.now().strftime(df)
-                        task.packet_json["timestamp"] = now  # 重新授时
-                        task.timestamp = now
-                        to_id = task.to_id
-                        is_group = task.is_group
-                        db = DBOperator()
-                        db.insertMessage(task.from_id, task.to_id, task.timestamp, task.msg, task.msg_type,
-                                         task.is_group)
-
-                        if is_group:
-                            self.send_message(to_id, task, is_group=True, send_apns_push=True)
+                    if task.type != RequestType.Ping:  # 心跳只刷新 last_seen
+                        session.last_active = seen_at
+                    allowed, warn = self.rate_limiter.allow(user_id, task.type, seen_at)
+                    if not allowed:
+                        # 被限流的请求直接丢弃，并定期提示客户端
+                        THROTTLED.inc(REQUEST_TYPE_NAMES.get(task.type, "Unknown"))
+                        if warn:
+                            logger.info(f"Throttling {REQUEST_TYPE_NAMES.get(task.type)} requests from user {user_id}")
+                            self.deliver(session, ResponseMessage.make_warn_message(
+                                f"请求过于频繁，{REQUEST_TYPE_NAMES.get(task.type)} 请求已被限流").to_json_encoded_bytes())
+                        if trace is not None:
+                            tracer.finish(trace, "Throttled")
+                        continue
+                    action = self.admission.action_for(task.type)
+                    if action is not None:
+                        # 过载时丢弃或推迟非关键请求，优先处理消息投递
+                        type_name = REQUEST_TYPE_NAMES.get(task.type, "Unknown")
+                        if action == DEFER and self.deferred.submit(self.deferrable_handlers()[task.type], task):
+                            LOAD_SHED.inc(type_name, "deferred")
                         else:
-                            self.send_message(user_id, task)  # 重授时后直接回显消息
-                            if to_id != user_id:
-                                self.send_message(to_id, task, send_apns_push=True)
+                            LOAD_SHED.inc(type_name, "shed")
+                            self.deliver(session, ResponseMessage.make_warn_message(
+                                f"服务器繁忙，{type_name} 请求未处理，请稍后重试").to_json_encoded_bytes())
+                        if trace is not None:
+                            tracer.finish(trace, "Shed")
+                        continue
+                    if task.type == RequestType.Ping:  # 心跳
+                        self.deliver(session, ResponseMessage.make_pong_message(
+                            task.packet_json.get("timestamp")).to_json_encoded_bytes())
+                    elif task.type == RequestType.Exit:  # 执行退出操作
+                        self.disconnect_queue.put((session, False))
+                    elif task.type == RequestType.Post:  # 正常发消息
+                        self.process_post(user_id, task, session)
                     elif task.type == RequestType.QueryUser:  # 从数据库请求用户信息
-                        self.process_query_user(user_id, task)
+                        self.process_query_user(user_id, task, session)
                     elif task.type == RequestType.InsertContact:  # 增加联系人
                         self.process_insert_contact(task)
                     elif task.type == RequestType.QueryGroup:  # 从数据库请求群组信息
-                        self.process_query_group(task)
+                        self.process_query_group(task, session)
                     elif task.type == RequestType.InsertGroup:  # 增加群组
                         self.process_insert_group(task)
                     elif task.type == RequestType.InsertGroupUser:  # 加入群组
                         self.process_insert_group_user(task)
                     elif task.type == RequestType.File:
-                        self.process_file_operation(task)
+                        self.process_file_operation(task, session)
+                    elif task.type == RequestType.FileBatch:  # 批量获取文件链接
+                        self.process_file_batch(user_id, task, session)
                     elif task.type == RequestType.APNsToken:
                         self.process_user_apns_token(task)
                     elif task.type == RequestType.UpdateAvatar:  # 更新用户头像/群头像
                         self.process_update_avatar(task)
+                    elif task.type == RequestType.History:  # 分页查询历史消息
+                        self.process_history(user_id, task, session)
+                    elif task.type == RequestType.Search:  # 全文搜索消息
+                        self.process_search(user_id, task, session)
+                    elif task.type == RequestType.ReadAck:  # 已读回执
+                        self.process_read_ack(user_id, task, session)
+                    REQUEST_LATENCY.observe(time.perf_counter() - start, REQUEST_TYPE_NAMES.get(task.type, "Unknown"))
+                    if trace is not None:
+                        tracer.finish(trace, REQUEST_TYPE_NAMES.get(task.type, "Unknown"))
 
             else:
                 # 客户端已断开连接
-                self.disconnect_queue.put((fileno, True))
+                self.disconnect_queue.put((session, True))
         except socket.error as e:
-            if e.errno != errno.EAGAIN:
+            if self.sessions.get(fileno) is not session:  # 处理期间连接已被其他线程关闭
+                logger.debug("Session for fileno %s closed while receiving: %s", fileno, e)
+            elif e.errno in (errno.ECONNRESET, errno.EPIPE):
+                logger.info(f"Connection reset by user {user_id} with fileno {fileno}")
+                self.disconnect_queue.put((session, True))
+            elif e.errno != errno.EAGAIN:
                 logger.error(f"Socket error while receiving data from fileno {fileno}: {e}", exc_info=True)
-                self.disconnect_queue.put((fileno, True))
+                self.disconnect_queue.put((session, True))
         except Exception as e:
             logger.error(f"Error receiving data from client: {e}", exc_info=True)
-            self.disconnect_queue.put((fileno, True))
+            self.disconnect_queue.put((session, True))
+        finally:
+            self.finish_read(session)
+
+    def process_post(self, user_id: int, task: Utils.Message.RequestMessage, session: Session):
+        """
+        保存并投递一条消息；带 client_msg_id 的消息在去重窗口内重复到达时，只把第一次的回显发回该设备作为确认
+        :param user_id: 发送方(以登录的用户为准)
+        """
+        now = dt.now().strftime(df)
+        client_msg_id = task.client_msg_id if valid_client_msg_id(task.client_msg_id) else None
+        if client_msg_id is not None:
+            first = self.dedup.check(user_id, client_msg_id, now)
+            if first is not None:
+                task.packet_json["timestamp"] = first
+                self.deliver(session, task.to_json_encoded_bytes())
+                return
+        task.packet_json["timestamp"] = now  # 重新授时
+        task.timestamp = now
+        to_id = task.to_id
+        is_group = task.is_group
+        db = self.db_operator()
+        try:
+            db.insertMessage(task.from_id, task.to_id, task.timestamp, task.msg, task.msg_type, task.is_group)
+        except Exception:
+            if client_msg_id is not None:  # 保存失败，客户端重发时重新处理
+                self.dedup.forget(user_id, client_msg_id)
+            raise
+        self.history.invalidate(conversation_key(task.from_id, to_id, is_group))
+        if task.msg_type == "text":
+            self.index_message(task)
+
+        if is_group:
+            self.send_message(to_id, task, is_group=True, send_apns_push=True)
+        else:
+            self.send_message(user_id, task)  # 重授时后直接回显消息
+            if to_id != user_id:
+                self.send_message(to_id, task, send_apns_push=True)
 
-    def process_query_user(self, user_id: int, task: Utils.Message.RequestMessage):
+    def process_query_user(self, user_id: int, task: Utils.Message.RequestMessage, session: Session = None):
         """
         :param user_id: 发起请求的用户id
         :param task: 请求内容
+        :param session: 发起请求的会话，回复只发给该设备
         """
         query_user_id = task.to_id
-        db = DBOperator()
+        db = self.db_operator()
         query_user_name = db.queryUser(query_user_id)
         response = ResponseMessage.make_user_info_message(query_user_id, query_user_name)
-        self.send_message(user_id, response)
+        self.send_message(user_id, response, session=session)
 
     def process_insert_contact(self, task: Utils.Message.RequestMessage):
         user_id = task.from_id  # 发起加好友的人的id
         o_user_id = task.to_id  # 要加好友的另一个人的id
         if o_user_id is None or user_id is None:
-            logger.warning(f'In insert contact: user_id or o_user_id is None for task {task.to_json_str()}')
+            logger.warning('In insert contact: user_id or o_user_id is None for task %s', Lazy(task.to_json_str))
             return
-        db = DBOperator()
+        db = self.db_operator()
         db.insertContact(user_id, o_user_id)
 
-        response = ResponseMessage.make_hello_message(user_id, o_user_id, db.queryUser(user_id))
+        response = ResponseMessage.make_hello_message(user_id, o_user_id, db.queryUser(user_id), db=db)
+        self.history.invalidate(conversation_key(user_id, o_user_id, False))
         self.send_message(user_id, response)
         self.send_message(o_user_id, response)
 
-    def process_query_group(self, task: Utils.Message.RequestMessage):
+    def process_query_group(self, task: Utils.Message.RequestMessage, session: Session = None):
         user_id = task.from_id
         query_group_id = task.to_id
         during_add = task.msg != ''  # 是否是加群/建群之前的检查性查询
-        db = DBOperator()
+        db = self.db_operator()
         query_group_name = db.queryGroup(query_group_id)
         response = ResponseMessage.make_group_info_message(query_group_id, query_group_name, during_add)
-        self.send_message(user_id, response)
+        self.send_message(user_id, response, session=session)
 
     def process_insert_group(self, task: Utils.Message.RequestMessage):
         user_id = task.from_id
         group_id = task.to_id
         group_name = task.msg
-        db = DBOperator()
+        db = self.db_operator()
         db.insertGroup(group_id, group_name)
         db.insertGroupUser(group_id, user_id)
-        response = ResponseMessage.make_hello_message(0, group_id, group_name, True)
+        response = ResponseMessage.make_hello_message(0, group_id, group_name, True, db=db)
+        self.history.invalidate(conversation_key(0, group_id, True))
         self.send_message(group_id, response, is_group=True)
 
     def process_insert_group_user(self, task: Utils.Message.RequestMessage):
         user_id = task.from_id
         group_id = task.to_id
-        db = DBOperator()
+        db = self.db_operator()
         db.insertGroupUser(group_id, user_id)
-        response = ResponseMessage.make_hello_message(user_id, group_id, '', True, "Hi")
+        response = ResponseMessage.make_hello_message(user_id, group_id, '', True, "Hi", db=db)
+        self.history.invalidate(conversation_key(user_id, group_id, True))
         self.send_message(group_id, response, True)
 
-    def process_file_operation(self, task: Utils.Message.RequestMessage):
+    def process_file_operation(self, task: Utils.Message.RequestMessage, session: Session = None):
         user_id = task.from_id
         file_hash = task.file_hash
         file_suffix = task.file_suffix
         operation = task.file_operation
-        db = DBOperator()
+        db = self.db_operator()
         file_exist = db.queryFile(file_hash, file_suffix)
         file_name = file_hash + "." + file_suffix
         content = ""
         response = ""
         if operation == "upload":
             if not file_exist:
-                content = cos.get_presigned_upload_url("betterfly-1251588291", file_name)
+                content = self.cos.get_presigned_upload_url(COS_BUCKET, file_name)
                 db.insertFile(file_hash, file_suffix)
             else:
                 content = "Existed"
@@ -321,21 +1041,49 @@ class EpollChatServer:
             if not file_exist:
                 content = "Not Exist"
             else:
-                content = cos.get_presigned_download_url("betterfly-1251588291", file_name)
+                content = self.cos.get_presigned_download_url(COS_BUCKET, file_name)
             response = ResponseMessage.make_download_message(file_name, content)
-        self.send_message(user_id, response)
+        self.send_message(user_id, response, session=session)
+
+    def process_file_batch(self, user_id: int, task: Utils.Message.RequestMessage, session: Session):
+        """
+        一次返回多个文件的上传/下载链接，文件是否存在只查询一次数据库，链接在本地批量签名
+        :param user_id: 发起请求的用户id(以登录的用户为准，不信任请求中的from)
+        """
+        operation = task.file_operation
+        files = list(dict.fromkeys(task.files))[:MAX_FILE_BATCH]  # 去重并限制数量
+        if operation not in ("upload", "download") or not files:
+            self.deliver(session, ResponseMessage.make_warn_message("批量文件请求的操作或文件列表无效")
+                         .to_json_encoded_bytes())
+            return
+        db = self.db_operator()
+        existed = db.queryFiles(files)
+        names = {f: f[0] + "." + f[1] for f in files}
+        if operation == "upload":
+            missing = [f for f in files if f not in existed]
+            urls = dict(zip(missing, self.cos.get_presigned_urls(COS_BUCKET, [names[f] for f in missing],
+                                                                 'PUT', 300)))
+            if missing:
+                db.insertFiles(missing)
+            result = [{"name": names[f], "content": urls.get(f, "Existed")} for f in files]
+        else:
+            present = [f for f in files if f in existed]
+            urls = dict(zip(present, self.cos.get_presigned_urls(COS_BUCKET, [names[f] for f in present],
+                                                                 'GET', 60)))
+            result = [{"name": names[f], "content": urls.get(f, "Not Exist")} for f in files]
+        self.send_message(user_id, ResponseMessage.make_file_batch_message(operation, result), session=session)
 
     def process_user_apns_token(self, task: Utils.Message.RequestMessage):
         user_id = task.from_id
         user_apns_token = task.apns_token
-        db = DBOperator()
+        db = self.db_operator()
         db.insertUserAPNsToken(user_id, user_apns_token)  # 添加用户的APNs Token用于后续发送通知
 
     def process_update_avatar(self, task: Utils.Message.RequestMessage):
         id = task.from_id
         is_group = task.is_group
         avatar = task.msg
-        db = DBOperator()
+        db = self.db_operator()
         if is_group:
             db.updateGroupAvatar(id, avatar)
             group_info = db.queryGroup(id)
@@ -347,9 +1095,101 @@ class EpollChatServer:
             response = ResponseMessage.make_user_info_message(id, user_info)
             self.send_message(id, response)
 
-    def sync_message(self, user_id: int, last_login: dt | str):
-        """给客户端发送未登录期间收到的消息"""
-        db = DBOperator()
+    def process_history(self, user_id: int, task: Utils.Message.RequestMessage, session: Session):
+        """
+        按游标返回会话的一页历史消息，一页拆成若干帧后一次发出，只回复发起请求的设备
+        :param user_id: 发起请求的用户id(以登录的用户为准，不信任请求中的from)
+        """
+        to_id = task.to_id
+        is_group = bool(task.is_group)
+        try:
+            limit = min(max(int(task.limit or HISTORY_PAGE_DEFAULT), 1), HISTORY_PAGE_MAX)
+            cursor = None if task.cursor is None else int(task.cursor)
+        except (TypeError, ValueError):
+            self.deliver(session, ResponseMessage.make_warn_message("历史消息请求的游标或数量无效").to_json_encoded_bytes())
+            return
+        if is_group and to_id != -1 and user_id not in set(self.db_operator().queryGroupUser(to_id)):
+            self.deliver(session, ResponseMessage.make_warn_message("不在该群组中，无法查看历史消息").to_json_encoded_bytes())
+            return
+
+        rows, more = self.history.page(conversation_key(user_id, to_id, is_group), cursor, limit,
+                                       lambda *args: self.db_operator().queryHistory(*args))
+        messages = [{"seq": row[6], "from": row[0], "to": row[1], "timestamp": Utils.Message.datetime_str(row[2]),
+                     "msg": row[3], "msg_type": row[4], "is_group": row[5] != 0} for row in rows]
+        next_cursor = rows[-1][6] if more and rows else None
+        chunks = [messages[i:i + HISTORY_FRAME_MESSAGES] for i in range(0, len(messages), HISTORY_FRAME_MESSAGES)]
+        chunks = chunks or [[]]
+        self.deliver(session, b"".join(
+            ResponseMessage.make_history_message(to_id, is_group, chunk, next_cursor, i == len(chunks) - 1)
+            .to_json_encoded_bytes() for i, chunk in enumerate(chunks)))
+
+    def index_message(self, task: Utils.Message.RequestMessage):
+        """把已入库的文本消息加入全文检索索引，索引写入失败不影响消息投递"""
+        if self.search is None:
+            return
+        try:
+            self.search.add(task.from_id, task.to_id, Utils.Message.datetime_str(task.timestamp), task.msg,
+                            task.msg_type, task.is_group)
+        except OSError as e:
+            logger.error(f"Failed to index message from user {task.from_id}: {e}")
+
+    def process_search(self, user_id: int, task: Utils.Message.RequestMessage, session: Session):
+        """
+        搜索用户有权查看的消息：群聊限定在一个群组内(需是群成员)，私聊在用户的全部私聊中搜索，指定 to 时只搜索与该用户的私聊
+        :param user_id: 发起请求的用户id(以登录的用户为准，不信任请求中的from)
+        """
+        query = task.msg.strip()
+        to_id = task.to_id
+        is_group = bool(task.is_group)
+        if self.search is None:
+            self.deliver(session, ResponseMessage.make_warn_message("服务器未开启消息搜索").to_json_encoded_bytes())
+            return
+        try:
+            limit = min(max(int(task.limit or SEARCH_PAGE_DEFAULT), 1), SEARCH_PAGE_MAX)
+            cursor = None if task.cursor is None else int(task.cursor)
+        except (TypeError, ValueError):
+            self.deliver(session, ResponseMessage.make_warn_message("搜索请求的游标或数量无效").to_json_encoded_bytes())
+            return
+        match = None
+        if is_group:
+            if to_id != -1 and user_id not in set(self.db_operator().queryGroupUser(to_id)):
+                self.deliver(session, ResponseMessage.make_warn_message("不在该群组中，无法搜索").to_json_encoded_bytes())
+                return
+            scopes = [group_scope(to_id)]
+        else:
+            scopes = [user_scope(user_id)]
+            if to_id:
+                match = lambda doc: {doc[0], doc[1]} == {user_id, to_id}
+
+        results, more = self.search.search(scopes, query, cursor, limit, match)
+        messages = [{"id": doc_id, "from": doc[0], "to": doc[1], "timestamp": doc[2], "msg": doc[3],
+                     "msg_type": doc[4], "is_group": doc[5] != 0} for doc_id, doc in results]
+        next_cursor = results[-1][0] if more and results else None
+        self.deliver(session, ResponseMessage.make_search_result_message(
+            query, to_id, is_group, messages, next_cursor).to_json_encoded_bytes())
+
+    def process_read_ack(self, user_id: int, task: Utils.Message.RequestMessage, session: Session):
+        """清零一个会话的未读数，并把新的未读汇总发给该用户的其他设备"""
+        to_id = task.to_id
+        is_group = bool(task.is_group)
+        if not isinstance(to_id, int) or isinstance(to_id, bool):
+            self.deliver(session, ResponseMessage.make_warn_message("已读回执的会话无效").to_json_encoded_bytes())
+            return
+        if is_group and user_id not in set(self.db_operator().queryGroupUser(to_id)):
+            self.deliver(session, ResponseMessage.make_warn_message("不在该群组中").to_json_encoded_bytes())
+            return
+        if not self.unread.clear(user_id, (int(is_group), to_id)):
+            return
+        others = [s for s in self.sessions.sessions_of(user_id) if s is not session]
+        if others:
+            self.send_to_sessions(others, ResponseMessage.make_unread_summary_message(self.unread.summary(user_id)))
+
+    def sync_message(self, user_id: int, last_login: dt | str, session: Session = None):
+        """
+        给客户端发送未登录期间收到的消息
+        :param session: 刚登录的设备，只向该设备同步；不指定则发送给用户的所有设备
+        """
+        db = self.db_operator()
         msg_list = db.querySyncMessage(user_id, last_login)
         for msg in msg_list:
             response = ResponseMessage(
@@ -363,107 +1203,260 @@ class EpollChatServer:
                 is_group=(msg[5] == 1)
             )
             # 开启同步转发时，关闭APNs推送
-            self.send_message(user_id, response)
-
-    def close_client(self, fileno, abnormal=False):
-        user_id = self.fno_uid.get(fileno)
+            self.send_message(user_id, response, session=session)
 
-        if user_id is not None:
-            try:
-                client_socket = self.clients[user_id][2]
-                logger.info(f"Connection closed from user {user_id}")
-                if not abnormal:
-                    client_socket.send(ResponseMessage.make_server_message("Goodbye!").to_json_encoded_bytes())
-                    self.epoll.unregister(fileno)
-                client_socket.close()
-                self.clients.pop(user_id)
-                self.fno_uid.pop(fileno)
-            except Exception as e:
-                logger.error(f"Error closing client connection for user {user_id}: {e}", exc_info=True)
-        elif fileno in self.temp_clients:
-            # 如果 fileno 存在于临时客户端中
-            try:
-                client_socket = self.temp_clients[fileno]
+    def close_client(self, session: Session, abnormal=False):
+        if self.sessions.get(session.fileno) is not session:  # 已关闭，fileno 可能已被新连接复用
+            return
+        fileno = session.fileno
+        client_socket = session.sock
+        try:
+            if session.authenticated:
+                logger.info(f"Connection closed from user {session.user_id} with fileno {fileno}")
+            else:
                 logger.info(f"Connection closed from temporary fileno {fileno}")
-                if not abnormal:
-                    self.epoll.unregister(fileno)
+            if not abnormal:
+                if session.authenticated:
+                    self.deliver(session, ResponseMessage.make_server_message("Goodbye!").to_json_encoded_bytes())
+                self.epoll.unregister(fileno)
+        except (BrokenPipeError, ConnectionResetError) as e:  # 对端已先关闭连接
+            logger.debug("Peer of fileno %s already closed: %s", fileno, e)
+        except Exception as e:
+            logger.error(f"Error closing client connection for fileno {fileno}: {e}", exc_info=True)
+        finally:
+            # 先从会话表移除再关闭 socket，避免 fileno 被复用后误删新连接；
+            # 持有发送锁，避免其他线程在 fileno 被复用后修改新连接的 epoll 注册
+            with self.send_locks[fileno % SEND_LOCK_STRIPES]:
+                self.sessions.remove(fileno, session)
+                self.congested.discard(session)
                 client_socket.close()
-                self.temp_clients.pop(fileno)
-            except Exception as e:
-                logger.error(f"Error closing temporary client connection for fileno {fileno}: {e}", exc_info=True)
+            CONNECTIONS.inc("closed_abnormal" if abnormal else "closed")
+
+    def stop_workers(self):
+        """停止所有工作线程，已提交的任务会先处理完；推送线程停止时未发送的推送保留在暂存区"""
+        if self.workers_stopped:
+            return
+        self.workers_stopped = True
+        self.initialize_queue.put(None)
+        self.initialize_thread.join()
+        self.executor.shutdown(wait=True)
+        for executor in self.retired_executors:
+            executor.shutdown(wait=True)
+        self.broadcaster.stop()
+        if self.search is not None:
+            self.search.stop()
+        self.unread.stop()
+        self.disconnect_queue.put((None, None))
+        self.disconnect_thread.join()
+        self.deferred.stop()
+        self.startup.stop()
+        if self.cluster is not None:
+            self.cluster.stop()
+        self.apns_dispatcher.stop()
+        self.apns.close()
 
     def shutdown(self):
         try:
-            # 发送服务器关闭消息给所有已连接用户
-            for uid, (user_name, fno, sock) in list(self.clients.items()):
-                self.disconnect_queue.put((fno, False))
-
-            # 关闭所有未完成的临时客户端连接
-            for fno, sock in list(self.temp_clients.items()):
-                self.disconnect_queue.put((fno, False))
-
-            # 检查服务器套接字是否有效，避免负数的文件描述符错误
-            if self.server_socket.fileno() != -1:
-                logger.info("Shutting down server...")
-                self.epoll.unregister(self.server_socket.fileno())
+            if self.handed_off:
+                # 连接已交给新进程，只关闭本进程持有的描述符，不能向客户端发送任何数据
+                for session in self.sessions.all():
+                    session.sock.close()
                 self.server_socket.close()
+            else:
+                # 发送服务器关闭消息给所有已连接用户，并关闭所有未完成登录的连接
+                for session in self.sessions.all():
+                    if self.workers_stopped:  # 接管失败时关闭线程已停止
+                        self.close_client(session)
+                    else:
+                        self.disconnect_queue.put((session, False))
+
+                # 检查服务器套接字是否有效，避免负数的文件描述符错误
+                if self.server_socket.fileno() != -1:
+                    logger.info("Shutting down server...")
+                    if not self.workers_stopped:
+                        self.epoll.unregister(self.server_socket.fileno())
+                    self.server_socket.close()
+                if self.handoff_listener is not None and self.handoff_listener.fileno() != -1:
+                    self.handoff_listener.close()
+                    os.unlink(self.config.handoff_path)
+            self.stop_workers()
+            if self.metrics_server is not None:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close()
             # 关闭 epoll 对象
-            self.disconnect_queue.put((None, None))
-            self.initialize_queue.put(None)
-            self.apns_send_queue.put((None, None, None, None))
-            self.disconnect_thread.join()
-            self.initialize_thread.join()
-            self.apns_send_thread.join()
             self.epoll.close()
         except Exception as e:
             logger.error(f"Error during shutdown: {e}", exc_info=True)
 
     def send_message(self, to_id: int, message: ResponseMessage | RequestMessage,
-                     is_group=False, send_apns_push=False):
+                     is_group=False, send_apns_push=False, session: Session = None):
+        """
+        :param session: 指定时只发送给这一个会话(请求的回复、登录时的消息同步)，否则发送给接收方的所有设备
+        """
         # APNs 推送请求默认不发送
+        if session is not None:
+            self.send_to_sessions((session,), message)
+            return
         from_id = message.from_id  # 把from_id的获取提前，方便某人同步全体消息时转发使用
-        db = DBOperator()
+        db = self.db_operator()
         to_list = list()
         if is_group:
             if to_id == -1:  # 当转发全体消息时
-                for uid, (uname, fno, sock) in self.clients.items():
-                    sock.send(message.to_json_encoded_bytes())
-                return  # 全体消息转发完毕，可以退出了
+                data = message.to_json_encoded_bytes()
+                job = self.broadcaster.submit(self.sessions.authenticated_shards(), data)
+                if self.cluster is not None:
+                    self.cluster.route_all(data)
+                FANOUT_SIZE.observe(job.total)
+                return  # 全体消息已交给写线程，可以退出了
             to_list.extend(db.queryGroupUser(to_id))
         else:
             to_list.append(to_id)
+        FANOUT_SIZE.observe(len(to_list))
 
-        for user_id in to_list:
-            if user_id != from_id:
-                if send_apns_push:  # 仅当需要启用APNs推送时使用，消息同步的时候不进行这些操作
-                    user_name = db.queryUserName(from_id)
-                    if message.msg_type == "file":  # 用于获取推送需要的body内容
-                        user_msg = "[文件]"
-                    elif message.msg_type == "gif":
-                        user_msg = "[表情符号]"
-                    elif message.msg_type == "image":
-                        user_msg = "[图片]"
-                    else:
-                        if len(message.msg) > 30:  # 文本过长只显示您有一条新消息
-                            user_msg = "您有一条新消息"
-                        else:  # 否则显示文本内容
-                            user_msg = message.msg
-
-                    apns_list = db.queryUserAPNsTokens(user_id)  # 查询出用户所有的APNs Token
-                    for apns_token in apns_list:  # 开始尝试向对应用户所有APNs Token发送
-                        if apns_token[0] is not None:
-                            # (apns_token, user_name, user_msg, user_id)
-                            self.apns_send_queue.put((apns_token[0], user_name, user_msg, user_id))
-            recv_info = self.clients.get(user_id)
-
-            if recv_info is None:
-                logger.warning(
-                    f'Failed to get clients for user: {user_id}    While sending message: {message.to_json_str()}')
+        # 集群模式下，在其他节点在线的接收方按节点合并成一条转发，由对方节点投递并决定是否推送
+        delegated = ()
+        if self.cluster is not None:
+            meta = {"push": send_apns_push, "from_id": from_id}
+            if send_apns_push:
+                meta.update(msg=message.msg, msg_type=message.msg_type, to_id=message.to_id,
+                            is_group=bool(message.is_group))
+            to_list, delegated = self.cluster.route(to_list, message.to_json_encoded_bytes(), meta)
+        self.deliver_to_users(to_list, message, from_id, send_apns_push, skip_push=delegated, db=db)
+
+    def deliver_to_users(self, user_ids: list, message: ResponseMessage | RequestMessage | None, from_id: int,
+                         send_apns_push: bool, skip_push=(), db=None, data: bytes = None):
+        """
+        把消息投递给本节点上这些用户的所有设备，并为没有活跃设备的用户发送推送
+        :param skip_push: 不由本节点决定是否推送的用户
+        :param data: 已编码的消息帧(其他节点转发来的消息)，此时 message 只用于生成推送内容
+        """
+        push_targets = []
+        unread_users = []
+        avoided = 0
+        now = time.monotonic()
+        for user_id in user_ids:
+            recv_sessions = self.sessions.sessions_of(user_id)
+            if recv_sessions:
+                self.send_to_sessions(recv_sessions, message, data)
+                message_log.record("sent", user_id=user_id, from_id=from_id,
+                                   type=int(message.type) if message is not None else None)
+            else:
+                logger.debug('Failed to get clients for user: %s    While sending message from: %s',
+                             user_id, from_id)
+
+            # 仅当需要启用APNs推送时使用，消息同步的时候不进行这些操作
+            if send_apns_push and user_id != from_id and user_id not in skip_push:
+                unread_users.append(user_id)
+                if any(self.is_reachable(s, now) for s in recv_sessions):
+                    # 接收方有设备在线且近期活跃，socket 送达即可，不再推送
+                    avoided += 1
+                else:
+                    push_targets.append(user_id)
+
+        if send_apns_push:
+            # 每个接收方只由负责其推送的节点计入未读数，先计数再推送，角标包含这条消息
+            self.unread.add(unread_users, unread_conversation(from_id, message.to_id, message.is_group))
+            if push_targets:
+                if self.admission.level == NORMAL:
+                    self.push_to_users(from_id, push_targets, message, db)
+                elif self.deferred.submit(self.push_to_users, from_id, push_targets, message):
+                    # 过载时推送的数据库查询推迟到负载恢复后，优先完成 socket 投递
+                    LOAD_SHED.inc("Push", "deferred", amount=len(push_targets))
+                else:
+                    LOAD_SHED.inc("Push", "shed", amount=len(push_targets))
+            with self.push_stats_lock:
+                self.push_stats["pushed"] += len(push_targets)
+                self.push_stats["avoided"] += avoided
+            logger.debug("Fan-out of message from %s to %s users: %s pushed, %s pushes avoided",
+                         from_id, len(user_ids), len(push_targets), avoided)
+
+    def deliver_forwarded(self, forward: dict):
+        """其他节点转发来的投递(在总线接收线程中调用)，交给工作线程处理"""
+        try:
+            self.executor.submit(self._deliver_forwarded, forward)
+        except RuntimeError:  # 执行器刚被替换(调整线程数)或正在关闭
+            if self.workers_stopped:
+                logger.debug("Dropped forwarded message during shutdown")
+            else:
+                self.executor.submit(self._deliver_forwarded, forward)
+
+    def _deliver_forwarded(self, forward: dict):
+        message = None
+        if forward.get("push"):
+            message = ResponseMessage(ResponseType.Post, forward["from_id"], forward["msg"],
+                                      to_id=forward.get("to_id", 0), is_group=forward.get("is_group", False),
+                                      msg_type=forward["msg_type"])
+        users = forward["users"]
+        push_users = set(forward.get("push_users", ()))
+        self.deliver_to_users(users, message, forward["from_id"], bool(forward.get("push")),
+                              skip_push={u for u in users if u not in push_users}, data=forward["frame"].encode())
+
+    def deliver_forwarded_all(self, data: bytes):
+        """其他节点转发来的全体消息"""
+        self.broadcaster.submit(self.sessions.authenticated_shards(), data)
+
+    def on_broadcast_error(self, session: Session, error: OSError):
+        logger.warning(f"Failed to broadcast to fileno {session.fileno}: {error}")
+        self.disconnect_queue.put((session, True))
+
+    def push_to_users(self, from_id: int, user_ids: list, message: ResponseMessage | RequestMessage, db=None):
+        """
+        向若干用户的所有APNs Token发送推送
+        :param db: 可复用的数据库操作对象，不指定时新建
+        """
+        db = db if db is not None else self.db_operator()
+        user_name = db.queryUserName(from_id)
+        user_msg = self.make_push_body(message)
+        # 暂存区已满时整次扇出最多阻塞 spool_timeout，之后的推送不再等待直接丢弃(计入 dropped)
+        deadline = time.monotonic() + self.apns_dispatcher.spool_timeout
+        for user_id in user_ids:
+            apns_list = db.queryUserAPNsTokens(user_id)  # 查询出用户所有的APNs Token
+            if not apns_list:
                 continue
-            recv_sock = recv_info[2]
-            recv_sock.send(message.to_json_encoded_bytes())
+            badge = self.unread.total(user_id, db)  # 角标显示用户所有会话的未读数
+            for apns_token in apns_list:  # 开始尝试向对应用户所有APNs Token发送
+                if apns_token[0] is not None:
+                    self.apns_dispatcher.submit(apns_token[0], user_name, user_msg, user_id, badge,
+                                                timeout=max(0.0, deadline - time.monotonic()))
+
+    def is_reachable(self, session: Session, now: float) -> bool:
+        """会话近期活跃且能实时收到消息时不再推送；push_only 策略下暂停投递的会话改为推送"""
+        if now - session.last_active >= self.config.push_idle_threshold:
+            return False
+        outbox = session.outbox
+        return not (outbox is not None and outbox.degraded and self.config.slow_consumer_policy == PUSH_ONLY)
+
+    def send_to_sessions(self, sessions: tuple | list, message: ResponseMessage | RequestMessage | None,
+                         data: bytes = None):
+        """
+        把同一条消息发送给若干会话，只编码一次
+        :param data: 已编码的消息帧，指定时直接发送
+        """
+        if data is None and not tracer.enabled:
+            data = message.to_json_encoded_bytes()
+        for recv_session in sessions:
+            try:
+                if data is None:
+                    self.traced_send(recv_session, message)
+                else:
+                    self.deliver(recv_session, data)
+            except OSError as e:
+                # 一个设备的连接出错不影响同一用户其他设备的投递
+                logger.warning(f"Failed to send to fileno {recv_session.fileno}: {e}")
+                self.disconnect_queue.put((recv_session, True))
 
-            logger.info(f'Sent message to user {user_id}: {message.to_json_str()}')
+    @staticmethod
+    def make_push_body(message: ResponseMessage | RequestMessage) -> str:
+        """生成推送通知的body内容"""
+        if message.msg_type == "file":
+            return "[文件]"
+        elif message.msg_type == "gif":
+            return "[表情符号]"
+        elif message.msg_type == "image":
+            return "[图片]"
+        elif len(message.msg) > 30:  # 文本过长只显示您有一条新消息
+            return "您有一条新消息"
+        return message.msg  # 否则显示文本内容
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+import collections
+import threading
+
+from Utils.color_logger import get_logger
+from Utils.metrics import Histogram
+
+logger = get_logger(__name__)
+
+# 负载等级
+NORMAL = 0  # 正常处理所有请求
+SHEDDING = 1  # 丢弃或推迟非关键请求(查询、头像更新、推送)，优先保证消息投递
+OVERLOADED = 2  # 在 SHEDDING 基础上拒绝新登录
+LEVEL_NAMES = ("normal", "shedding", "overloaded")
+
+# 非关键请求在 SHEDDING 及以上等级时的处理方式
+SHED = "shed"  # 丢弃并回复 Warn，由客户端稍后重试
+DEFER = "defer"  # 放入推迟队列，负载恢复正常后再处理
+
+UPDATE_INTERVAL = 0.1  # 重新计算负载等级的最短间隔(秒)
+LOOP_LAG_ALPHA = 0.2  # 事件循环耗时的指数移动平均系数
+
+
+class WindowedMean:
+    """把累计型直方图转换为两次调用之间的平均值，如最近一个周期的平均连接池等待时间"""
+
+    def __init__(self, histogram: Histogram, *label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.__last = histogram.totals(*label_values)
+
+    def __call__(self) -> float:
+        total, count = self.histogram.totals(*self.label_values)
+        last_total, last_count = self.__last
+        self.__last = (total, count)
+        return (total - last_total) / (count - last_count) if count > last_count else 0.0
+
+
+class AdmissionController:
+    """
+    根据若干过载信号(执行器积压、数据库连接池等待、事件循环耗时)计算全局负载等级。
+    每个信号有 (SHEDDING 阈值, OVERLOADED 阈值)，取所有信号中最高的等级；
+    等级上升立即生效，下降需要持续 cooldown 秒，避免在阈值附近来回切换。
+    只应在事件循环线程中调用 update，其他线程只读取 level
+    """
+
+    def __init__(self, cooldown: float = 5.0, shed_types: set = (), defer_types: set = ()):
+        """
+        :param cooldown: 等级下降前需要保持低负载的时间(秒)
+        :param shed_types: SHEDDING 时丢弃的请求类型
+        :param defer_types: SHEDDING 时推迟处理的请求类型
+        """
+        self.cooldown = cooldown
+        self.shed_types = frozenset(shed_types)
+        self.defer_types = frozenset(defer_types)
+        self.level = NORMAL
+        self.loop_lag = 0.0  # 事件循环每轮处理耗时的移动平均(秒)
+        self.__signals = {}  # {名称: (func, SHEDDING 阈值, OVERLOADED 阈值)}
+        self.__values = {}  # {名称: 最近一次的值}
+        self.__updated = 0.0
+        self.__calm_since = None  # 计算出的等级低于当前等级的起始时间
+
+    def add_signal(self, name: str, func, shed_threshold: float, overload_threshold: float):
+        self.__signals[name] = (func, shed_threshold, overload_threshold)
+
+    def record_loop(self, busy: float):
+        """记录事件循环一轮的处理耗时"""
+        self.loop_lag += LOOP_LAG_ALPHA * (busy - self.loop_lag)
+
+    def update(self, now: float) -> int:
+        """
+        重新计算负载等级，距上次计算不足 UPDATE_INTERVAL 时直接返回当前等级
+        :param now: time.monotonic()
+        """
+        if now - self.__updated < UPDATE_INTERVAL:
+            return self.level
+        self.__updated = now
+        target = NORMAL
+        for name, (func, shed_threshold, overload_threshold) in self.__signals.items():
+            try:
+                value = self.__values[name] = func()
+            except Exception as e:
+                logger.warning(f"Failed to read admission signal {name}: {e}")
+                continue
+            if value >= overload_threshold:
+                target = OVERLOADED
+            elif value >= shed_threshold:
+                target = max(target, SHEDDING)
+
+        if target >= self.level:
+            self.__calm_since = None
+            if target > self.level:
+                self._transition(target)
+        elif self.__calm_since is None:
+            self.__calm_since = now
+        elif now - self.__calm_since >= self.cooldown:
+            self.__calm_since = None
+            self._transition(target)
+        return self.level
+
+    def _transition(self, level: int):
+        signals = ", ".join(f"{name}={value:.4g}" for name, value in self.__values.items())
+        if level > self.level:
+            logger.warning(f"Load level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} ({signals})")
+        else:
+            logger.info(f"Load level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} ({signals})")
+        self.level = level
+
+    def action_for(self, request_type: int) -> str | None:
+        """:return: 当前等级下该类型请求的处理方式 SHED/DEFER，正常处理时返回None"""
+        if self.level == NORMAL:
+            return None
+        if request_type in self.shed_types:
+            return SHED
+        if request_type in self.defer_types:
+            return DEFER
+        return None
+
+    def state(self) -> dict:
+        return {"level": LEVEL_NAMES[self.level],
+                "signals": {name: {"value": self.__values.get(name), "shed": shed, "overload": overload}
+                            for name, (_, shed, overload) in self.__signals.items()}}
+
+    def signal_values(self) -> dict:
+        return dict(self.__values)
+
+
+class DeferredWork:
+    """
+    负载过高时推迟执行的任务队列(有界)，由一个后台线程在负载恢复正常后逐个执行，
+    同一时间最多只占用一个线程
+    """
+
+    def __init__(self, controller: AdmissionController, max_size: int = 10000):
+        self.controller = controller
+        self.max_size = max_size
+        self.dropped = 0
+        self.__queue = collections.deque()
+        self.__cond = threading.Condition()
+        self.__running = False
+        self.__thread = None
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def submit(self, func, *args) -> bool:
+        """:return: 队列已满时返回False，任务被丢弃"""
+        with self.__cond:
+            if len(self.__queue) >= self.max_size:
+                self.dropped += 1
+                return False
+            self.__queue.append((func, args))
+            self.__cond.notify()
+        return True
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self._run, name="deferred-work", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """停止后台线程，并在调用线程中执行队列中剩余的任务(这些请求已被接受，不能丢弃)"""
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+        with self.__cond:
+            remaining = list(self.__queue)
+            self.__queue.clear()
+        if remaining:
+            logger.info(f"Running {len(remaining)} deferred tasks before shutdown")
+        for func, args in remaining:
+            self._execute(func, args)
+
+    def _execute(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Error in deferred task {func}: {e}", exc_info=True)
+
+    def _run(self):
+        while True:
+            with self.__cond:
+                while self.__running and (not self.__queue or self.controller.level != NORMAL):
+                    self.__cond.wait(UPDATE_INTERVAL)
+                if not self.__running:
+                    return
+                func, args = self.__queue.popleft()
+            self._execute(func, args)
@@ -1,20 +1,73 @@
+import asyncio
 import os
+import random
+import threading
 import time
+from collections import deque
+from dataclasses import dataclass, field
 
 import httpx
 import jwt
 
+from Utils.apns_spool import PushSpool
 from Utils.color_logger import get_logger
+from Utils.metrics import registry
 
 logger = get_logger(__name__)
 
+APNS_RESULTS = registry.counter("betterfly_apns_results_total", "APNs send attempts by outcome and reason",
+                                ("outcome", "reason"))
+APNS_QUEUE_AGE = registry.histogram("betterfly_apns_queue_age_seconds", "Time from submit to APNs response")
+
 root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 config_dir = os.path.join(root_dir, "Config")
 config_fp = os.path.join(config_dir, 'AuthKey_8UZN8NKG46.p8')
 
+# Apple 要求 provider token 每 20~60 分钟刷新一次，过于频繁会被 TooManyProviderTokenUpdates 拒绝
+JWT_REFRESH_INTERVAL = 40 * 60
+# stats 中吞吐与平均排队时长的统计窗口(秒)
+STATS_WINDOW = 60
+
+
+# 可重试的临时错误：限流、服务端错误与不可用
+TRANSIENT_STATUS = {429, 500, 503}
+# 只有这两个原因说明设备Token确实失效，需要删除
+INVALID_TOKEN_REASONS = {"Unregistered", "BadDeviceToken"}
+
+
+@dataclass
+class APNsResult:
+    """一次推送请求的结果，status 为 None 表示网络错误"""
+    ok: bool
+    status: int | None = None
+    reason: str = ""
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def transient(self) -> bool:
+        """是否为可重试的临时错误"""
+        return not self.ok and (self.status is None or self.status in TRANSIENT_STATUS)
+
+    @property
+    def invalid_token(self) -> bool:
+        """Apple 明确告知设备Token无效"""
+        return self.reason in INVALID_TOKEN_REASONS
+
+    @staticmethod
+    def from_response(response: httpx.Response) -> "APNsResult":
+        reason = ""
+        if response.status_code != 200 and response.content:
+            try:
+                reason = response.json().get("reason", "")
+            except ValueError:
+                reason = response.text
+        return APNsResult(response.status_code == 200, response.status_code, reason)
+
 
 class APNsClient:
-    def __init__(self, use_sandbox: bool = True):
+    def __init__(self, use_sandbox: bool = True, key_path: str = config_fp, apns_url: str = None):
         """
         初始化 APNs 客户端。
 
@@ -23,12 +76,26 @@ class APNsClient:
         :param bundle_id: 应用的 Bundle ID
         :param key_path: 本地 .p8 文件的路径
         :param use_sandbox: 是否使用沙盒环境（默认 True，生产环境为 False）
+        :param apns_url: 自定义 APNs 地址(如本地的 APNs 模拟服务)，http:// 地址会使用 h2c 直连
         """
         self.team_id = "BYMJC965BC"
         self.key_id = "8UZN8NKG46"
         self.bundle_id = "com.betterfly.betterflyclient"
-        self.key_path = config_fp
-        self.apns_url = "https://api.sandbox.push.apple.com" if use_sandbox else "https://api.push.apple.com"
+        self.key_path = key_path
+        if apns_url is None:
+            apns_url = "https://api.sandbox.push.apple.com" if use_sandbox else "https://api.push.apple.com"
+        self.apns_url = apns_url
+        # 明文地址没有ALPN协商，只能以HTTP/2 prior knowledge方式连接
+        self.http1 = not apns_url.startswith("http://")
+
+        # 密钥只读取一次，JWT 在刷新周期内复用
+        self.__private_key: str | None = None
+        self.__jwt: str | None = None
+        self.__jwt_issued_at = 0.0
+        # 长连接：所有推送复用同一个 HTTP/2 连接(多路复用)，断开后自动重建
+        self.__client: httpx.Client | None = None
+        self.__async_client: httpx.AsyncClient | None = None  # 仅在APNsDispatcher的事件循环中使用
+        self.__lock = threading.Lock()
 
     def _generate_jwt(self) -> str:
         """
@@ -36,46 +103,409 @@ class APNsClient:
 
         :return: JWT 字符串
         """
-        with open(self.key_path, "r") as f:
-            private_key = f.read()
+        if self.__private_key is None:
+            with open(self.key_path, "r") as f:
+                self.__private_key = f.read()
 
         token = jwt.encode(
             {"iss": self.team_id, "iat": int(time.time())},
-            private_key,
+            self.__private_key,
             algorithm="ES256",
             headers={"alg": "ES256", "kid": self.key_id}
         )
         return token
 
+    def _get_jwt(self, force_refresh: bool = False) -> str:
+        """
+        获取缓存的 JWT，超过刷新周期或被 Apple 判定过期时重新签名。
+
+        :param force_refresh: 是否强制重新签名
+        """
+        with self.__lock:
+            now = time.monotonic()
+            if force_refresh or self.__jwt is None or now - self.__jwt_issued_at >= JWT_REFRESH_INTERVAL:
+                self.__jwt = self._generate_jwt()
+                self.__jwt_issued_at = now
+            return self.__jwt
+
+    def warm_up(self):
+        """提前读取密钥并生成 JWT，密钥缺失或无效时在启动阶段就能发现"""
+        self._get_jwt()
+
+    def _get_client(self) -> httpx.Client:
+        """获取长连接客户端，不存在时新建"""
+        with self.__lock:
+            if self.__client is None:
+                self.__client = httpx.Client(http1=self.http1, http2=True,
+                                             timeout=httpx.Timeout(10.0, connect=5.0),
+                                             limits=httpx.Limits(max_connections=4, max_keepalive_connections=4))
+            return self.__client
+
+    def _reset_client(self, client: httpx.Client):
+        """连接出错后丢弃旧客户端，下次请求时重新建立连接"""
+        with self.__lock:
+            if self.__client is client:
+                self.__client = None
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """获取异步长连接客户端，所有并发请求作为HTTP/2 stream复用同一个连接"""
+        if self.__async_client is None:
+            self.__async_client = httpx.AsyncClient(http1=self.http1, http2=True,
+                                                    timeout=httpx.Timeout(10.0, connect=5.0),
+                                                    limits=httpx.Limits(max_connections=1,
+                                                                        max_keepalive_connections=1))
+        return self.__async_client
+
+    async def _reset_async_client(self, client: httpx.AsyncClient):
+        if self.__async_client is client:
+            self.__async_client = None
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+
+    def close(self):
+        """关闭长连接"""
+        with self.__lock:
+            client, self.__client = self.__client, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self):
+        """关闭异步长连接，需在创建它的事件循环中调用"""
+        client, self.__async_client = self.__async_client, None
+        if client is not None:
+            await client.aclose()
+
     def send_notification(self, device_token: str, payload: dict) -> bool:
         """
-        向指定设备发送推送通知。
+        向指定设备发送推送通知。连接断开时自动重连并重试一次，
+        provider token 过期时重新签名并重试一次。
 
         :param device_token: 目标设备的 Token
         :param payload: 推送通知的 JSON 数据
         :return: APNs 响应
         """
-        headers = {
-            "Authorization": f"bearer {self._generate_jwt()}",
-            "apns-topic": self.bundle_id,
-        }
-        client = httpx.Client(http2=True)
         url = f"{self.apns_url}/3/device/{device_token}"
+        force_refresh = False
+        for attempt in range(2):
+            headers = {
+                "Authorization": f"bearer {self._get_jwt(force_refresh)}",
+                "apns-topic": self.bundle_id,
+            }
+            client = self._get_client()
+            try:
+                response = client.post(url, json=payload, headers=headers)
+                if response.status_code == 403 and attempt == 0 and "ExpiredProviderToken" in response.text:
+                    force_refresh = True
+                    continue
+                response.raise_for_status()  # 如果状态码非200，抛出异常
+                logger.info({"status": response.status_code, "data": response.json() if response.text else {}})
+                return True
+            except httpx.HTTPStatusError as e:
+                logger.error({"status": e.response.status_code, "error": e.response.text})
+                return False
+            except httpx.TransportError as e:
+                self._reset_client(client)
+                if attempt == 0:
+                    continue
+                logger.error({"status": "transport_error", "error": str(e)})
+                return False
+            except Exception as e:
+                logger.error({"status": "unknown_error", "error": str(e)})
+                return False
+        return False
+
+    async def send_notification_async(self, device_token: str, payload: dict) -> APNsResult:
+        """
+        send_notification 的异步版本，多个并发调用会在同一个HTTP/2连接上多路复用。
+
+        :param device_token: 目标设备的 Token
+        :param payload: 推送通知的 JSON 数据
+        :return: 推送结果，包含状态码与 Apple 返回的失败原因
+        """
+        url = f"{self.apns_url}/3/device/{device_token}"
+        force_refresh = False
+        for attempt in range(2):
+            headers = {
+                "Authorization": f"bearer {self._get_jwt(force_refresh)}",
+                "apns-topic": self.bundle_id,
+            }
+            client = self._get_async_client()
+            try:
+                response = await client.post(url, json=payload, headers=headers)
+                result = APNsResult.from_response(response)
+                if result.reason == "ExpiredProviderToken" and attempt == 0:
+                    force_refresh = True
+                    continue
+                if result.ok:
+                    logger.debug({"status": result.status})
+                else:
+                    logger.warning({"status": result.status, "reason": result.reason})
+                return result
+            except httpx.TransportError as e:
+                await self._reset_async_client(client)
+                if attempt == 0:
+                    continue
+                logger.warning({"status": "transport_error", "error": str(e)})
+                return APNsResult(False, None, type(e).__name__)
+            except Exception as e:
+                logger.error({"status": "unknown_error", "error": str(e)})
+                return APNsResult(False, 0, "unknown_error")
+        return APNsResult(False, 403, "ExpiredProviderToken")
+
+
+@dataclass
+class PendingPush:
+    """等待发送的推送，同一设备在合并窗口内的多条推送会合并为一条"""
+    device_token: str
+    user_id: int
+    user_name: str
+    msg: str
+    count: int = 1
+    badge: int | None = None  # 用户的未读消息数，为空时角标显示合并的推送条数
+    ids: list = field(default_factory=list)  # 对应的暂存区记录id
+    attempts: int = 0  # 已失败的次数
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class APNsDispatcher:
+    """
+    异步推送调度器：在独立线程的事件循环中运行，
+    并发请求以多个HTTP/2 stream复用APNs连接，同一设备的突发推送合并为一条并带上准确的消息数。
+    推送先写入有界的持久化暂存区(PushSpool)，临时错误按指数退避加随机抖动重试，
+    只有 Apple 明确返回 Unregistered/BadDeviceToken 时才删除设备Token。
+    """
+
+    def __init__(self, client: APNsClient, spool: PushSpool = None, max_concurrent_streams: int = 100,
+                 coalesce_window: float = 0.5, max_retries: int = 8, base_backoff: float = 1.0,
+                 max_backoff: float = 300.0, spool_timeout: float = 1.0, on_invalid_token=None):
+        """
+        :param client: APNs 客户端
+        :param spool: 持久化暂存区，为None时推送只保存在内存中
+        :param max_concurrent_streams: 同时在途的推送请求数上限
+        :param coalesce_window: 同一设备的推送合并窗口(秒)，窗口内的推送合并发送
+        :param max_retries: 临时错误的最大重试次数
+        :param base_backoff: 首次重试的退避时间(秒)，之后每次翻倍
+        :param max_backoff: 退避时间上限(秒)
+        :param spool_timeout: 暂存区已满时 submit 最多阻塞的时间(秒)
+        :param on_invalid_token: 设备Token失效时的回调 on_invalid_token(user_id, device_token)，在线程池中执行
+        """
+        self.client = client
+        self.spool = spool
+        self.max_concurrent_streams = max_concurrent_streams
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.spool_timeout = spool_timeout
+        self.on_invalid_token = on_invalid_token
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="apns-dispatcher", daemon=True)
+        self.__pending: dict[str, PendingPush] = {}  # {device_token: PendingPush}，仅在事件循环线程中访问
+        self.__retrying = 0  # 等待退避重试的推送数
+        self.__tasks = set()
+        self.__semaphore: asyncio.Semaphore | None = None
+
+        # 统计信息
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.invalid_tokens = 0
+        self.in_flight = 0
+        self.max_queue_age = 0.0
+        self.__started_at = time.monotonic()
+        # 最近 STATS_WINDOW 秒内每秒完成的推送 [秒, 完成数, 排队时长之和]，吞吐与平均排队时长不受突发量限制
+        self.__buckets = deque(maxlen=STATS_WINDOW)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.__semaphore = asyncio.Semaphore(self.max_concurrent_streams)
+        self.loop.run_forever()
+
+    def start(self):
+        self.__started_at = time.monotonic()
+        self.thread.start()
+        if self.spool is not None:
+            # 重新发送上次退出时尚未完成的推送
+            for entry in self.spool.pending():
+                self.loop.call_soon_threadsafe(self._enqueue, entry["token"], entry["user_name"], entry["msg"],
+                                               entry["user_id"], entry["id"], entry.get("badge"))
+
+    def submit(self, device_token: str, user_name: str, msg: str, user_id: int, badge: int = None,
+               timeout: float = None) -> bool:
+        """
+        线程安全地提交一条推送。暂存区已满时阻塞调用方，超时后放弃该推送
+        :param badge: 应用图标上显示的未读数，为空时显示合并的推送条数
+        :param timeout: 暂存区已满时最多阻塞的时间(秒)，为空时使用 spool_timeout；
+                        一次扇出提交多条推送时由调用方分摊，保证整次扇出最多阻塞 spool_timeout
+        :return: 是否成功提交
+        """
+        entry_id = None
+        if self.spool is not None:
+            entry_id = self.spool.put(device_token, user_name, msg, user_id,
+                                      self.spool_timeout if timeout is None else timeout, badge)
+            if entry_id is None:
+                logger.warning(f"APNs spool is full, dropping push for user {user_id}")
+                return False
+        self.loop.call_soon_threadsafe(self._enqueue, device_token, user_name, msg, user_id, entry_id, badge)
+        return True
+
+    def _enqueue(self, device_token: str, user_name: str, msg: str, user_id: int, entry_id: int | None,
+                 badge: int = None):
+        self.submitted += 1
+        ids = [] if entry_id is None else [entry_id]
+        push = self.__pending.get(device_token)
+        if push is not None:
+            # 窗口内同一设备的推送：展示最新一条与最新的未读数，计数累加
+            push.user_name = user_name
+            push.msg = msg
+            push.count += 1
+            if badge is not None:
+                push.badge = badge
+            push.ids.extend(ids)
+            self.coalesced += 1
+            return
+        self.__pending[device_token] = PendingPush(device_token, user_id, user_name, msg, badge=badge, ids=ids)
+        self.loop.call_later(self.coalesce_window, self._launch, device_token)
+
+    def _launch(self, device_token: str):
+        push = self.__pending.pop(device_token, None)
+        if push is None:
+            return
+        task = self.loop.create_task(self._send(push))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    def _finish(self, push: PendingPush):
+        if self.spool is not None and push.ids:
+            self.spool.done(push.ids)
+
+    def _schedule_retry(self, push: PendingPush):
+        push.attempts += 1
+        if push.attempts > self.max_retries:
+            logger.warning(f"Giving up APNs push for user {push.user_id} after {push.attempts} attempts")
+            self.failed += 1
+            self._finish(push)
+            return
+        self.retried += 1
+        self.__retrying += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (push.attempts - 1))
+        self.loop.call_later(random.uniform(backoff / 2, backoff), self._requeue, push)  # 抖动避免同时重试
+
+    def _requeue(self, push: PendingPush):
+        self.__retrying -= 1
+        newer = self.__pending.get(push.device_token)
+        if newer is not None:
+            # 重试期间同一设备又有新推送，合并后随新推送一起发送
+            newer.count += push.count
+            if newer.badge is None:
+                newer.badge = push.badge
+            newer.ids.extend(push.ids)
+            newer.attempts = max(newer.attempts, push.attempts)
+            return
+        self.__pending[push.device_token] = push
+        self._launch(push.device_token)
+
+    async def _send(self, push: PendingPush):
+        async with self.__semaphore:
+            self.in_flight += 1
+            try:
+                msg = push.msg if push.count == 1 else f"[{push.count}条]{push.msg}"
+                result = await self.client.send_notification_async(
+                    push.device_token, make_notification_payload(
+                        push.user_name, msg, push.count if push.badge is None else push.badge))
+            finally:
+                self.in_flight -= 1
+        now = time.monotonic()
+        queue_age = now - push.enqueued_at
+        self.max_queue_age = max(self.max_queue_age, queue_age)
+        second = int(now)
+        if not self.__buckets or self.__buckets[-1][0] != second:
+            self.__buckets.append([second, 0, 0.0])
+        bucket = self.__buckets[-1]
+        bucket[1] += 1
+        bucket[2] += queue_age
+        APNS_QUEUE_AGE.observe(queue_age)
+        if result.ok:
+            self.sent += 1
+            APNS_RESULTS.inc("sent", "")
+            self._finish(push)
+        elif result.transient:
+            APNS_RESULTS.inc("retry", result.reason or "")
+            self._schedule_retry(push)
+        else:
+            APNS_RESULTS.inc("failed", result.reason or "")
+            self.failed += 1
+            self._finish(push)
+            if result.invalid_token:
+                self.invalid_tokens += 1
+                if self.on_invalid_token is not None:
+                    self.loop.run_in_executor(None, self.on_invalid_token, push.user_id, push.device_token)
+
+    def stats(self) -> dict:
+        """
+        :return: 推送吞吐与排队时长等统计信息，可在任意线程调用
+        """
+        now = time.monotonic()
+        recent = [bucket for bucket in list(self.__buckets) if bucket[0] > int(now) - STATS_WINDOW]
+        completed = sum(bucket[1] for bucket in recent)
+        pending = list(self.__pending.values())
+        return {
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "invalid_tokens": self.invalid_tokens,
+            "dropped": self.spool.dropped if self.spool is not None else 0,
+            "spooled": len(self.spool) if self.spool is not None else 0,
+            "in_flight": self.in_flight,
+            "pending": len(pending),
+            "retrying": self.__retrying,
+            "oldest_pending_age": max((now - push.enqueued_at for push in pending), default=0.0),
+            "throughput_per_s": completed / min(STATS_WINDOW, max(now - self.__started_at, 1e-9)),
+            "avg_queue_age": sum(bucket[2] for bucket in recent) / completed if completed else 0.0,
+            "max_queue_age": self.max_queue_age,
+        }
+
+    async def _drain(self):
+        for device_token in list(self.__pending):
+            self._launch(device_token)
+        if self.__tasks:
+            await asyncio.wait(list(self.__tasks))
+        await self.client.aclose()
+
+    def stop(self, timeout: float = 10.0):
+        """
+        立即发送所有待合并的推送，等待在途请求完成后停止事件循环。
+        仍在退避等待中的推送保留在暂存区，下次启动时重新发送。
+        """
+        if not self.thread.is_alive():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._drain(), self.loop)
         try:
-            response = client.post(url, json=payload, headers=headers)
-            response.raise_for_status()  # 如果状态码非200，抛出异常
-            logger.info({"status": response.status_code, "data": response.json() if response.text else {}})
-            return True
-        except httpx.HTTPStatusError as e:
-            logger.error({"status": e.response.status_code, "error": e.response.text})
-            return False
+            future.result(timeout)
         except Exception as e:
-            logger.error({"status": "unknown_error", "error": str(e)})
-            return False
+            logger.error(f"Error draining APNs dispatcher: {e}", exc_info=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if self.spool is not None:
+            self.spool.close()
 
 
-def make_notification_payload(user_name: str, msg: str) -> dict:
-    info = {"aps": {"alert": {}, "sound": "default", "badge": 1}}
+def make_notification_payload(user_name: str, msg: str, badge: int = 1) -> dict:
+    """
+    :param badge: 应用图标上显示的未读数
+    """
+    info = {"aps": {"alert": {}, "sound": "default", "badge": badge}}
     info["aps"]["alert"]["title"] = user_name
     info["aps"]["alert"]["body"] = msg
     info["aps"]["alert"]["sound"] = "default"
@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class PushSpool:
+    """
+    有界、持久化的推送暂存区。
+
+    每条待发送推送以 {"op": "add", ...} 追加写入本地文件，发送结束(成功或放弃)后追加 {"op": "done", "id": ...}，
+    重启时回放文件即可恢复未完成的推送。已完成记录过多时重写文件进行压缩。
+    暂存区已满时 put 会阻塞调用方(背压)，超时后放弃该条推送。
+    """
+
+    def __init__(self, path: str, max_entries: int = 50000, compact_threshold: int = 10000):
+        """
+        :param path: 追加写入的暂存文件路径
+        :param max_entries: 暂存区最多保存的推送条数
+        :param compact_threshold: 文件中已完成的记录超过该数量时压缩文件
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.compact_threshold = compact_threshold
+        self.__entries = {}  # {id: entry}
+        self.__next_id = 1
+        self.__dead_records = 0
+        self.__corrupted = False  # 文件中有写了一半的记录，需要重写后才能继续追加
+        self.__cond = threading.Condition()
+        self.dropped = 0  # 因暂存区已满被放弃的推送数
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        self.__file = open(self.path, "a", encoding="utf-8")
+        if self.__dead_records or self.__corrupted:
+            self._compact()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # 进程崩溃时最后一行可能只写了一半，直接追加会与下一条记录写在同一行
+                    self.__corrupted = True
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping corrupted APNs spool record in {self.path}")
+                    self.__corrupted = True
+                    continue
+                entry_id = record["id"]
+                self.__next_id = max(self.__next_id, entry_id + 1)
+                if record["op"] == "add":
+                    record.pop("op")
+                    self.__entries[entry_id] = record
+                else:
+                    self.__entries.pop(entry_id, None)
+                    self.__dead_records += 2
+        if self.__entries:
+            logger.info(f"Recovered {len(self.__entries)} pending APNs pushes from {self.path}")
+
+    def _write(self, record: dict):
+        self.__file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.__file.flush()
+
+    def _compact(self):
+        """只保留未完成的记录，写入临时文件后原子替换"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self.__entries.values():
+                f.write(json.dumps({"op": "add", **entry}, ensure_ascii=False) + "\n")
+        self.__file.close()
+        os.replace(tmp_path, self.path)
+        self.__file = open(self.path, "a", encoding="utf-8")
+        self.__dead_records = 0
+        self.__corrupted = False
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def pending(self) -> list[dict]:
+        """
+        :return: 当前所有未完成的推送(用于重启后重新发送)
+        """
+        with self.__cond:
+            return list(self.__entries.values())
+
+    def put(self, device_token: str, user_name: str, msg: str, user_id: int, timeout: float = 1.0,
+            badge: int = None) -> int | None:
+        """
+        写入一条推送，暂存区已满时最多阻塞 timeout 秒
+        :param badge: 推送的角标数，为空时按合并的推送条数显示
+        :return: 推送id，超时未能写入时返回None
+        """
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: len(self.__entries) < self.max_entries, timeout):
+                self.dropped += 1
+                return None
+            entry_id = self.__next_id
+            self.__next_id += 1
+            entry = {"id": entry_id, "token": device_token, "user_name": user_name, "msg": msg, "user_id": user_id}
+            if badge is not None:
+                entry["badge"] = badge
+            self.__entries[entry_id] = entry
+            self._write({"op": "add", **entry})
+            return entry_id
+
+    def done(self, entry_ids: list[int]):
+        """标记推送已完成(成功发送或放弃)，释放暂存区空间"""
+        with self.__cond:
+            for entry_id in entry_ids:
+                if self.__entries.pop(entry_id, None) is not None:
+                    self._write({"op": "done", "id": entry_id})
+                    self.__dead_records += 2
+            if self.__dead_records >= self.compact_threshold:
+                self._compact()
+            self.__cond.notify_all()
+
+    def close(self):
+        with self.__cond:
+            if self.__dead_records:
+                self._compact()
+            self.__file.close()
@@ -0,0 +1,129 @@
+"""
+全体消息(to_id == -1)的并行投递：消息帧只编码一次，会话表的每个分段作为一个任务交给若干写线程，
+每个会话的发送都是非阻塞的(内核缓冲区满时进入发送积压)，单个慢连接不会拖住整次广播。
+每次广播的进度与完成耗时可以从 /debug/broadcast 查看。
+"""
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Utils.color_logger import get_logger
+from Utils.metrics import registry
+
+logger = get_logger(__name__)
+
+BROADCAST_SECONDS = registry.histogram("betterfly_broadcast_seconds", "Time to hand a broadcast to every session")
+BROADCAST_RECIPIENTS = registry.counter("betterfly_broadcast_recipients_total", "Broadcast recipients by result",
+                                        ("result",))
+BROADCAST_HISTORY = 20  # /debug/broadcast 保留的最近广播数
+
+
+class BroadcastJob:
+    """一次广播的进度，各计数只在持有 lock 时修改"""
+
+    def __init__(self, job_id: int, total: int, shards: int):
+        self.id = job_id
+        self.total = total
+        self.delivered = 0  # 已发出或已进入发送积压
+        self.dropped = 0  # 接收方发送积压已满
+        self.failed = 0  # 连接出错
+        self.shards_left = shards
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    @property
+    def progress(self) -> float:
+        return (self.delivered + self.dropped + self.failed) / self.total if self.total else 1.0
+
+    def to_dict(self) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        return {"id": self.id, "total": self.total, "delivered": self.delivered, "dropped": self.dropped,
+                "failed": self.failed, "progress": round(self.progress, 4), "done": self.finished is not None,
+                "elapsed_ms": round((end - self.started) * 1000, 3)}
+
+
+class Broadcaster:
+    def __init__(self, deliver, on_error, writers: int = 4):
+        """
+        :param deliver: deliver(session, data) -> bool，非阻塞地发送给一个会话，被丢弃时返回False
+        :param on_error: on_error(session, exc)，发送出错的会话
+        :param writers: 并行写线程数
+        """
+        self.deliver = deliver
+        self.on_error = on_error
+        self.executor = ThreadPoolExecutor(max_workers=max(1, writers), thread_name_prefix="broadcast")
+        self.jobs = collections.deque(maxlen=BROADCAST_HISTORY)
+        self.__ids = itertools.count(1)
+        self.__retired = []  # 调整线程数后被替换、仍在完成已提交广播的线程池
+
+    def submit(self, shards: list[list], data: bytes) -> BroadcastJob:
+        """
+        :param shards: 按会话表分段的接收会话，每段由一个写线程处理
+        :param data: 已编码的消息帧
+        """
+        shards = [shard for shard in shards if shard]
+        job = BroadcastJob(next(self.__ids), sum(len(shard) for shard in shards), len(shards))
+        self.jobs.append(job)
+        if not shards:
+            self._finish(job)
+            return job
+        for shard in shards:
+            try:
+                self.executor.submit(self._write_shard, job, shard, data)
+            except RuntimeError:  # 线程池刚被 resize 替换
+                self.executor.submit(self._write_shard, job, shard, data)
+        return job
+
+    def _write_shard(self, job: BroadcastJob, sessions: list, data: bytes):
+        delivered = dropped = failed = 0
+        for session in sessions:
+            try:
+                if self.deliver(session, data):
+                    delivered += 1
+                else:
+                    dropped += 1
+            except OSError as e:
+                failed += 1
+                self.on_error(session, e)
+        with job.lock:
+            job.delivered += delivered
+            job.dropped += dropped
+            job.failed += failed
+            job.shards_left -= 1
+            last = job.shards_left == 0
+        if last:
+            self._finish(job)
+
+    def _finish(self, job: BroadcastJob):
+        job.finished = time.monotonic()
+        elapsed = job.finished - job.started
+        BROADCAST_SECONDS.observe(elapsed)
+        BROADCAST_RECIPIENTS.inc("delivered", amount=job.delivered)
+        BROADCAST_RECIPIENTS.inc("dropped", amount=job.dropped)
+        BROADCAST_RECIPIENTS.inc("failed", amount=job.failed)
+        logger.info(f"Broadcast #{job.id} to {job.total} sessions finished in {elapsed * 1000:.1f} ms "
+                    f"({job.delivered} delivered, {job.dropped} dropped, {job.failed} failed)")
+        job.done.set()
+
+    def resize(self, writers: int):
+        """调整写线程数，进行中的广播在旧的线程池中继续完成"""
+        old = self.executor
+        self.executor = ThreadPoolExecutor(max_workers=max(1, writers), thread_name_prefix="broadcast")
+        self.__retired.append(old)
+        old.shutdown(wait=False)
+
+    def active(self) -> int:
+        return sum(1 for job in list(self.jobs) if job.finished is None)
+
+    def recent(self) -> list[dict]:
+        return [job.to_dict() for job in list(self.jobs)]
+
+    def stop(self):
+        """等待已提交的广播写完"""
+        self.executor.shutdown(wait=True)
+        for executor in self.__retired:
+            executor.shutdown(wait=True)
@@ -0,0 +1,423 @@
+"""
+集群模式：多个网关节点各自持有一部分客户端连接，通过节点间消息总线转发消息。
+
+- PresenceRegistry：每个节点保存一份 {user_id: 所在节点} 的副本，本节点用户上下线时广播给其他节点，
+  其他节点连上本节点时与定期发送全量快照，节点断开时清除其用户
+- MessageBus：可替换的节点间消息总线接口，SocketBus 为基于 TCP/Unix socket 的实现
+- Cluster：按接收方所在节点把单聊、群聊的投递合并为每个节点一条转发消息
+"""
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from Utils.color_logger import get_logger
+from Utils.metrics import SIZE_BUCKETS, registry
+
+logger = get_logger(__name__)
+
+FORWARDED = registry.counter("betterfly_cluster_forwarded_total", "Messages forwarded to other nodes", ("node",))
+FORWARD_BATCH = registry.histogram("betterfly_cluster_batch_messages", "Bus messages per batch written to a peer",
+                                   buckets=SIZE_BUCKETS)
+BUS_DROPPED = registry.counter("betterfly_cluster_dropped_total", "Bus messages dropped because a peer queue was full",
+                               ("node",))
+
+MAX_BATCH = 512  # 每批最多合并的消息数
+MAX_BATCH_BYTES = 256 * 1024
+MAX_FRAME = 64 * 1024 * 1024
+RECONNECT_DELAYS = (0.2, 0.5, 1, 2, 5)
+SNAPSHOT_INTERVAL = 30  # 定期交换全量在线快照的间隔(秒)，修正丢失的上下线消息
+
+
+def parse_address(address: str) -> tuple:
+    """
+    :param address: "tcp://host:port" 或 "unix:///path/to/socket"
+    :return: (socket family, 地址)
+    """
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"Unsupported bus address {address!r}")
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes | None:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class MessageBus:
+    """
+    节点间消息总线接口。消息为可JSON序列化的dict，同一对节点之间保证顺序。
+    实现需保证 send/broadcast 不阻塞调用方
+    """
+    node_id: str = ""
+
+    def start(self, handler, on_peer_change=None):
+        """
+        :param handler: handler(from_node, message)，在总线的接收线程中调用
+        :param on_peer_change: on_peer_change(node, connected)，与其他节点的连接建立或断开时调用
+        """
+        raise NotImplementedError
+
+    def peers(self) -> list[str]:
+        raise NotImplementedError
+
+    def send(self, node: str, message: dict):
+        raise NotImplementedError
+
+    def broadcast(self, message: dict):
+        for node in self.peers():
+            self.send(node, message)
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class _Peer:
+    """到一个节点的出站连接，后台线程把排队的消息合并成批写出，断开后自动重连"""
+
+    def __init__(self, bus: "SocketBus", node: str, address: str, max_queue: int):
+        self.bus = bus
+        self.node = node
+        self.address = address
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.connected = False
+        self.thread = threading.Thread(target=self._run, name=f"bus-{node}", daemon=True)
+
+    def put(self, message: dict):
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                self.queue.popleft()
+                BUS_DROPPED.inc(self.node)
+            self.queue.append(message)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def _connect(self) -> socket.socket | None:
+        family, address = parse_address(self.address)
+        for attempt in range(len(RECONNECT_DELAYS) + 1):
+            if not self.running:
+                return None
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                if family == socket.AF_INET:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(self.bus.encode([{"t": "hello", "node": self.bus.node_id}]))
+                return sock
+            except OSError:
+                sock.close()
+                time.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+        return None
+
+    def _run(self):
+        sock = None
+        while self.running:
+            if sock is None:
+                sock = self._connect()
+                if sock is None:
+                    continue
+                self.connected = True
+                logger.info(f"Connected to cluster node {self.node} at {self.address}")
+                self.bus.peer_changed(self.node, True)
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                batch, size = [], 0
+                while self.queue and len(batch) < MAX_BATCH and size < MAX_BATCH_BYTES:
+                    message = self.queue.popleft()
+                    batch.append(message)
+                    size += len(message.get("frame", "")) + 64
+            if not batch:
+                continue
+            try:
+                sock.sendall(self.bus.encode(batch))
+                FORWARD_BATCH.observe(len(batch))
+            except OSError as e:
+                logger.warning(f"Lost connection to cluster node {self.node}: {e}")
+                with self.cond:
+                    self.queue.extendleft(reversed(batch))  # 重连后按原顺序重发
+                sock.close()
+                sock = None
+                self.connected = False
+                self.bus.peer_changed(self.node, False)
+        if sock is not None:
+            sock.close()
+
+
+class SocketBus(MessageBus):
+    """
+    基于 TCP 或 Unix socket 的消息总线。每对节点之间各有一条出站连接，
+    每批消息编码为 4 字节长度 + JSON {"from": 节点, "msgs": [...]}
+    """
+
+    def __init__(self, node_id: str, listen: str, peers: dict, max_queue: int = 100000):
+        """
+        :param node_id: 本节点名
+        :param listen: 本节点监听地址，如 "tcp://0.0.0.0:7100" 或 "unix:///tmp/betterfly-a.sock"
+        :param peers: {节点名: 地址}
+        :param max_queue: 每个节点的待发送队列上限，超过后丢弃最旧的消息
+        """
+        self.node_id = node_id
+        self.listen = listen
+        self.__peers = {node: _Peer(self, node, address, max_queue)
+                        for node, address in peers.items() if node != node_id}
+        self.__handler = None
+        self.__on_peer_change = None
+        self.__server = None
+        self.__running = False
+
+    def encode(self, messages: list) -> bytes:
+        data = json.dumps({"from": self.node_id, "msgs": messages}, separators=(",", ":")).encode()
+        return struct.pack(">I", len(data)) + data
+
+    def peers(self) -> list[str]:
+        return list(self.__peers)
+
+    def connected_peers(self) -> list[str]:
+        return [node for node, peer in self.__peers.items() if peer.connected]
+
+    def queued(self) -> dict:
+        return {node: len(peer.queue) for node, peer in self.__peers.items()}
+
+    def start(self, handler, on_peer_change=None):
+        self.__handler = handler
+        self.__on_peer_change = on_peer_change
+        self.__running = True
+        family, address = parse_address(self.listen)
+        self.__server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        else:
+            self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind(address)
+        self.__server.listen(64)
+        threading.Thread(target=self._accept_loop, name="bus-accept", daemon=True).start()
+        for peer in self.__peers.values():
+            peer.thread.start()
+        logger.info(f"Cluster node {self.node_id} listening on {self.listen}, peers: {', '.join(self.__peers)}")
+
+    def peer_changed(self, node: str, connected: bool):
+        if self.__on_peer_change is not None:
+            self.__on_peer_change(node, connected)
+
+    def send(self, node: str, message: dict):
+        peer = self.__peers.get(node)
+        if peer is None:
+            logger.warning(f"Unknown cluster node {node}")
+            return
+        peer.put(message)
+
+    def stop(self):
+        self.__running = False
+        for peer in self.__peers.values():
+            peer.stop()
+        if self.__server is not None:
+            self.__server.close()
+            if self.__server.family == socket.AF_UNIX:
+                try:
+                    os.unlink(parse_address(self.listen)[1])
+                except OSError:
+                    pass
+
+    def _accept_loop(self):
+        while self.__running:
+            try:
+                conn, _ = self.__server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read_loop, args=(conn,), name="bus-reader", daemon=True).start()
+
+    def _read_loop(self, conn: socket.socket):
+        node = None
+        try:
+            while True:
+                header = _recv_exact(conn, 4)
+                if header is None:
+                    break
+                size = struct.unpack(">I", header)[0]
+                if size > MAX_FRAME:
+                    raise ValueError(f"bus frame of {size} bytes")
+                data = _recv_exact(conn, size)
+                if data is None:
+                    break
+                batch = json.loads(data)
+                node = batch["from"]
+                for message in batch["msgs"]:
+                    try:
+                        self.__handler(node, message)
+                    except Exception as e:
+                        logger.error(f"Error handling bus message from {node}: {e}", exc_info=True)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cluster connection from {node} failed: {e}")
+        finally:
+            conn.close()
+            if node is not None and self.__running:
+                # 对方进程退出或网络中断，由上层清除该节点的在线用户
+                self.peer_changed(node, False)
+
+
+class PresenceRegistry:
+    """在线用户所在节点的副本，一个用户的多个设备可能分布在不同节点"""
+
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+        self.__lock = threading.Lock()
+        self.__by_user = {}  # {UserID: frozenset(节点)}
+        self.__by_node = collections.defaultdict(set)  # {节点: {UserID}}
+
+    def __len__(self):
+        return len(self.__by_user)
+
+    def set(self, user_id: int, node: str, online: bool):
+        with self.__lock:
+            nodes = self.__by_user.get(user_id, frozenset())
+            nodes = nodes | {node} if online else nodes - {node}
+            if nodes:
+                self.__by_user[user_id] = nodes
+            else:
+                self.__by_user.pop(user_id, None)
+            if online:
+                self.__by_node[node].add(user_id)
+            else:
+                self.__by_node[node].discard(user_id)
+
+    def replace_node(self, node: str, user_ids):
+        """用全量快照替换一个节点的在线用户，user_ids 为空表示清除该节点"""
+        users = set(user_ids)
+        with self.__lock:
+            old = self.__by_node.pop(node, set())
+            for user_id in old - users:
+                nodes = self.__by_user.get(user_id, frozenset()) - {node}
+                if nodes:
+                    self.__by_user[user_id] = nodes
+                else:
+                    self.__by_user.pop(user_id, None)
+            for user_id in users - old:
+                self.__by_user[user_id] = self.__by_user.get(user_id, frozenset()) | {node}
+            if users:
+                self.__by_node[node] = users
+
+    def users_on(self, node: str) -> list:
+        with self.__lock:
+            return list(self.__by_node.get(node, ()))
+
+    def nodes_of(self, user_id: int) -> frozenset:
+        return self.__by_user.get(user_id, frozenset())
+
+    def push_owner(self, user_id: int) -> str | None:
+        """用户在多个节点在线时，由名字最小的节点负责是否推送的决定，避免重复推送"""
+        nodes = self.__by_user.get(user_id)
+        return min(nodes) if nodes else None
+
+    def node_counts(self) -> dict:
+        with self.__lock:
+            return {node: len(users) for node, users in self.__by_node.items()}
+
+
+class Cluster:
+    """把消息转发给接收方所在的其他节点"""
+
+    def __init__(self, bus: MessageBus, on_deliver, on_deliver_all):
+        """
+        :param on_deliver: on_deliver(message: dict)，其他节点转发来的投递，message 含 users/push_users/frame
+        :param on_deliver_all: on_deliver_all(frame: bytes)，其他节点转发来的全体消息
+        """
+        self.bus = bus
+        self.node_id = bus.node_id
+        self.presence = PresenceRegistry(self.node_id)
+        self.on_deliver = on_deliver
+        self.on_deliver_all = on_deliver_all
+        self.local_users = None  # 返回本节点在线用户列表的函数，用于发送快照
+
+    def start(self, local_users):
+        self.local_users = local_users
+        self.bus.start(self.handle, self.on_peer_change)
+
+    def stop(self):
+        self.bus.stop()
+
+    def on_presence(self, user_id: int, online: bool):
+        """本节点用户的第一个设备上线或最后一个设备下线(SessionRegistry 回调，不能阻塞)"""
+        self.presence.set(user_id, self.node_id, online)
+        self.bus.broadcast({"t": "presence", "user": user_id, "online": online})
+
+    def on_peer_change(self, node: str, connected: bool):
+        if not connected:
+            logger.warning(f"Cluster node {node} is unreachable, clearing its presence")
+            self.presence.replace_node(node, ())
+
+    def send_snapshot(self, node: str = None):
+        message = {"t": "snapshot", "users": self.local_users()}
+        if node is None:
+            self.bus.broadcast(message)
+        else:
+            self.bus.send(node, message)
+
+    def handle(self, node: str, message: dict):
+        kind = message.get("t")
+        if kind == "deliver":
+            self.on_deliver(message)
+        elif kind == "presence":
+            self.presence.set(message["user"], node, message["online"])
+        elif kind == "snapshot":
+            self.presence.replace_node(node, message["users"])
+        elif kind == "deliver_all":
+            self.on_deliver_all(message["frame"].encode())
+        elif kind == "hello":
+            # 对方(可能是刚重启的节点)已连上本节点，把本节点的在线用户发给它；
+            # 本节点到对方的旧连接若已失效，发送失败后会重连并重发
+            self.send_snapshot(node)
+        else:
+            logger.warning(f"Unknown bus message {kind!r} from {node}")
+
+    def route(self, user_ids: list, frame: bytes, meta: dict) -> tuple[list, set]:
+        """
+        把投递按接收方所在节点分组，每个节点只转发一条消息
+        :param frame: 已编码的消息帧
+        :param meta: 随转发消息附带的推送信息 {"push", "from_id", "msg", "msg_type", "to_id", "is_group"}
+        :return: (需要在本节点处理的用户(在本节点在线或不在任何节点在线)，由其他节点负责推送决定的用户)
+        """
+        local, delegated = [], set()
+        by_node = collections.defaultdict(list)
+        for user_id in user_ids:
+            nodes = self.presence.nodes_of(user_id)
+            if not nodes or self.node_id in nodes:
+                local.append(user_id)
+            for node in nodes:
+                if node != self.node_id:
+                    by_node[node].append(user_id)
+        if not by_node:
+            return local, delegated
+        text = frame.decode()
+        for node, users in by_node.items():
+            push_users = [u for u in users if self.presence.push_owner(u) == node]
+            delegated.update(push_users)
+            self.bus.send(node, dict(meta, t="deliver", users=users, push_users=push_users, frame=text))
+            FORWARDED.inc(node)
+        return local, delegated
+
+    def route_all(self, frame: bytes):
+        """全体消息转发给所有节点"""
+        self.bus.broadcast({"t": "deliver_all", "frame": frame.decode()})
@@ -1,5 +1,14 @@
+import atexit
+import json
 import logging
+import queue
+import random
 import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "[%(asctime)s] - %(levelname)s - %(message)s"
+MAX_BATCH = 512  # 后台线程一次最多合并写出的日志条数
 
 
 class Color:
@@ -11,32 +20,216 @@ class Color:
     END = "\033[0m"
 
 
-# 自定义日志处理器
-class ColorHandler(logging.StreamHandler):
+LEVEL_COLORS = {
+    logging.DEBUG: Color.BLUE,
+    logging.INFO: Color.GREEN,
+    logging.WARNING: Color.YELLOW,
+    logging.ERROR: Color.RED,
+}
+
+
+class Lazy:
+    """
+    延迟求值的日志参数，只有日志真正被输出时才在后台线程调用 func(*args)
+    例: logger.debug("Sent %s", Lazy(message.to_json_str))
+    """
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class ColorFormatter(logging.Formatter):
+    """按日志级别给整行加颜色"""
+
+    def format(self, record):
+        log_entry = super().format(record)
+        color = LEVEL_COLORS.get(record.levelno)
+        return f"{color}{log_entry}{Color.END}" if color else log_entry
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，附加字段来自 extra={"fields": {...}}"""
+
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname, "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    只把日志记录放入队列，不在调用方线程格式化消息，格式化与写出都交给后台的 QueueListener。
+    因此日志参数应为不可变值，或记录后不再被修改的对象。
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            # traceback 只在当前栈上有效，先转为文本
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """
+    运行在 QueueListener 线程中，格式化后先放入缓冲区，
+    队列已空或缓冲区已满时才一次性写出并 flush
+    """
+
+    def __init__(self, stream, log_queue, max_batch: int = MAX_BATCH):
+        super().__init__(stream)
+        self.log_queue = log_queue
+        self.max_batch = max_batch
+        self.buffer = []
+
     def emit(self, record):
-        log_entry = self.format(record)
-        if record.levelno == logging.DEBUG:
-            log_entry = f"{Color.BLUE}{log_entry}{Color.BLUE}"
-        elif record.levelno == logging.INFO:
-            log_entry = f"{Color.GREEN}{log_entry}{Color.END}"
-        elif record.levelno == logging.WARNING:
-            log_entry = f"{Color.YELLOW}{log_entry}{Color.END}"
-        elif record.levelno == logging.ERROR:
-            log_entry = f"{Color.RED}{log_entry}{Color.END}"
-        sys.stdout.write(log_entry + "\n")
-        sys.stdout.flush()
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+        if len(self.buffer) >= self.max_batch or self.log_queue.empty():
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.buffer:
+                self.stream.write("\n".join(self.buffer) + "\n")
+                self.buffer.clear()
+            super().flush()
+
+
+class MessageLog:
+    """
+    逐条消息的结构化日志(JSON行)，按采样率记录。
+    未启用时 record 只做一次属性判断
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.__logger = None
+
+    def configure(self, logger: logging.Logger | None, sample_rate: float = 1.0):
+        self.__logger = logger
+        self.sample_rate = sample_rate
+        self.enabled = logger is not None and sample_rate > 0
+
+    def record(self, event: str, **fields):
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return
+        self.__logger.info(event, extra={"fields": fields})
+
+
+message_log = MessageLog()
+
+_log_queue = queue.SimpleQueue()
+_listeners = []
+_loggers = {}  # {name: 调用 get_logger 时指定的级别}
+_level_override = None
+_json_path = None
+_json_listener = None  # 逐条消息日志的 (listener, handler)，更换文件时停止并关闭
+_lock = threading.RLock()
+
+
+def _start_listener(log_queue, handler: logging.Handler):
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    _listeners.append((listener, handler))
+    if len(_listeners) == 1:
+        atexit.register(stop_logging)
+
+
+def _stop_json_listener():
+    """停止逐条消息日志的写线程，写出剩余日志并关闭文件，需持有 _lock"""
+    global _json_listener, _json_path
+    _json_path = None
+    if _json_listener is None:
+        return
+    listener, handler = _json_listener
+    _json_listener = None
+    _listeners.remove((listener, handler))
+    listener.stop()
+    handler.flush()
+    handler.stream.close()
+    handler.close()
+
+
+def _ensure_listener():
+    with _lock:
+        if not _listeners:
+            handler = BatchStreamHandler(sys.stdout, _log_queue)
+            handler.setFormatter(ColorFormatter(LOG_FORMAT))
+            _start_listener(_log_queue, handler)
+
+
+def stop_logging():
+    """停止后台写日志线程并写出剩余的日志"""
+    with _lock:
+        message_log.configure(None)
+        _stop_json_listener()
+        while _listeners:
+            listener, handler = _listeners.pop()
+            listener.stop()
+            handler.flush()
 
 
 def get_logger(name: str, level=logging.INFO) -> logging.Logger:
     logger = logging.getLogger(name)
-    logger.setLevel(level)
+    _ensure_listener()
+    with _lock:
+        _loggers[name] = level
+        logger.setLevel(_level_override if _level_override is not None else level)
 
-    # 添加自定义处理器
-    color_handler = ColorHandler()
-    # color_handler.setLevel(level)
-    formatter = logging.Formatter("[%(asctime)s] - %(levelname)s - %(message)s")
-    color_handler.setFormatter(formatter)
+    # 添加异步队列处理器
     logger.propagate = False
     logger.handlers.clear()
-    logger.addHandler(color_handler)
+    logger.addHandler(LazyQueueHandler(_log_queue))
     return logger
+
+
+def configure_logging(level=None, json_path: str | None = None, sample_rate: float = 1.0):
+    """
+    根据配置统一设置日志
+    :param level: 所有 get_logger 创建的日志器的级别，如 "DEBUG"，None 表示保持各自的默认级别
+    :param json_path: 逐条消息结构化日志(JSON行)的文件路径，None 表示不记录
+    :param sample_rate: 逐条消息日志的采样率 0~1
+    """
+    global _level_override, _json_path, _json_listener
+    _ensure_listener()
+    with _lock:
+        _level_override = logging.getLevelName(level) if isinstance(level, str) else level
+        for name, default in _loggers.items():
+            logging.getLogger(name).setLevel(_level_override if _level_override is not None else default)
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(LazyQueueHandler(_log_queue))
+    if _level_override is not None:
+        root.setLevel(_level_override)
+
+    with _lock:
+        if json_path is not None and json_path == _json_path:  # 服务器重建时沿用已打开的文件
+            message_log.configure(logging.getLogger("betterfly.messages"), sample_rate)
+            return
+        # 更换文件或关闭记录时，先停止记录再停止旧的写线程并关闭旧文件
+        message_log.configure(None)
+        _stop_json_listener()
+        if json_path is None:
+            return
+        _json_path = json_path
+        json_queue = queue.SimpleQueue()
+        handler = BatchStreamHandler(open(json_path, "a", encoding="utf-8"), json_queue)
+        handler.setFormatter(JsonFormatter())
+        _start_listener(json_queue, handler)
+        _json_listener = _listeners[-1]
+    json_logger = logging.getLogger("betterfly.messages")
+    json_logger.setLevel(logging.INFO)
+    json_logger.propagate = False
+    json_logger.handlers.clear()
+    json_logger.addHandler(LazyQueueHandler(json_queue))
+    message_log.configure(json_logger, sample_rate)
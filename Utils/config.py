@@ -1,7 +1,33 @@
 import json
+import os
+import resource
+
+CPU_COUNT = os.cpu_count() or 1
+FD_RESERVE = 64  # 为监听 socket、日志文件、epoll 等预留的描述符数
+
+
+def fd_limit() -> int:
+    """:return: 进程可打开的文件描述符数(RLIMIT_NOFILE 软限制)"""
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return 1 << 20 if soft == resource.RLIM_INFINITY else soft
+
+
+def somaxconn() -> int:
+    """:return: 内核允许的最大 listen backlog"""
+    try:
+        with open('/proc/sys/net/core/somaxconn', 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 128
 
 
 class Config:
+    # 修改后需要重启才能生效的配置项，其余配置项在收到 SIGHUP 时重新加载
+    RESTART_REQUIRED = frozenset({
+        'ip', 'port', 'listen_backlog', 'apns_sandbox', 'apns_spool_path', 'apns_spool_max', 'metrics_port',
+        'metrics_host', 'handoff_path', 'cluster_node_id', 'cluster_listen', 'cluster_peers', 'cluster_queue_max',
+        'profile_dir', 'search_index_path'})
+
     def __init__(self, path: str):
         """
         :param path: 配置文件路径
@@ -11,6 +37,106 @@ class Config:
             data = json.load(f)
             self.ip = data['ip']
             self.port = data['port']
+            # 性能相关参数，默认值按 CPU 核数与描述符上限计算：
+            # 工作线程处理请求(多数时间在等数据库)，数据库连接池比工作线程多出登录与推迟任务线程所需的连接；
+            # 最大连接数为描述符上限减去数据库连接与预留，超过后新连接会被立即关闭
+            self.worker_threads = data.get('worker_threads', min(64, 8 + CPU_COUNT * 4))
+            self.db_pool_size = data.get('db_pool_size', self.worker_threads + 2)
+            self.db_pool_min_cached = data.get('db_pool_min_cached', min(4, self.db_pool_size))
+            self.listen_backlog = data.get('listen_backlog', min(somaxconn(), 1024))
+            self.recv_buffer_size = data.get('recv_buffer_size', 64 * 1024)
+            self.max_connections = data.get('max_connections', max(fd_limit() - self.db_pool_size - FD_RESERVE, 1))
+            # APNs 是否使用沙盒环境
+            self.apns_sandbox = data.get('apns_sandbox', False)
+            # APNs推送暂存文件，默认与配置文件放在同一目录
+            self.apns_spool_path = data.get('apns_spool_path',
+                                            os.path.join(os.path.dirname(os.path.abspath(path)), 'apns_spool.jsonl'))
+            self.apns_spool_max = data.get('apns_spool_max', 50000)
+            # 在线用户空闲超过该时间(秒)后，即使连接仍在也会收到推送
+            self.push_idle_threshold = data.get('push_idle_threshold', 300)
+            # 日志级别；逐条消息的JSON行日志文件(为空则不记录)及其采样率
+            self.log_level = data.get('log_level', 'INFO')
+            self.log_json_path = data.get('log_json_path')
+            self.log_sample_rate = data.get('log_sample_rate', 1.0)
+            # Prometheus 指标HTTP端口，为空则不开启
+            self.metrics_port = data.get('metrics_port')
+            self.metrics_host = data.get('metrics_host', '127.0.0.1')
+            # 连接超时(秒)：login_timeout 内未登录、heartbeat_timeout 内未收到任何数据(含Ping)、
+            # idle_timeout 内除心跳外没有任何请求(为空则不限制)的连接会被关闭
+            self.login_timeout = data.get('login_timeout', 10)
+            self.heartbeat_timeout = data.get('heartbeat_timeout', 120)
+            self.idle_timeout = data.get('idle_timeout')
+            # 请求追踪：trace_requests 记录每个请求的阶段耗时，slow_request_ms 只记录超过阈值的慢请求
+            self.trace_requests = data.get('trace_requests', False)
+            self.slow_request_ms = data.get('slow_request_ms')
+            # 收到 SIGUSR2 时采样 profile_seconds 秒，调用栈写入 profile_dir
+            self.profile_seconds = data.get('profile_seconds', 10)
+            self.profile_dir = data.get('profile_dir', os.path.join(os.path.dirname(os.path.abspath(path)), 'profiles'))
+            # 按用户与请求类型限流 {"Post": [每秒请求数, 突发上限], ...}，未列出的类型不限流
+            self.rate_limits = data.get('rate_limits', {
+                "Post": [20, 60], "QueryUser": [20, 60], "QueryGroup": [20, 60],
+                "File": [10, 30], "FileBatch": [2, 10], "UpdateAvatar": [1, 5], "History": [10, 30],
+                "Search": [2, 10], "ReadAck": [20, 60]})
+            # 每个连接发送积压的上限(字节)，超过后按 slow_consumer_policy(drop/disconnect/push_only)处理
+            self.outbound_queue_max = data.get('outbound_queue_max', 1 << 20)
+            self.slow_consumer_policy = data.get('slow_consumer_policy', 'push_only')
+            # 过载保护：各信号的 [开始降级阈值, 拒绝新登录阈值]，分别为执行器排队任务数、
+            # 近期平均数据库连接池等待(毫秒)、事件循环每轮平均耗时(毫秒)
+            self.admission_backlog = data.get('admission_backlog', [64, 256])
+            self.admission_db_wait_ms = data.get('admission_db_wait_ms', [20, 100])
+            self.admission_loop_lag_ms = data.get('admission_loop_lag_ms', [20, 100])
+            # 负载持续低于阈值多久(秒)后才恢复；降级时丢弃(shed)与推迟(defer)处理的请求类型
+            self.admission_cooldown = data.get('admission_cooldown', 5)
+            self.admission_shed_types = data.get('admission_shed_types', ["QueryUser", "QueryGroup", "File", "FileBatch",
+                                                                       "History", "Search"])
+            self.admission_defer_types = data.get('admission_defer_types', ["UpdateAvatar", "APNsToken"])
+            self.deferred_queue_max = data.get('deferred_queue_max', 10000)
+            # 平滑重启：新进程通过该 Unix socket 从旧进程接管所有连接，为空则不开启
+            self.handoff_path = data.get('handoff_path',
+                                         os.path.join(os.path.dirname(os.path.abspath(path)), 'betterfly-handoff.sock'))
+            # 全体消息(to_id == -1)的并行写线程数
+            self.broadcast_writers = data.get('broadcast_writers', min(8, max(2, CPU_COUNT)))
+            # 集群模式：本节点名(为空则单机运行)、节点间消息总线监听地址(tcp://host:port 或 unix:///path)、
+            # 其他节点 {节点名: 地址}，以及每个节点待转发消息的队列上限
+            self.cluster_node_id = data.get('cluster_node_id')
+            self.cluster_listen = data.get('cluster_listen')
+            self.cluster_peers = data.get('cluster_peers', {})
+            self.cluster_queue_max = data.get('cluster_queue_max', 100000)
+            # 历史消息缓存：缓存最近访问的会话数、每个会话缓存的最新消息数与缓存有效期(秒)
+            self.history_cache_conversations = data.get('history_cache_conversations', 1024)
+            self.history_cache_messages = data.get('history_cache_messages', 100)
+            self.history_cache_ttl = data.get('history_cache_ttl', 30)
+            # 全文检索索引目录(为空则不开启搜索)、内存表写成段文件的消息数与触发后台合并的段数；
+            # 索引中保存了消息原文，应放在仓库之外的数据目录(如 /var/lib/betterfly/search_index)
+            self.search_index_path = data.get('search_index_path')
+            self.search_segment_docs = data.get('search_segment_docs', 50000)
+            self.search_max_segments = data.get('search_max_segments', 8)
+            # 未读数：常驻内存的用户数上限、载入后重新从数据库读取的间隔(秒)与批量写入数据库的间隔(秒)
+            self.unread_cache_users = data.get('unread_cache_users', 100000)
+            self.unread_cache_ttl = data.get('unread_cache_ttl', 300)
+            self.unread_flush_interval = data.get('unread_flush_interval', 1.0)
+            # Post 去重：识别重发消息的窗口(秒)、每个用户一代最多记录的 client_msg_id 数与最多记录的用户数
+            self.post_dedup_window = data.get('post_dedup_window', 120)
+            self.post_dedup_per_user = data.get('post_dedup_per_user', 256)
+            self.post_dedup_users = data.get('post_dedup_users', 100000)
+
+    def reload(self) -> tuple[dict, list]:
+        """
+        重新读取配置文件，更新可在线修改的配置项
+        :return: ({已更新的配置项: (旧值, 新值)}, 已修改但需要重启才能生效的配置项)
+        """
+        new = Config(self.path)
+        changed, ignored = {}, []
+        for key, value in vars(new).items():
+            old = getattr(self, key, None)
+            if old == value:
+                continue
+            if key in self.RESTART_REQUIRED:
+                ignored.append(key)
+                continue
+            setattr(self, key, value)
+            changed[key] = (old, value)
+        return changed, ignored
 
 
 class COSConfig:
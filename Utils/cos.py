@@ -1,4 +1,11 @@
+import hashlib
+import hmac
+import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlencode
 
 from qcloud_cos import CosConfig, CosS3Client
 
@@ -11,13 +18,77 @@ root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 config_dir = os.path.join(root_dir, "Config")
 config_fp = os.path.join(config_dir, 'cos_config.json')
 
+DEFAULT_PART_SIZE = 8 * 1024 * 1024  # 分块上传/分段下载的块大小，COS要求除最后一块外不小于1MB
+DEFAULT_WORKERS = 4  # 分块传输的并发数
+STREAM_CHUNK_SIZE = 1024 * 1024  # 下载时每次从网络读取并写入文件的大小
+
+
+class COSSigner:
+    """
+    本地计算 COS 预签名链接(XML API v5 的 sha1 签名)，不经过 SDK 构造请求对象。
+    结果与 CosS3Client.get_presigned_url(SignHost=False) 一致。
+    签名算法参见 https://cloud.tencent.com/document/product/436/7778
+    """
+
+    def __init__(self, secret_id: str, secret_key: str, region: str, scheme: str = "https"):
+        self.secret_id = secret_id
+        self.secret_key = secret_key.encode()
+        self.endpoint = f"cos.{region}.myqcloud.com"
+        self.scheme = scheme
+
+    @staticmethod
+    def _encode(value) -> str:
+        return quote(str(value).encode(), '-_.~')
+
+    def _key_time(self, expired: int, now: int = None) -> str:
+        now = int(time.time()) if now is None else now
+        return f"{now - 60};{now + expired}"  # 与SDK一致，起始时间提前60秒容忍时钟偏差
+
+    def _sign_key(self, key_time: str) -> str:
+        return hmac.new(self.secret_key, key_time.encode(), hashlib.sha1).hexdigest()
+
+    def _presign(self, bucket: str, key: str, method: str, key_time: str, sign_key: str, params: dict = None) -> str:
+        path = key if key.startswith('/') else '/' + key
+        signed = {self._encode(k).lower(): self._encode(v) for k, v in (params or {}).items()}
+        param_str = '&'.join(f"{k}={v}" for k, v in sorted(signed.items()))
+        http_string = f"{method.lower()}\n{path}\n{param_str}\n\n"
+        string_to_sign = f"sha1\n{key_time}\n{hashlib.sha1(http_string.encode()).hexdigest()}\n"
+        signature = hmac.new(sign_key.encode(), string_to_sign.encode(), hashlib.sha1).hexdigest()
+        auth = urlencode([("q-sign-algorithm", "sha1"), ("q-ak", self.secret_id), ("q-sign-time", key_time),
+                          ("q-key-time", key_time), ("q-header-list", ""),
+                          ("q-url-param-list", ';'.join(sorted(signed))), ("q-signature", signature)])
+        url_path = quote(path[1:].encode(), '/-_.~').replace('./', '.%2F')
+        url = f"{self.scheme}://{bucket}.{self.endpoint}/{url_path}?{auth}"
+        if params:
+            url += '&' + urlencode(params)
+        return url
+
+    def presign(self, bucket: str, key: str, method: str = 'GET', expired: int = 60, params: dict = None) -> str:
+        """
+        :param bucket: 桶名称
+        :param key: 文件名称
+        :param method: HTTP方法
+        :param expired: 过期时间(秒)
+        :param params: 需要签入的URL参数
+        :return: 预签名链接
+        """
+        key_time = self._key_time(expired)
+        return self._presign(bucket, key, method, key_time, self._sign_key(key_time), params)
+
+    def presign_many(self, bucket: str, keys: list[str], method: str = 'GET', expired: int = 60) -> list[str]:
+        """批量签名，同一批链接共用签名时间与SignKey"""
+        key_time = self._key_time(expired)
+        sign_key = self._sign_key(key_time)
+        return [self._presign(bucket, key, method, key_time, sign_key) for key in keys]
+
 
 # 目前使用腾讯的对象存储服务
 # https://cloud.tencent.com/document/product/436/12269
 class COS:
-    __global_config = Utils.config.COSConfig(config_fp)
+    __global_config: Utils.config.COSConfig = None
     __cos_config: CosConfig = None
     __client: CosS3Client = None
+    __signer: COSSigner = None
 
     def __init__(self):
         """
@@ -27,12 +98,15 @@ class COS:
         :param token:临时密钥的 Token，临时密钥生成和使用指引参见 https://cloud.tencent.com/document/product/436/14048
         :param scheme:指定使用 http/https 协议来访问 COS，默认为 https，可不填
         """
+        COS.__global_config = Utils.config.COSConfig(config_fp)
         COS.__cos_config = CosConfig(Region=COS.__global_config.region,
                                      SecretId=COS.__global_config.secret_id,
                                      SecretKey=COS.__global_config.secret_key,
                                      Token=None,
                                      Scheme="https")
         COS.__client = CosS3Client(COS.__cos_config)
+        COS.__signer = COSSigner(COS.__global_config.secret_id, COS.__global_config.secret_key,
+                                 COS.__global_config.region)
 
     @staticmethod
     def list_buckets():
@@ -51,6 +125,9 @@ class COS:
         :param key:文件名
         :return:Etag
         """
+        if os.path.getsize(file_path) > DEFAULT_PART_SIZE:
+            # 大文件改为并发分块上传，避免单个PUT请求过大
+            return COS.multipart_upload(file_path, bucket, key)
         with open(file_path, 'rb') as fp:
             response = COS.__client.put_object(
                 Bucket=bucket,
@@ -70,6 +147,8 @@ class COS:
         :param key:文件名
         :return:Etag
         """
+        if isinstance(file, io.BytesIO) and file.getbuffer().nbytes > DEFAULT_PART_SIZE:
+            return COS.multipart_upload(file, bucket, key)
         response = COS.__client.put_object(
             Bucket=bucket,
             Body=file,
@@ -80,41 +159,177 @@ class COS:
         return response['ETag']
 
     @staticmethod
-    def list_all_objects(bucket, prefix: str = ""):
+    def iter_objects(bucket, prefix: str = "", page_size: int = 1000):
         """
-        查询所有对象
+        逐页查询并逐个产出对象，不在内存中保存完整列表
         :param bucket:桶名称
         :param prefix:文件夹
-        :return:所有对象列表[{'Key','LastModified','Etag','Size','Owner':{'ID','DisplayName','StorageClass'}}]
+        :param page_size:每页数量
+        :return:对象生成器，元素格式同list_all_objects
         """
-        res_list = []
         marker = ""
         while True:
             response = COS.__client.list_objects(
                 Bucket=bucket,
                 Prefix=prefix,
-                Marker=marker
+                Marker=marker,
+                MaxKeys=page_size
             )
-            res_list = res_list + response['Contents']
+            yield from response.get('Contents', [])
             if response["IsTruncated"] == 'false':
                 break
             marker = response["NextMarker"]
-        return res_list
+
+    @staticmethod
+    def list_all_objects(bucket, prefix: str = ""):
+        """
+        查询所有对象
+        :param bucket:桶名称
+        :param prefix:文件夹
+        :return:所有对象列表[{'Key','LastModified','Etag','Size','Owner':{'ID','DisplayName','StorageClass'}}]
+        """
+        return list(COS.iter_objects(bucket, prefix))
+
+    @staticmethod
+    def _iter_parts(source, part_size: int):
+        """
+        把上传源切分为 (分块序号, 读取函数)，读取函数在工作线程中调用，只读取该分块
+        :param source: BytesIO、以rb打开的本地文件或任意可读的文件流
+        """
+        if isinstance(source, io.BytesIO):
+            # 直接切分底层缓冲区，不复制整个对象
+            view = memoryview(source.getbuffer())
+            for number, offset in enumerate(range(0, max(len(view), 1), part_size), 1):
+                yield number, (lambda v=view[offset:offset + part_size]: v)
+        elif isinstance(source, io.BufferedReader):
+            # 本地文件按偏移量读取，各线程互不影响文件指针
+            fd = source.fileno()
+            size = os.fstat(fd).st_size
+            for number, offset in enumerate(range(0, max(size, 1), part_size), 1):
+                yield number, (lambda o=offset, n=min(part_size, size - offset): os.pread(fd, n, o))
+        else:
+            number = 0
+            while True:
+                data = source.read(part_size)
+                if not data and number:
+                    break
+                number += 1
+                yield number, (lambda d=data: d)
+                if len(data) < part_size:
+                    break
+
+    @staticmethod
+    def multipart_upload(source, bucket, key, part_size: int = DEFAULT_PART_SIZE,
+                         max_workers: int = DEFAULT_WORKERS):
+        """
+        并发分块上传，同一时间最多只有 2 * max_workers 个分块在内存中
+        :param source:文件路径、BytesIO 或可读文件流
+        :param bucket:桶名称
+        :param key:文件名
+        :param part_size:分块大小
+        :param max_workers:并发上传的线程数
+        :return:Etag
+        """
+        if isinstance(source, str):
+            with open(source, 'rb') as fp:
+                return COS.multipart_upload(fp, bucket, key, part_size, max_workers)
+        upload_id = COS.__client.create_multipart_upload(Bucket=bucket, Key=key, StorageClass='STANDARD')['UploadId']
+        slots = threading.BoundedSemaphore(max_workers * 2)
+        failed = threading.Event()  # 任一分块失败后不再读取与上传后续分块
+
+        def upload(number, read):
+            try:
+                if failed.is_set():
+                    return None
+                response = COS.__client.upload_part(Bucket=bucket, Key=key, Body=read(), PartNumber=number,
+                                                    UploadId=upload_id)
+                return {'PartNumber': number, 'ETag': response['ETag']}
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = []
+                for number, read in COS._iter_parts(source, part_size):
+                    slots.acquire()
+                    if failed.is_set():
+                        slots.release()
+                        break
+                    futures.append(executor.submit(upload, number, read))
+                parts = sorted((f.result() for f in as_completed(futures)), key=lambda p: p['PartNumber'])
+            response = COS.__client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                                              MultipartUpload={'Part': parts})
+            return response['ETag']
+        except Exception:
+            logger.error(f"Multipart upload of {key} failed, aborting", exc_info=True)
+            COS.__client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    @staticmethod
+    def parallel_download(bucket, key, file_path, part_size: int = DEFAULT_PART_SIZE,
+                          max_workers: int = DEFAULT_WORKERS):
+        """
+        按Range并发分段下载到本地文件，每段边读边写，内存占用与对象大小无关
+        :param bucket:桶
+        :param key: 文件名
+        :param file_path:本地路径
+        :param part_size:每段大小
+        :param max_workers:并发下载的线程数
+        :return: None
+        """
+        size = int(COS.__client.head_object(Bucket=bucket, Key=key)['Content-Length'])
+        tmp_path = f"{file_path}.part"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def download(offset):
+                end = min(offset + part_size, size) - 1
+                response = COS.__client.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{end}")
+                position = offset
+                for chunk in response['Body'].get_stream(STREAM_CHUNK_SIZE):
+                    position += os.pwrite(fd, chunk, position)
+                if position != end + 1:
+                    raise IOError(f"Incomplete range {offset}-{end} of {key}: got {position - offset} bytes")
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(download, offset) for offset in range(0, size, part_size)]:
+                    future.result()
+        except Exception:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+        os.close(fd)
+        os.replace(tmp_path, file_path)
 
     @staticmethod
     def get_object_local(bucket, key, file_path):
         """
-        下载文件到本地
+        下载文件到本地，大文件自动分段并发下载
         :param bucket:桶
         :param key: 文件名
         :param file_path:本地路径
         :return: None
         """
+        COS.parallel_download(bucket, key, file_path)
+
+    @staticmethod
+    def iter_object_chunks(bucket, key, chunk_size: int = STREAM_CHUNK_SIZE):
+        """
+        以生成器方式流式读取对象内容
+        :param bucket:桶
+        :param key: 文件名
+        :param chunk_size: 每次产出的字节数
+        :return: bytes 生成器
+        """
         response = COS.__client.get_object(
             Bucket=bucket,
             Key=key,
         )
-        response['Body'].get_stream_to_file(file_path)
+        yield from response['Body'].get_stream(chunk_size)
 
     @staticmethod
     def get_object_stream(bucket, key):
@@ -158,6 +373,9 @@ class COS:
         :param Expired: 过期时间
         :return:        预签名后的下载链接
         """
+        if not Headers and not SignHost:
+            # 不需要签入头部时直接在本地计算签名
+            return COS.__signer.presign(Bucket, Key, Method, Expired, Params)
         url = COS.__client.get_presigned_url(
             Bucket=Bucket,
             Method=Method,
@@ -183,6 +401,8 @@ class COS:
         :param Expired: 过期时间
         :return:        预签名后的上传链接
         """
+        if not Headers and not SignHost:
+            return COS.__signer.presign(Bucket, Key, Method, Expired, Params)
         url = COS.__client.get_presigned_url(
             Method=Method,
             Bucket=Bucket,
@@ -194,6 +414,18 @@ class COS:
         )
         return url
 
+    @staticmethod
+    def get_presigned_urls(Bucket, Keys, Method='GET', Expired=60):
+        """
+        批量获取预签名链接，全部在本地计算
+        :param Bucket:  桶名称
+        :param Keys:    文件名称列表
+        :param Method:  HTTP方法，下载为GET，上传为PUT
+        :param Expired: 过期时间
+        :return:        与Keys一一对应的预签名链接列表
+        """
+        return COS.__signer.presign_many(Bucket, Keys, Method, Expired)
+
     @staticmethod
     def delete_object(bucket, key):
         """
@@ -209,4 +441,14 @@ class COS:
         return response
 
 
-cos_operator = COS()
\ No newline at end of file
+_cos_operator: COS = None
+
+
+def __getattr__(name: str):
+    """cos_operator 在首次访问时才创建，导入本模块不会读取 cos_config.json"""
+    global _cos_operator
+    if name == "cos_operator":
+        if _cos_operator is None:
+            _cos_operator = COS()
+        return _cos_operator
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Post 去重：客户端超时后会重发同一条消息，带上 client_msg_id 的 Post 在窗口期内重复到达时，
+不再写数据库、不再扇出与推送，只把第一次处理时的回显发回给发送方作为确认。
+每个用户的窗口由两代集合组成，当前一代存在超过 window 秒(或条数达到上限)后整体淘汰更早的一代，
+因此一个 id 至少保留 window 秒(条数未超限时)，最多保留 2 * window 秒，不需要逐条记录过期时间。
+"""
+import collections
+import threading
+import time
+
+from Utils.metrics import registry
+
+DEDUP_STRIPES = 64  # 按用户分段加锁
+MAX_CLIENT_MSG_ID = 64  # client_msg_id 的最大长度，超过或类型不对的 id 不参与去重
+
+POST_DEDUP = registry.counter("betterfly_post_dedup_total", "Posts with a client_msg_id by dedup result",
+                              ("result",))
+
+
+def valid_client_msg_id(client_msg_id) -> bool:
+    return isinstance(client_msg_id, (str, int)) and not isinstance(client_msg_id, bool) \
+        and 0 < len(str(client_msg_id)) <= MAX_CLIENT_MSG_ID
+
+
+class _Window:
+    __slots__ = ("current", "previous", "rotated_at")
+
+    def __init__(self, now: float):
+        self.current = {}  # {client_msg_id: 第一次处理时的服务器时间戳}
+        self.previous = {}
+        self.rotated_at = now
+
+
+class PostDedup:
+    def __init__(self, window: float = 120.0, per_user: int = 256, users: int = 100000):
+        """
+        :param window: 重复消息的识别窗口(秒)
+        :param per_user: 每个用户一代最多记录的 id 数，超过后提前轮换
+        :param users: 最多记录的用户数，超过后淘汰最久没有发消息的用户
+        """
+        self.window = window
+        self.per_user = per_user
+        self.users = users
+        self.__stripes = [(threading.Lock(), collections.OrderedDict()) for _ in range(DEDUP_STRIPES)]
+        self.hits = 0
+        self.misses = 0
+
+    def _window(self, windows: collections.OrderedDict, user_id: int, now: float) -> _Window:
+        """取出用户的窗口并按需轮换，需持有该段的锁"""
+        window = windows.get(user_id)
+        if window is None:
+            window = windows[user_id] = _Window(now)
+            while len(windows) > max(1, self.users // DEDUP_STRIPES):
+                windows.popitem(last=False)
+            return window
+        windows.move_to_end(user_id)
+        if now - window.rotated_at >= 2 * self.window:
+            window.current, window.previous, window.rotated_at = {}, {}, now
+        elif now - window.rotated_at >= self.window or len(window.current) >= self.per_user:
+            window.current, window.previous, window.rotated_at = {}, window.current, now
+        return window
+
+    def check(self, user_id: int, client_msg_id, timestamp: str) -> str | None:
+        """
+        记录一条 Post，已在窗口内出现过时不记录
+        :param timestamp: 本次处理将使用的服务器时间戳
+        :return: 重复时返回第一次处理时的时间戳，否则返回None
+        """
+        lock, windows = self.__stripes[user_id % DEDUP_STRIPES]
+        with lock:
+            window = self._window(windows, user_id, time.monotonic())
+            first = window.current.get(client_msg_id)
+            if first is None:
+                first = window.previous.get(client_msg_id)
+            if first is None:
+                window.current[client_msg_id] = timestamp
+                self.misses += 1
+            else:
+                self.hits += 1
+        POST_DEDUP.inc("miss" if first is None else "hit")
+        return first
+
+    def forget(self, user_id: int, client_msg_id):
+        """第一次处理失败时移除记录，客户端重发的消息会被重新处理"""
+        lock, windows = self.__stripes[user_id % DEDUP_STRIPES]
+        with lock:
+            window = windows.get(user_id)
+            if window is not None:
+                window.current.pop(client_msg_id, None)
+                window.previous.pop(client_msg_id, None)
+
+    def stats(self) -> dict:
+        """:return: 记录的用户数与 id 数、累计命中与未命中次数"""
+        users = ids = 0
+        for lock, windows in self.__stripes:
+            with lock:
+                users += len(windows)
+                ids += sum(len(w.current) + len(w.previous) for w in windows.values())
+        return {"users": users, "ids": ids, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,157 @@
+import collections
+import itertools
+import threading
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+# 慢速接收方的处理策略：outbound_queue_max 写满后
+DROP = "drop"  # 丢弃新消息，接收方恢复后提示其重新同步
+DISCONNECT = "disconnect"  # 直接断开连接，由客户端重连后同步
+PUSH_ONLY = "push_only"  # 暂停 socket 投递，新消息改为 APNs 推送，积压发完后恢复
+SLOW_CONSUMER_POLICIES = (DROP, DISCONNECT, PUSH_ONLY)
+THROTTLE_WARN_INTERVAL = 10  # 持续被限流时，每隔多少秒再提示一次客户端
+FLUSH_IOV = 64  # 发送积压时一次 sendmsg 最多携带的数据块数(远小于 IOV_MAX)
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 burst 个"""
+    __slots__ = ("rate", "burst", "tokens", "updated", "warned_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.warned_at = None  # 上一次提示客户端被限流的时间
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now: float, amount: float = 1) -> bool:
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class RateLimiter:
+    """
+    按用户与请求类型限流，同一用户的所有设备共用令牌桶，重连不会重置。
+    令牌桶按需创建，已补满的桶由 prune 定期清理
+    """
+
+    def __init__(self, limits: dict):
+        """
+        :param limits: {RequestType 值: (每秒请求数, 突发上限)}，未列出的类型不限流
+        """
+        self.limits = limits
+        self.__buckets = {}  # {(UserID, RequestType): TokenBucket}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def set_limits(self, limits: dict):
+        """更换限流配置，限额有变化的类型的令牌桶重新开始计算"""
+        with self.__lock:
+            changed = {t for t in limits.keys() | self.limits.keys() if limits.get(t) != self.limits.get(t)}
+            for key in [key for key in self.__buckets if key[1] in changed]:
+                del self.__buckets[key]
+            self.limits = limits
+
+    def allow(self, user_id: int, request_type: int, now: float) -> tuple[bool, bool]:
+        """
+        :return: (是否放行, 是否需要提示客户端被限流，每 THROTTLE_WARN_INTERVAL 秒最多一次)
+        """
+        limit = self.limits.get(request_type)
+        if limit is None:
+            return True, False
+        key = (user_id, request_type)
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                bucket = self.__buckets[key] = TokenBucket(limit[0], limit[1], now)
+            if bucket.consume(now):
+                return True, False
+            if bucket.warned_at is not None and now - bucket.warned_at < THROTTLE_WARN_INTERVAL:
+                return False, False
+            bucket.warned_at = now
+            return False, True
+
+    def prune(self, now: float) -> int:
+        """
+        删除已补满的令牌桶，它们与新建的桶等价
+        :return: 删除的数量
+        """
+        with self.__lock:
+            full = []
+            for key, bucket in self.__buckets.items():
+                bucket.refill(now)
+                if bucket.tokens >= bucket.burst and (bucket.warned_at is None
+                                                      or now - bucket.warned_at >= THROTTLE_WARN_INTERVAL):
+                    full.append(key)
+            for key in full:
+                del self.__buckets[key]
+        return len(full)
+
+
+class Outbox:
+    """
+    一个会话发不出去的数据(内核发送缓冲区已满)，由事件循环在 socket 可写时继续发送。
+    size 为积压字节数，degraded 表示因积压过多已暂停投递(drop/push_only 策略)
+    """
+    __slots__ = ("chunks", "size", "degraded")
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+        self.degraded = False
+
+    def __bool__(self):
+        return self.size > 0
+
+    def append(self, data: bytes | memoryview):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def flush(self, sendmsg) -> bool:
+        """
+        积压的多条消息通过一次 sendmsg(分散/聚集写)发出，减少系统调用次数
+        :param sendmsg: 非阻塞发送函数，参数为数据块列表，返回已发送字节数
+        :return: 是否已全部发完
+        """
+        while self.chunks:
+            batch = list(itertools.islice(self.chunks, FLUSH_IOV))
+            try:
+                sent = sendmsg(batch)
+            except BlockingIOError:
+                return False
+            self.size -= sent
+            for chunk in batch:
+                if sent < len(chunk):
+                    if sent:
+                        self.chunks[0] = memoryview(chunk)[sent:]
+                    return False  # 内核发送缓冲区已满
+                sent -= len(chunk)
+                self.chunks.popleft()
+        return True
+
+
+def parse_rate_limits(config: dict, type_enum) -> dict:
+    """
+    :param config: 配置中的 {"Post": [每秒请求数, 突发上限], ...}
+    :param type_enum: RequestType
+    :return: {RequestType 值: (每秒请求数, 突发上限)}
+    """
+    limits = {}
+    for name, value in (config or {}).items():
+        try:
+            rate, burst = value
+            limits[type_enum[name].value] = (float(rate), float(burst))
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Ignoring invalid rate limit for {name}: {value}")
+    return limits
@@ -0,0 +1,189 @@
+"""
+平滑重启：旧进程通过 Unix socket(SCM_RIGHTS)把监听 socket 与所有客户端 socket 连同会话信息、
+未处理完的接收缓冲区和未发送完的发送积压交给新进程，客户端连接不会断开。
+
+流程：
+    1. 旧进程启动时在 handoff_path 上监听(SOCK_SEQPACKET，以 0600 权限创建)
+    2. 新进程以 takeover 模式启动，连接 handoff_path 并发送 takeover 请求；旧进程只接受同一用户(或root)的请求
+    3. 旧进程停止接受新连接与读取，等待工作线程处理完已提交的任务，停止推送线程(暂存区落盘)
+    4. 旧进程发送监听 socket、按批发送客户端 socket 与会话信息、分块发送缓冲区，最后发送 done
+    5. 新进程恢复全部会话后回复 ok，旧进程关闭自己持有的描述符并退出(不会向客户端发送任何数据)
+"""
+import base64
+import json
+import os
+import socket
+import struct
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+HANDOFF_BATCH = 128  # 每条消息携带的描述符数，SCM_RIGHTS 单条消息上限为 253
+BUFFER_CHUNK = 32 * 1024  # 缓冲区按块发送，避免超过 SOCK_SEQPACKET 单条消息大小
+MAX_MESSAGE = 1 << 20
+HANDOFF_TIMEOUT = 30.0
+REQUEST_TIMEOUT = 5.0  # 旧进程等待接管请求的时间，期间事件循环被阻塞
+
+
+class HandoffError(Exception):
+    pass
+
+
+class HandedOffSession:
+    """新进程收到的一个客户端连接"""
+    __slots__ = ("sock", "meta", "inbuf", "outbox")
+
+    def __init__(self, sock: socket.socket, meta: dict):
+        self.sock = sock
+        self.meta = meta  # {"user_id", "user_name", "connected_at", "last_seen", "last_active"}
+        self.inbuf = b""  # 尚未收完的半包
+        self.outbox = []  # 尚未发出的数据块
+
+
+class HandoffState:
+    def __init__(self, listener: socket.socket, sessions: list[HandedOffSession]):
+        self.listener = listener
+        self.sessions = sessions
+
+
+def open_listener(path: str) -> socket.socket:
+    """
+    在 path 上监听接管请求，已存在的 socket 文件只有在无人监听(上一个进程留下的)时才会被替换
+    :raise HandoffError: 另一个进程正在 path 上监听
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        probe.connect(path)  # 连上后不发送请求直接关闭，对方会忽略这次连接
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    else:
+        raise HandoffError(f"Another server is listening for handoff at {path}")
+    finally:
+        probe.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    umask = os.umask(0o177)  # socket 文件创建时即为 0600，bind 与 chmod 之间不会被其他用户连上
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+
+def read_request(conn: socket.socket) -> bool:
+    """
+    旧进程：确认连接来自同一用户(或root)并读取接管请求
+    :return: 对方发送了 takeover 请求时返回True，连接后直接关闭(新进程检查监听状态)时返回False
+    :raise HandoffError: 对方不是同一用户或请求无效
+    """
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    pid, uid, _ = struct.unpack("3i", creds)
+    if uid not in (os.geteuid(), 0):
+        raise HandoffError(f"Rejected handoff request from pid {pid} uid {uid}")
+    conn.settimeout(REQUEST_TIMEOUT)
+    data = conn.recv(MAX_MESSAGE)
+    if not data:
+        return False
+    if json.loads(data).get("type") != "takeover":
+        raise HandoffError(f"Invalid handoff request from pid {pid}: {data[:100]!r}")
+    return True
+
+
+def _send(conn: socket.socket, message: dict, fds: list = ()):
+    data = json.dumps(message).encode()
+    if fds:
+        socket.send_fds(conn, [data], list(fds))
+    else:
+        conn.sendall(data)
+
+
+def send_state(conn: socket.socket, listener: socket.socket, sessions: list):
+    """
+    旧进程发送全部状态，调用前必须已停止所有会修改会话的线程
+    :param sessions: Session 列表
+    """
+    conn.settimeout(HANDOFF_TIMEOUT)
+    _send(conn, {"type": "listener"}, [listener.fileno()])
+    for begin in range(0, len(sessions), HANDOFF_BATCH):
+        batch = sessions[begin:begin + HANDOFF_BATCH]
+        metas = [{"id": begin + i, "user_id": s.user_id, "user_name": s.user_name, "connected_at": s.connected_at,
+                  "last_seen": s.last_seen, "last_active": s.last_active} for i, s in enumerate(batch)]
+        _send(conn, {"type": "sessions", "sessions": metas}, [s.sock.fileno() for s in batch])
+    for index, session in enumerate(sessions):
+        if session.inbuf:
+            _send_buffer(conn, index, "in", session.inbuf)
+        if session.outbox is not None:
+            for chunk in session.outbox.chunks:
+                _send_buffer(conn, index, "out", bytes(chunk))
+    _send(conn, {"type": "done", "count": len(sessions)})
+    reply = conn.recv(MAX_MESSAGE)
+    if json.loads(reply or b"{}").get("type") != "ok":
+        raise HandoffError(f"New process did not confirm the handoff: {reply!r}")
+
+
+def _send_buffer(conn: socket.socket, index: int, kind: str, data: bytes):
+    for begin in range(0, len(data), BUFFER_CHUNK):
+        _send(conn, {"type": "buffer", "id": index, "kind": kind,
+                     "data": base64.b64encode(data[begin:begin + BUFFER_CHUNK]).decode()})
+
+
+def receive_state(path: str) -> tuple[socket.socket, HandoffState]:
+    """
+    新进程连接旧进程并接收全部状态
+    :return: (与旧进程的连接，处理完毕后调用 confirm 回复；接收到的状态)
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    try:
+        conn.connect(path)
+    except OSError as e:
+        conn.close()
+        raise HandoffError(f"No running server accepts handoff at {path}: {e}") from e
+
+    listener = None
+    sessions = []
+    try:
+        _send(conn, {"type": "takeover"})
+        while True:
+            data, fds, _, _ = socket.recv_fds(conn, MAX_MESSAGE, HANDOFF_BATCH)
+            if not data:
+                raise HandoffError("Old process closed the connection during handoff")
+            message = json.loads(data)
+            kind = message["type"]
+            if kind == "listener":
+                listener = socket.socket(fileno=fds[0])
+            elif kind == "sessions":
+                for meta, fd in zip(message["sessions"], fds):
+                    sessions.append(HandedOffSession(socket.socket(fileno=fd), meta))
+            elif kind == "buffer":
+                session = sessions[message["id"]]
+                chunk = base64.b64decode(message["data"])
+                if message["kind"] == "in":
+                    session.inbuf += chunk
+                else:
+                    session.outbox.append(chunk)
+            elif kind == "done":
+                if listener is None or message["count"] != len(sessions):
+                    raise HandoffError(f"Incomplete handoff: {len(sessions)}/{message['count']} sessions")
+                return conn, HandoffState(listener, sessions)
+    except Exception:
+        for session in sessions:
+            session.sock.close()
+        if listener is not None:
+            listener.close()
+        conn.close()
+        raise
+
+
+def confirm(conn: socket.socket):
+    """新进程恢复完全部会话后通知旧进程退出"""
+    try:
+        _send(conn, {"type": "ok"})
+    finally:
+        conn.close()
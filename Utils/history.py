@@ -0,0 +1,113 @@
+"""
+历史消息分页：按会话(私聊的两个用户或一个群组)与消息序号 seq 做 keyset 分页，游标为上一页最早一条消息的 seq，
+查询走 messages 表的 (会话, seq) 索引，翻到多深都只扫描一页的行，不使用 OFFSET。
+最近访问过的会话在内存中缓存最新若干条消息，打开会话与往前翻看的前几页不需要访问数据库；
+本节点写入消息时失效对应会话，其他节点写入的消息在缓存过期(ttl)后可见。
+"""
+import collections
+import threading
+import time
+
+from Utils.metrics import registry
+
+HISTORY_PAGE_DEFAULT = 50  # 未指定 limit 时的每页消息数
+HISTORY_PAGE_MAX = 100  # 每页最多消息数
+HISTORY_FRAME_MESSAGES = 25  # 一页按此拆成多帧，单帧不至于过大
+INVALIDATION_STRIPES = 256  # 失效计数按会话分段，查询数据库期间同段会话被写入时不缓存查询结果
+
+HISTORY_CACHE = registry.counter("betterfly_history_cache_total", "History page lookups by cache result",
+                                 ("result",))
+
+
+def conversation_key(user_id: int, to_id: int, is_group: bool) -> tuple[int, int, int]:
+    """
+    与 messages 表的 conv_low/conv_high 生成列一致
+    :return: (is_group, conv_low, conv_high)，私聊两个方向的消息属于同一个会话
+    """
+    if is_group:
+        return 1, to_id, 0
+    return 0, min(user_id, to_id), max(user_id, to_id)
+
+
+class _Entry:
+    __slots__ = ("rows", "complete", "expires")
+
+    def __init__(self, rows: list, complete: bool, expires: float):
+        self.rows = rows  # 会话最新的若干条消息，按 seq 从新到旧
+        self.complete = complete  # rows 是否已是会话的全部消息
+        self.expires = expires
+
+
+class HistoryCache:
+    def __init__(self, conversations: int = 1024, messages: int = 100, ttl: float = 30.0):
+        """
+        :param conversations: 最多缓存的会话数，超过后淘汰最久未访问的会话
+        :param messages: 每个会话缓存的最新消息数
+        :param ttl: 缓存有效期(秒)
+        """
+        self.conversations = conversations
+        self.messages = messages
+        self.ttl = ttl
+        self.__entries = collections.OrderedDict()  # {会话键: _Entry}，按访问顺序排列
+        self.__epochs = [0] * INVALIDATION_STRIPES
+        self.__lock = threading.Lock()
+
+    def configure(self, conversations: int, messages: int, ttl: float):
+        """在线调整缓存大小，已缓存的内容全部丢弃"""
+        with self.__lock:
+            self.conversations, self.messages, self.ttl = conversations, messages, ttl
+            self.__entries.clear()
+            self.__epochs = [epoch + 1 for epoch in self.__epochs]
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def invalidate(self, key: tuple):
+        """会话有新消息写入"""
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__epochs[hash(key) % INVALIDATION_STRIPES] += 1
+
+    def page(self, key: tuple, before: int | None, limit: int, load) -> tuple[list, bool]:
+        """
+        :param key: conversation_key
+        :param before: 游标，只返回 seq 小于它的消息；为空则从最新一条开始
+        :param limit: 本页消息数
+        :param load: load(key, before, limit) -> 按 seq 从新到旧的消息行，最后一列为 seq
+        :return: (本页消息(从新到旧), 是否还有更早的消息)
+        """
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self.__entries[key]
+                entry = None
+            if entry is not None:
+                self.__entries.move_to_end(key)
+            epoch = self.__epochs[hash(key) % INVALIDATION_STRIPES]
+            cached = self.messages
+
+        if entry is not None:
+            rows = entry.rows if before is None else [row for row in entry.rows if row[-1] < before]
+            if len(rows) >= limit or entry.complete:
+                HISTORY_CACHE.inc("hit")
+                return rows[:limit], len(rows) > limit or not entry.complete
+
+        if before is not None or entry is not None or limit > cached or cached <= 0:
+            # 更早的页直接按游标查询，多取一条用于判断是否还有更早的消息
+            HISTORY_CACHE.inc("bypass")
+            rows = list(load(key, before, limit + 1))
+            return rows[:limit], len(rows) > limit
+
+        HISTORY_CACHE.inc("miss")
+        rows = list(load(key, None, cached + 1))
+        complete = len(rows) <= cached
+        rows = rows[:cached]
+        with self.__lock:
+            # 查询期间同段会话有新消息写入时，结果可能已过时，不缓存
+            if self.__epochs[hash(key) % INVALIDATION_STRIPES] == epoch and cached == self.messages:
+                self.__entries[key] = _Entry(rows, complete, now + self.ttl)
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.conversations:
+                    self.__entries.popitem(last=False)
+        return rows[:limit], len(rows) > limit or not complete
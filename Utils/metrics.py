@@ -0,0 +1,226 @@
+import bisect
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class _Metric:
+    """
+    指标基类。每个线程写自己的分片(dict)，写入时无需加锁；
+    抓取时把所有线程的分片合并，只有线程第一次写入时才需要登记分片
+    """
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self) -> list[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        # dict() 复制在GIL下是原子的，不会读到正在扩容的字典
+        return [dict(shard) for shard in shards]
+
+    def _label_str(self, values: tuple, extra: str = "") -> str:
+        pairs = [f"{k}={_quote(v)}" for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return sum(shard.get(label_values, 0) for shard in self._snapshots())
+
+    def render(self) -> list[str]:
+        merged = {}
+        for shard in self._snapshots():
+            for key, value in shard.items():
+                merged[key] = merged.get(key, 0) + value
+        return super().render() + [f"{self.name}{self._label_str(key)} {value}" for key, value in sorted(merged.items())]
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图，每个标签组合保存 [各桶计数..., 总和, 总数]"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        shard = self._shard()
+        row = shard.get(label_values)
+        if row is None:
+            row = shard[label_values] = [0] * (len(self.buckets) + 3)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def totals(self, *label_values) -> tuple:
+        """:return: 该标签组合的 (总和, 总数)"""
+        rows = [shard.get(label_values) for shard in self._snapshots()]
+        return sum(row[-2] for row in rows if row), sum(row[-1] for row in rows if row)
+
+    def render(self) -> list[str]:
+        merged = {}
+        for shard in self._snapshots():
+            for key, row in shard.items():
+                total = merged.setdefault(key, [0] * len(row))
+                for i, v in enumerate(row):
+                    total[i] += v
+        lines = super().render()
+        for key, row in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._label_str(key, 'le=%s' % _quote(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self._label_str(key, 'le=%s' % _quote('+Inf'))} {row[-1]}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {row[-2]}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {row[-1]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    抓取时才调用回调读取当前值，热路径上没有任何开销
+    回调返回一个数值，或 {标签值元组: 数值}
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, func, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.func = func
+
+    def render(self) -> list[str]:
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.warning(f"Failed to collect gauge {self.name}: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return super().render() + [f"{self.name}{self._label_str(key)} {value}" for key, value in values.items()]
+
+
+def _quote(value) -> str:
+    return '"' + _escape(value) + '"'
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """指标注册表，同名指标重复注册时返回已有对象(Gauge则替换回调)"""
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def _register(self, metric_cls, name: str, *args, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = metric_cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, labels, buckets)
+
+    def gauge(self, name: str, help_text: str, func, labels: tuple = ()) -> Gauge:
+        gauge = self._register(Gauge, name, help_text, func, labels)
+        gauge.func = func
+        return gauge
+
+    def render(self) -> str:
+        """
+        :return: Prometheus 文本格式的全部指标
+        """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        status = 200
+        if path in ("/metrics", "/"):
+            content_type, body = "text/plain; version=0.0.4; charset=utf-8", self.server.registry.render()
+        elif path in self.server.routes:
+            try:
+                content_type, body, *rest = self.server.routes[path](urllib.parse.parse_qs(query))
+                if rest:
+                    status = rest[0]
+            except Exception as e:
+                logger.error(f"Error handling {path}: {e}", exc_info=True)
+                self.send_error(500)
+                return
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "127.0.0.1", metrics: MetricsRegistry = registry,
+                      routes: dict = None) -> ThreadingHTTPServer:
+    """
+    在后台线程中启动指标HTTP服务，GET /metrics 返回 Prometheus 文本格式
+    :param routes: 额外的管理接口 {路径: func(query: dict) -> (content_type, body) 或 (content_type, body, status)}
+    :return: HTTP服务对象，调用 shutdown() 停止
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = metrics
+    server.routes = routes or {}
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,171 @@
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+SAMPLE_INTERVAL = 0.005  # 采样间隔(秒)
+MAX_PROFILE_SECONDS = 120
+RECENT_SLOW_TRACES = 100  # 保留最近的慢请求条数，供管理接口查看
+
+
+class SamplingProfiler:
+    """
+    采样分析器：在独立线程中定期读取所有线程的调用栈，
+    输出 flamegraph.pl / speedscope 可直接使用的 collapsed stack 格式。
+    未运行时没有任何开销
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.__lock = threading.Lock()
+        self.__running = False
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    def sample(self, duration: float) -> collections.Counter:
+        """
+        阻塞采样 duration 秒
+        :return: {"线程名;最外层帧;...;最内层帧": 采样次数}，正在采样时返回None
+        """
+        with self.__lock:
+            if self.__running:
+                return None
+            self.__running = True
+        try:
+            return self._sample(min(duration, MAX_PROFILE_SECONDS))
+        finally:
+            self.__running = False
+
+    def _sample(self, duration: float) -> collections.Counter:
+        counts = collections.Counter()
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + duration
+        for i in itertools.count():
+            if time.monotonic() >= deadline:
+                break
+            if i % 200 == 0:  # 线程名变化不频繁，定期刷新即可
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return counts
+
+    @staticmethod
+    def collapsed(counts: collections.Counter) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    def dump_async(self, duration: float, directory: str) -> bool:
+        """
+        在后台线程采样并写入 directory/profile-<时间>.folded，用于信号触发
+        :return: 已有采样在进行时返回False
+        """
+        if self.__running:
+            return False
+
+        def run():
+            counts = self.sample(duration)
+            if counts is None:
+                return
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.collapsed(counts))
+            logger.info(f"Wrote {sum(counts.values())} stack samples to {path}")
+
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+        return True
+
+
+class Trace:
+    """单个请求的追踪记录，spans 为 [(名称, 开始, 结束)]，时间为 perf_counter 秒"""
+    __slots__ = ("trace_id", "name", "user_id", "queued_at", "started_at", "spans")
+
+    def __init__(self, trace_id: int, name: str, user_id, queued_at: float | None):
+        self.trace_id = trace_id
+        self.name = name
+        self.user_id = user_id
+        self.started_at = time.perf_counter()
+        self.queued_at = queued_at if queued_at is not None else self.started_at
+        self.spans = []
+
+    def to_dict(self, finished_at: float) -> dict:
+        ms = lambda t: round((t - self.queued_at) * 1000, 3)
+        return {
+            "trace_id": self.trace_id,
+            "request": self.name,
+            "user_id": self.user_id,
+            "total_ms": ms(finished_at),
+            "queued_ms": ms(self.started_at),
+            "spans": [{"name": name, "start_ms": ms(start), "duration_ms": round((end - start) * 1000, 3)}
+                      for name, start, end in self.spans],
+        }
+
+
+class Tracer:
+    """
+    按请求记录各阶段耗时(排队、开始处理、数据库、编码、发送)。
+    当前请求保存在线程局部变量中，数据库与发送代码只需调用 span()；
+    未启用时调用方只做一次 enabled 判断
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.log_all = False
+        self.slow_threshold = None  # 秒，超过则以WARNING输出完整的阶段耗时
+        self.recent_slow = collections.deque(maxlen=RECENT_SLOW_TRACES)
+        self.__ids = itertools.count(1)
+        self.__local = threading.local()
+
+    def configure(self, log_all: bool = False, slow_request_ms: float | None = None):
+        self.log_all = log_all
+        self.slow_threshold = slow_request_ms / 1000 if slow_request_ms is not None else None
+        self.enabled = log_all or self.slow_threshold is not None
+
+    def begin(self, name: str, user_id=None, queued_at: float | None = None) -> Trace:
+        trace = Trace(next(self.__ids), name, user_id, queued_at)
+        self.__local.trace = trace
+        return trace
+
+    def span(self, name: str, start: float, end: float):
+        """给当前线程正在处理的请求追加一个阶段"""
+        trace = getattr(self.__local, "trace", None)
+        if trace is not None:
+            trace.spans.append((name, start, end))
+
+    def finish(self, trace: Trace, name: str = None):
+        self.__local.trace = None
+        if name is not None:
+            trace.name = name
+        finished_at = time.perf_counter()
+        elapsed = finished_at - trace.queued_at
+        slow = self.slow_threshold is not None and elapsed >= self.slow_threshold
+        if not slow and not self.log_all:
+            return
+        record = trace.to_dict(finished_at)
+        if slow:
+            self.recent_slow.append(record)
+            logger.warning("Slow request: %s", json.dumps(record, ensure_ascii=False))
+        else:
+            logger.info("Trace: %s", json.dumps(record, ensure_ascii=False))
+
+
+profiler = SamplingProfiler()
+tracer = Tracer()
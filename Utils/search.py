@@ -0,0 +1,585 @@
+"""
+消息全文检索：随消息写入增量维护的倒排索引，不需要对 MySQL 做 LIKE 扫描。每条消息除了各个词之外，
+还记在所属的范围下——私聊记在双方用户名下，群聊记在群组名下；查询从发起者有权查看的范围的文档表出发，
+与各个词的倒排表求交，长倒排表分块并带跳表，只解码候选文档所在的块。
+
+* 分词：拉丁字母与数字按词切分；中日韩文字没有空格，按单字与相邻两字(bigram)切分，查询时按同样规则切分后求交集，
+  再用原文校验查询串确实连续出现
+* 存储：新消息先进入内存表并追加写入 WAL；内存表满 segment_docs 条后冻结，由后台线程写成不可变的段文件，
+  段内倒排表按文档号差值编码(必要时 zlib 压缩)，原文按块压缩；段数超过 max_segments 时在后台合并相邻的段
+* 文档号按写入顺序递增，查询结果从新到旧返回，游标为上一页最后一条结果的文档号
+"""
+import array
+import bisect
+import collections
+import functools
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from Utils.color_logger import get_logger
+from Utils.metrics import registry
+
+logger = get_logger(__name__)
+
+SEARCH_PAGE_DEFAULT = 20  # 未指定 limit 时的每页结果数
+SEARCH_PAGE_MAX = 50  # 每页最多结果数
+MAX_WORD_LENGTH = 32  # 超过该长度的词不建索引(链接、编码串等)
+DOC_BLOCK = 128  # 原文每块的消息数，查询时按块解压
+MERGE_FACTOR = 4  # 每次合并的相邻段数
+POSTING_BLOCK = 128  # 超过该长度的倒排表分块编码，求交时只解码用到的块
+
+SEARCH_QUERY_SECONDS = registry.histogram("betterfly_search_query_seconds", "Full-text search query latency")
+SEARCH_INDEXED = registry.counter("betterfly_search_indexed_total", "Messages added to the search index")
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"  # 假名、中日韩统一表意文字、谚文
+_RUNS = re.compile(f"([{_CJK}]+)|([^\\W{_CJK}]+)")
+_SEP = "\x1f"  # 范围键的前缀，分词结果中不会出现
+
+_MAGIC = b"BFSEARCH"
+_HEADER = struct.Struct("<8sQIIIQQ")  # magic, 首个文档号, 文档数, 词条数, 块数, 词条表偏移, 块表偏移
+_ENTRY = struct.Struct("<QHI")  # 数据偏移, 键长度, 倒排表长度；键与倒排表在数据区中相邻存放
+_BLOCK = struct.Struct("<IQI")  # 块内首个文档相对段首的偏移, 数据偏移, 长度
+_WIDE, _ZLIB, _BLOCKED = 1, 2, 4  # 倒排表格式标志：差值用 uint32(否则 uint16)、zlib 压缩、分块
+_COUNT = struct.Struct("<I")  # 分块倒排表的文档数
+_SKIP = struct.Struct("<II")  # 分块倒排表的跳表项：块首文档相对段首的偏移, 块数据相对块区开头的偏移
+
+
+def _runs(text: str):
+    """:return: [(是否为中日韩文字, 连续片段)]，已转为小写"""
+    return [(bool(cjk), cjk or word) for cjk, word in _RUNS.findall(text.lower())]
+
+
+def index_terms(text: str) -> set[str]:
+    """一条消息的索引词：拉丁词整体，中日韩文字的单字与 bigram"""
+    terms = set()
+    for cjk, run in _runs(text):
+        if cjk:
+            terms.update(run)
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        elif len(run) <= MAX_WORD_LENGTH:
+            terms.add(run)
+    return terms
+
+
+def query_terms(query: str) -> tuple[list[str], list[str]]:
+    """
+    :return: (需要同时命中的索引词, 需要在原文中连续出现的片段)
+    """
+    terms, runs = [], []
+    for cjk, run in _runs(query):
+        if cjk and len(run) > 1:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif cjk or len(run) <= MAX_WORD_LENGTH:
+            terms.append(run)
+        runs.append(run)
+    return list(dict.fromkeys(terms)), runs
+
+
+def user_scope(user_id: int) -> str:
+    """:return: 用户参与的所有私聊消息的检索范围"""
+    return f"u{user_id}"
+
+
+def group_scope(group_id: int) -> str:
+    """:return: 群组消息的检索范围"""
+    return f"g{group_id}"
+
+
+def scopes_of(from_id: int, to_id: int, is_group: bool) -> list[str]:
+    """:return: 一条消息所属的检索范围，私聊记在双方名下，群聊记在群组名下"""
+    if is_group:
+        return [group_scope(to_id)]
+    return list(dict.fromkeys((user_scope(from_id), user_scope(to_id))))
+
+
+def _encode_plain(doc_ids: list[int], base: int) -> bytes:
+    """递增的文档号 -> 格式标志 + 相对前一个文档号的差值数组(必要时 zlib 压缩)"""
+    deltas = [b - a for a, b in zip(itertools.chain((base,), doc_ids), doc_ids)]
+    flags = _WIDE if deltas and max(deltas) > 0xFFFF else 0
+    packed = array.array("I" if flags & _WIDE else "H", deltas)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    raw = packed.tobytes()
+    if len(raw) > 64:
+        compressed = zlib.compress(raw, 1)
+        if len(compressed) < len(raw):
+            flags, raw = flags | _ZLIB, compressed
+    return bytes((flags,)) + raw
+
+
+def _decode_plain(data: bytes, base: int) -> list[int]:
+    flags = data[0]
+    raw = zlib.decompress(data[1:]) if flags & _ZLIB else data[1:]
+    deltas = array.array("I" if flags & _WIDE else "H")
+    deltas.frombytes(raw)
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return list(itertools.accumulate(deltas, initial=base))[1:]
+
+
+def _encode_postings(doc_ids: list[int], base: int) -> bytes:
+    """长倒排表按 POSTING_BLOCK 分块编码，前面是各块首个文档号与位置组成的跳表"""
+    if len(doc_ids) <= POSTING_BLOCK:
+        return _encode_plain(doc_ids, base)
+    table, blocks = bytearray(), bytearray()
+    for i in range(0, len(doc_ids), POSTING_BLOCK):
+        block = doc_ids[i:i + POSTING_BLOCK]
+        table += _SKIP.pack(block[0] - base, len(blocks))
+        blocks += _encode_plain(block, block[0])
+    return bytes((_BLOCKED,)) + _COUNT.pack(len(doc_ids)) + table + blocks
+
+
+def _decode_postings(data: bytes, base: int):
+    """:return: 文档号列表，长倒排表返回按需解码的 _BlockedPostings"""
+    if data[0] & _BLOCKED:
+        return _BlockedPostings(data, base)
+    return _decode_plain(data, base)
+
+
+class _BlockedPostings:
+    """分块编码的长倒排表，判断文档是否在表中时只解码所在的块"""
+
+    def __init__(self, data: bytes, base: int):
+        self.count = _COUNT.unpack_from(data, 1)[0]
+        blocks = -(-self.count // POSTING_BLOCK)
+        skips = [_SKIP.unpack_from(data, 1 + _COUNT.size + i * _SKIP.size) for i in range(blocks)]
+        start = 1 + _COUNT.size + blocks * _SKIP.size
+        self.firsts = [base + first for first, _ in skips]
+        self.bounds = [start + offset for _, offset in skips] + [len(data)]
+        self.data = data
+        self.decoded = {}
+
+    def __len__(self):
+        return self.count
+
+    def block(self, index: int) -> list[int]:
+        block = self.decoded.get(index)
+        if block is None:
+            block = self.decoded[index] = _decode_plain(
+                self.data[self.bounds[index]:self.bounds[index + 1]], self.firsts[index])
+        return block
+
+    def __contains__(self, doc_id: int) -> bool:
+        index = bisect.bisect_right(self.firsts, doc_id) - 1
+        if index < 0:
+            return False
+        block = self.block(index)
+        i = bisect.bisect_left(block, doc_id)
+        return i < len(block) and block[i] == doc_id
+
+    def __iter__(self):
+        for index in range(len(self.firsts)):
+            yield from self.block(index)
+
+
+def _narrow(candidates: set[int], postings) -> set[int]:
+    """候选集与倒排表求交：倒排表比候选集长得多时逐个查找候选，否则整体求交"""
+    if len(postings) > 8 * len(candidates):
+        if isinstance(postings, list):
+            return {d for d in candidates
+                    if (i := bisect.bisect_left(postings, d)) < len(postings) and postings[i] == d}
+        return {d for d in candidates if d in postings}
+    return candidates.intersection(postings)
+
+
+def _match(lookup, scopes: list[str], terms: list[str]) -> set[int]:
+    """
+    :param lookup: lookup(键) -> 倒排表或None
+    :return: 属于任一范围且包含全部索引词的文档号
+    """
+    postings = [lookup(term) for term in terms]
+    if any(p is None for p in postings):
+        return set()
+    candidates = set()
+    for scope in scopes:
+        candidates.update(lookup(_SEP + scope) or ())
+    for p in sorted(postings, key=len):
+        if not candidates:
+            break
+        candidates = _narrow(candidates, p)
+    return candidates
+
+
+class _MemTable:
+    """尚未写成段的最新消息，只在持有 SearchIndex 的锁时修改"""
+
+    def __init__(self, first_doc: int):
+        self.first_doc = first_doc
+        self.docs = []  # 文档号 first_doc + i 的消息
+        self.postings = collections.defaultdict(list)  # {词或\x1f范围: [文档号]}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id: int, doc: list):
+        self.docs.append(doc)
+        for key in itertools.chain(index_terms(doc[3]), (_SEP + s for s in scopes_of(doc[0], doc[1], doc[5]))):
+            self.postings[key].append(doc_id)
+
+    def match(self, scopes: list[str], terms: list[str], lock: threading.Lock) -> set[int]:
+        with lock:
+            return _match(self.postings.get, scopes, terms)
+
+    def doc(self, doc_id: int) -> list:
+        return self.docs[doc_id - self.first_doc]
+
+    def entries(self):
+        for key in sorted(k.encode() for k in self.postings):
+            yield key, _encode_postings(self.postings[key.decode()], self.first_doc)
+
+    def blocks(self):
+        for i in range(0, len(self.docs), DOC_BLOCK):
+            yield i, zlib.compress(json.dumps(self.docs[i:i + DOC_BLOCK], ensure_ascii=False).encode())
+
+
+class _Segment:
+    """只读的段文件，通过 mmap 访问，词条表按键排序后二分查找"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.first_doc, self.doc_count, self.term_count, block_count, self.entries_off, blocks_off = \
+            _HEADER.unpack_from(self.mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a search index segment")
+        self.size = len(self.mm)
+        self.blocks = [_BLOCK.unpack_from(self.mm, blocks_off + i * _BLOCK.size) for i in range(block_count)]
+        self.block_starts = [block[0] for block in self.blocks]
+        self.block = functools.lru_cache(maxsize=16)(self._load_block)
+
+    def lookup(self, key: str):
+        key = key.encode()
+        mm, unpack, lo, hi = self.mm, _ENTRY.unpack_from, 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, key_len, length = unpack(mm, self.entries_off + mid * _ENTRY.size)
+            found = mm[offset:offset + key_len]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return _decode_postings(mm[offset + key_len:offset + key_len + length], self.first_doc)
+        return None
+
+    def match(self, scopes: list[str], terms: list[str], lock=None) -> set[int]:
+        return _match(self.lookup, scopes, terms)
+
+    def _load_block(self, index: int) -> list:
+        _, offset, length = self.blocks[index]
+        return json.loads(zlib.decompress(self.mm[offset:offset + length]))
+
+    def doc(self, doc_id: int) -> list:
+        offset = doc_id - self.first_doc
+        index = bisect.bisect_right(self.block_starts, offset) - 1
+        return self.block(index)[offset - self.block_starts[index]]
+
+    def entries(self):
+        for i in range(self.term_count):
+            offset, key_len, length = _ENTRY.unpack_from(self.mm, self.entries_off + i * _ENTRY.size)
+            yield self.mm[offset:offset + key_len], self.mm[offset + key_len:offset + key_len + length]
+
+    def raw_blocks(self):
+        for first, offset, length in self.blocks:
+            yield first, self.mm[offset:offset + length]
+
+
+def _write_segment(path: str, first_doc: int, doc_count: int, entries, blocks):
+    """
+    :param entries: 按键排序的 (键, 编码后的倒排表)
+    :param blocks: (块内首个文档相对段首的偏移, 压缩后的原文块)
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f, tempfile.TemporaryFile() as table:
+        f.write(b"\0" * _HEADER.size)
+        position, term_count = _HEADER.size, 0
+        for key, postings in entries:
+            f.write(key)
+            f.write(postings)
+            table.write(_ENTRY.pack(position, len(key), len(postings)))
+            position += len(key) + len(postings)
+            term_count += 1
+        block_table = bytearray()
+        for first, data in blocks:
+            f.write(data)
+            block_table += _BLOCK.pack(first, position, len(data))
+            position += len(data)
+        entries_off = position
+        table.seek(0)
+        shutil.copyfileobj(table, f)
+        blocks_off = entries_off + term_count * _ENTRY.size
+        f.write(block_table)
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, first_doc, doc_count, term_count, len(block_table) // _BLOCK.size,
+                             entries_off, blocks_off))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class _Aborted(Exception):
+    pass
+
+
+class SearchIndex:
+    def __init__(self, path: str, segment_docs: int = 50000, max_segments: int = 8):
+        """
+        :param path: 索引目录
+        :param segment_docs: 内存表写成段文件的消息数
+        :param max_segments: 段数超过该值时在后台合并
+        """
+        self.path = path
+        self.segment_docs = max(1, segment_docs)
+        self.max_segments = max(MERGE_FACTOR, max_segments)
+        self.merges = 0
+        self.__lock = threading.Lock()
+        self.__pending = threading.Condition(self.__lock)
+        self.__stopping = False
+        self.__segments = ()  # 按文档号从旧到新，整体替换
+        self.__frozen = []  # 已写满、等待后台写成段的内存表
+        os.makedirs(path, exist_ok=True)
+        self._open()
+        self.__flusher = threading.Thread(target=self._flush_worker, name="search-flush", daemon=True)
+        self.__flusher.start()
+
+    # ---------- 启动恢复 ----------
+
+    def _open(self):
+        manifest = self._read_manifest()
+        self.__segments = tuple(_Segment(os.path.join(self.path, name)) for name in manifest)
+        next_doc = self.__segments[-1].first_doc + self.__segments[-1].doc_count if self.__segments else 1
+        for name in os.listdir(self.path):  # 合并或写段时中断留下的文件
+            if (name.startswith("seg-") and name not in manifest) or name.endswith(".tmp"):
+                os.unlink(os.path.join(self.path, name))
+
+        # 重放 WAL 中尚未写成段的消息，写满的部分直接写成段，其余的作为新的内存表并重写 WAL
+        wal_names = sorted((n for n in os.listdir(self.path) if n.startswith("wal-")),
+                           key=lambda n: int(n[4:-4]))
+        docs = []
+        for name in wal_names:
+            with open(os.path.join(self.path, name), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        doc_id, *doc = json.loads(line)
+                    except ValueError:  # 崩溃时写了一半的最后一行
+                        break
+                    if doc_id >= next_doc + len(docs):
+                        docs.append(doc)
+        while len(docs) >= self.segment_docs:
+            table = _MemTable(next_doc)
+            for i, doc in enumerate(docs[:self.segment_docs]):
+                table.add(next_doc + i, doc)
+            self._write_memtable(table)
+            docs, next_doc = docs[self.segment_docs:], next_doc + self.segment_docs
+        self.__memtable = _MemTable(next_doc)
+        for i, doc in enumerate(docs):
+            self.__memtable.add(next_doc + i, doc)
+        self.__next_doc = next_doc + len(docs)
+        self.__wal = self._open_wal(self.__memtable)
+        for name in wal_names:
+            if name != f"wal-{next_doc}.log":
+                os.unlink(os.path.join(self.path, name))
+        logger.info(f"Search index opened with {len(self.__segments)} segments, {self.__next_doc - 1} messages "
+                    f"({len(docs)} replayed from the WAL)")
+
+    def _read_manifest(self) -> list[str]:
+        try:
+            with open(os.path.join(self.path, "manifest.json"), "r", encoding="utf-8") as f:
+                return json.load(f)["segments"]
+        except FileNotFoundError:
+            return []
+
+    def _write_manifest(self, segments):
+        tmp = os.path.join(self.path, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segments": [segment.name for segment in segments]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, "manifest.json"))
+
+    def _open_wal(self, table: _MemTable):
+        """为内存表创建 WAL，先写入表中已有的消息"""
+        path = os.path.join(self.path, f"wal-{table.first_doc}.log")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for i, doc in enumerate(table.docs):
+                f.write(json.dumps([table.first_doc + i, *doc], ensure_ascii=False) + "\n")
+        os.replace(path + ".tmp", path)
+        return open(path, "a", encoding="utf-8")
+
+    # ---------- 写入 ----------
+
+    def add(self, from_id: int, to_id: int, timestamp: str, text: str, msg_type: str, is_group: bool) -> int:
+        """
+        索引一条消息
+        :return: 文档号
+        """
+        doc = [from_id, to_id, timestamp, text, msg_type, int(bool(is_group))]
+        with self.__lock:
+            doc_id = self.__next_doc
+            self.__next_doc += 1
+            self.__memtable.add(doc_id, doc)
+            self.__wal.write(json.dumps([doc_id, *doc], ensure_ascii=False) + "\n")
+            self.__wal.flush()
+            if len(self.__memtable) >= self.segment_docs:
+                # 冻结内存表并换用新的 WAL，旧 WAL 在段写完后删除
+                self.__frozen.append(self.__memtable)
+                self.__memtable = _MemTable(self.__next_doc)
+                self.__wal.close()
+                self.__wal = self._open_wal(self.__memtable)
+                self.__pending.notify()
+        SEARCH_INDEXED.inc()
+        return doc_id
+
+    def _write_memtable(self, table: _MemTable) -> _Segment:
+        path = os.path.join(self.path, f"seg-{table.first_doc}-{table.first_doc + len(table) - 1}.bfs")
+        _write_segment(path, table.first_doc, len(table), table.entries(), table.blocks())
+        segment = _Segment(path)
+        with self.__lock:
+            # 发布段与移除冻结的内存表在同一个临界区内完成，否则期间的搜索会在两处各找到一次同一条消息
+            self.__segments = self.__segments + (segment,)
+            if self.__frozen and self.__frozen[0] is table:
+                self.__frozen.pop(0)
+        self._write_manifest(self.__segments)
+        return segment
+
+    def _flush_worker(self):
+        while True:
+            with self.__lock:
+                while not self.__frozen and not self.__stopping:
+                    self.__pending.wait()
+                if self.__stopping:
+                    return
+                table = self.__frozen[0]
+            try:
+                begin = time.monotonic()
+                segment = self._write_memtable(table)
+                os.unlink(os.path.join(self.path, f"wal-{table.first_doc}.log"))
+                logger.info(f"Wrote search segment {segment.name} ({segment.size} bytes) "
+                            f"in {(time.monotonic() - begin) * 1000:.1f} ms")
+                while len(self.__segments) > self.max_segments and not self.__stopping:
+                    self._merge()
+            except _Aborted:
+                return
+            except Exception as e:
+                logger.error(f"Failed to write search segment: {e}", exc_info=True)
+                with self.__lock:
+                    self.__pending.wait(5)
+
+    def _merge(self):
+        """合并文档数之和最小的 MERGE_FACTOR 个相邻段"""
+        segments = self.__segments
+        start = min(range(len(segments) - MERGE_FACTOR + 1),
+                    key=lambda i: sum(s.doc_count for s in segments[i:i + MERGE_FACTOR]))
+        group = segments[start:start + MERGE_FACTOR]
+        first_doc = group[0].first_doc
+        doc_count = sum(s.doc_count for s in group)
+        path = os.path.join(self.path, f"seg-{first_doc}-{first_doc + doc_count - 1}.bfs")
+        begin = time.monotonic()
+
+        def entries():
+            # 同一个键按段的先后排列，拼接后的文档号仍然递增
+            merged = heapq.merge(*(zip(s.entries(), itertools.repeat(i)) for i, s in enumerate(group)),
+                                 key=lambda item: (item[0][0], item[1]))
+            for n, (key, items) in enumerate(itertools.groupby(merged, key=lambda item: item[0][0])):
+                if n % 4096 == 0 and self.__stopping:
+                    raise _Aborted()
+                doc_ids = []
+                for (_, postings), i in items:
+                    doc_ids.extend(_decode_postings(postings, group[i].first_doc))
+                yield key, _encode_postings(doc_ids, first_doc)
+
+        def blocks():
+            for s in group:
+                for first, data in s.raw_blocks():
+                    yield s.first_doc - first_doc + first, data
+
+        try:
+            _write_segment(path, first_doc, doc_count, entries(), blocks())
+        except _Aborted:
+            os.unlink(path + ".tmp")
+            raise
+        merged = _Segment(path)
+        with self.__lock:
+            current = self.__segments
+            self.__segments = current[:start] + (merged,) + current[start + MERGE_FACTOR:]
+        self._write_manifest(self.__segments)
+        for s in group:  # 正在查询的线程仍持有 mmap，文件删除后在其释放时回收
+            os.unlink(s.path)
+        self.merges += 1
+        logger.info(f"Merged {MERGE_FACTOR} search segments into {merged.name} ({merged.size} bytes) "
+                    f"in {(time.monotonic() - begin) * 1000:.1f} ms")
+
+    # ---------- 查询 ----------
+
+    def search(self, scopes: list[str], query: str, before: int = None, limit: int = SEARCH_PAGE_DEFAULT,
+               match=None) -> tuple[list[tuple[int, list]], bool]:
+        """
+        :param scopes: 检索范围，见 scopes_of
+        :param query: 查询串，所有片段都出现的消息才会命中
+        :param before: 游标，只返回文档号小于它的消息
+        :param match: match(doc) -> bool，进一步过滤(如限定私聊对象)
+        :return: ([(文档号, [from_id, to_id, timestamp, text, msg_type, is_group])]，从新到旧), 是否还有更多结果)
+        """
+        start = time.perf_counter()
+        terms, runs = query_terms(query)
+        results = []
+        if terms:
+            with self.__lock:
+                sources = [self.__memtable, *reversed(self.__frozen), *reversed(self.__segments)]
+            for source in sources:
+                if before is not None and source.first_doc >= before:
+                    continue
+                for doc_id in sorted(source.match(scopes, terms, self.__lock), reverse=True):
+                    if before is not None and doc_id >= before:
+                        continue
+                    doc = source.doc(doc_id)
+                    text = doc[3].lower()
+                    if all(run in text for run in runs) and (match is None or match(doc)):
+                        results.append((doc_id, doc))
+                        if len(results) > limit:
+                            break
+                if len(results) > limit:
+                    break
+        SEARCH_QUERY_SECONDS.observe(time.perf_counter() - start)
+        return results[:limit], len(results) > limit
+
+    # ---------- 状态 ----------
+
+    def stats(self) -> dict:
+        segments = self.__segments
+        return {"messages": self.__next_doc - 1, "segments": len(segments),
+                "segment_bytes": sum(s.size for s in segments),
+                "stored_bytes": sum(length for s in segments for _, _, length in s.blocks),
+                "memtable": len(self.__memtable),
+                "frozen": len(self.__frozen), "merges": self.merges}
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """等待冻结的内存表全部写成段、段数降到 max_segments 以下(压测用)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.__frozen or len(self.__segments) > self.max_segments:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self):
+        """停止后台线程(进行中的合并会被放弃)，内存表中的消息保留在 WAL 中，下次启动时重放"""
+        with self.__lock:
+            self.__stopping = True
+            self.__pending.notify_all()
+        self.__flusher.join()
+        with self.__lock:
+            self.__wal.close()
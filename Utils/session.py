@@ -0,0 +1,202 @@
+import socket
+import threading
+import time
+
+# 每个空闲连接的 Python 堆内存预算(字节)，不含内核 socket 缓冲区。
+# 10 万个已登录空闲会话的实测组成(64位 CPython 3.11，python -m Test.bench_sessions)：
+#   Session 对象(slots)及时间戳      ~ 150
+#   socket.socket 对象                ~ 100
+#   by_fileno 索引中的一项            ~  60 (随字典扩容摊销)
+#   by_user 索引中的一项、1元组、用户名 ~ 195
+#   时间轮中的心跳超时定时器          ~ 320
+# 合计约 830 字节(每用户 2 个设备时约 780)，超过该预算时 Test/bench_sessions.py 会报告失败
+SESSION_MEMORY_BUDGET = 1024
+
+
+class Session:
+    """
+    一条客户端连接。未登录时 user_id 为 None。
+    使用 __slots__ 避免每个对象携带 __dict__
+    """
+    __slots__ = ("fileno", "sock", "user_id", "user_name", "connected_at", "last_seen", "last_active", "outbox",
+                 "reading", "inbuf", "__weakref__")
+
+    def __init__(self, fileno: int, sock: socket.socket, now: float = None):
+        self.fileno = fileno
+        self.sock = sock
+        self.user_id = None
+        self.user_name = None
+        self.connected_at = now if now is not None else time.monotonic()
+        self.last_seen = self.connected_at  # 最近一次收到任何数据(含心跳)的时间
+        self.last_active = self.connected_at  # 最近一次收到非心跳请求的时间
+        self.outbox = None  # 发送积压(Utils.flow_control.Outbox)，没有积压时为None
+        self.reading = False  # 是否已有读取任务提交给工作线程而尚未完成
+        self.inbuf = b""  # 尚未收完的半包
+
+    @property
+    def authenticated(self) -> bool:
+        return self.user_id is not None
+
+    def __repr__(self):
+        return f"Session(fileno={self.fileno}, user_id={self.user_id})"
+
+
+SESSION_SHARDS = 64  # 会话表分段数(2的幂)，按 fileno 与用户id分别分段
+
+
+class _Shard:
+    __slots__ = ("lock", "sessions", "pending")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}  # {FileNo: Session} 或 {UserID: (Session, ...)}
+        self.pending = 0  # 未登录的会话数(仅 fileno 分段)
+
+
+class SessionRegistry:
+    """
+    按 fileno 与 user_id 索引的会话表，一个用户可以有多个设备(会话)。
+    两个索引各自分段，每段一把锁，不同连接、不同用户的登录与断开互不阻塞，
+    在没有 GIL 的 CPython(3.13t 及以上)中多线程写入也能并行；同时需要两段时先锁 fileno 段再锁用户段。
+    读操作不加锁：by_user 中保存的是不可变元组，写时整体替换(RCU)，读到的要么是旧元组要么是新元组；
+    遍历时逐段在锁内复制，得到的快照不会因其他线程的修改而出错
+    """
+
+    def __init__(self, on_presence=None, shards: int = SESSION_SHARDS):
+        """
+        :param on_presence: on_presence(user_id, online)，用户的第一个设备登录或最后一个设备断开时在持锁状态下调用，
+                            同一用户的调用顺序与实际变化一致，不能阻塞
+        :param shards: 分段数，必须是2的幂
+        """
+        if shards <= 0 or shards & (shards - 1):
+            raise ValueError(f"shards must be a power of two, got {shards}")
+        self.__on_presence = on_presence
+        self.__mask = shards - 1
+        self.__by_fileno = tuple(_Shard() for _ in range(shards))
+        self.__by_user = tuple(_Shard() for _ in range(shards))
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self.__by_fileno)
+
+    @property
+    def user_count(self) -> int:
+        return sum(len(shard.sessions) for shard in self.__by_user)
+
+    @property
+    def pending_count(self) -> int:
+        return sum(shard.pending for shard in self.__by_fileno)
+
+    def _fileno_shard(self, fileno: int) -> _Shard:
+        return self.__by_fileno[fileno & self.__mask]
+
+    def _user_shard(self, user_id: int) -> _Shard:
+        return self.__by_user[user_id & self.__mask]
+
+    def add(self, fileno: int, sock: socket.socket) -> Session:
+        """登记一条新连接(未登录)"""
+        session = Session(fileno, sock)
+        shard = self._fileno_shard(fileno)
+        with shard.lock:
+            old = shard.sessions.get(fileno)
+            if old is not None:  # fileno 已被内核复用，旧会话必然已关闭
+                self._unlink(shard, old)
+            shard.sessions[fileno] = session
+            shard.pending += 1
+        return session
+
+    def authenticate(self, session: Session, user_id: int, user_name: str) -> bool:
+        """
+        会话登录，加入该用户的设备列表
+        :return: 会话已被移除时返回False
+        """
+        shard = self._fileno_shard(session.fileno)
+        with shard.lock:
+            if shard.sessions.get(session.fileno) is not session:
+                return False
+            if session.user_id is not None:
+                self._unlink_user(session)
+            else:
+                shard.pending -= 1
+            user_shard = self._user_shard(user_id)
+            with user_shard.lock:
+                session.user_id = user_id
+                session.user_name = user_name
+                sessions = user_shard.sessions.get(user_id, ())
+                user_shard.sessions[user_id] = sessions + (session,)
+                if not sessions and self.__on_presence is not None:
+                    self.__on_presence(user_id, True)
+            return True
+
+    # 以下查询在每条消息的投递路径上，直接索引分段而不经过 _fileno_shard/_user_shard
+    def get(self, fileno: int) -> Session | None:
+        return self.__by_fileno[fileno & self.__mask].sessions.get(fileno)
+
+    def sessions_of(self, user_id: int) -> tuple:
+        """:return: 用户当前所有在线设备的会话"""
+        return self.__by_user[user_id & self.__mask].sessions.get(user_id, ())
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.__by_user[user_id & self.__mask].sessions
+
+    def remove(self, fileno: int, session: Session = None) -> Session | None:
+        """
+        :param session: 指定时只有当前 fileno 对应的仍是该会话才移除
+        :return: 被移除的会话
+        """
+        shard = self._fileno_shard(fileno)
+        with shard.lock:
+            current = shard.sessions.get(fileno)
+            if current is None or (session is not None and current is not session):
+                return None
+            self._unlink(shard, current)
+            return current
+
+    def _unlink(self, shard: _Shard, session: Session):
+        """调用方持有 shard(session 所在的 fileno 段)的锁"""
+        del shard.sessions[session.fileno]
+        if session.user_id is None:
+            shard.pending -= 1
+        else:
+            self._unlink_user(session)
+
+    def _unlink_user(self, session: Session):
+        user_shard = self._user_shard(session.user_id)
+        with user_shard.lock:
+            remaining = tuple(s for s in user_shard.sessions.get(session.user_id, ()) if s is not session)
+            if remaining:
+                user_shard.sessions[session.user_id] = remaining
+            elif user_shard.sessions.pop(session.user_id, None) is not None and self.__on_presence is not None:
+                self.__on_presence(session.user_id, False)
+
+    def user_ids(self) -> list[int]:
+        """:return: 所有在线用户"""
+        users = []
+        for shard in self.__by_user:
+            with shard.lock:
+                users.extend(shard.sessions)
+        return users
+
+    def all(self) -> list[Session]:
+        """:return: 所有会话(含未登录)的快照"""
+        sessions = []
+        for shard in self.__by_fileno:
+            with shard.lock:
+                sessions.extend(shard.sessions.values())
+        return sessions
+
+    def authenticated(self) -> list[Session]:
+        """:return: 所有已登录会话的快照"""
+        groups = []
+        for shard in self.__by_user:
+            with shard.lock:
+                groups.extend(shard.sessions.values())
+        return [s for group in groups for s in group]
+
+    def authenticated_shards(self) -> list[list[Session]]:
+        """:return: 按用户分段的已登录会话快照，各段可以交给不同线程并行处理"""
+        shards = []
+        for shard in self.__by_user:
+            with shard.lock:
+                groups = list(shard.sessions.values())
+            shards.append([s for group in groups for s in group])
+        return shards
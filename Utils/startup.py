@@ -0,0 +1,99 @@
+"""
+启动过程的可观测性：记录各启动阶段的耗时，并在后台并行预热外部依赖(数据库连接池、COS、APNs 密钥)。
+预热期间服务器已经开始 accept，/ready 在全部预热完成前返回 503，供负载均衡判断是否转发流量。
+"""
+import threading
+import time
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+# 就绪状态
+STARTING = "starting"  # 正在初始化
+WARMING = "warming"  # 已开始服务，外部依赖正在预热
+READY = "ready"  # 全部预热完成
+DEGRADED = "degraded"  # 有预热失败，正在后台重试
+STOPPED = "stopped"
+
+WARM_UP_RETRY_DELAYS = (1, 2, 5, 10, 30)  # 预热失败后的重试间隔(秒)，之后一直按最后一个间隔重试
+
+
+class Startup:
+    def __init__(self):
+        self.state = STARTING
+        self.started = time.monotonic()
+        self.ready_at = None
+        self.phases = {}  # {阶段: 耗时(秒)}
+        self.warmups = {}  # {名称: {"state", "attempts", "seconds", "error"}}
+        self.__last_mark = self.started
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    def mark(self, phase: str):
+        """记录从上一个阶段结束到现在的耗时"""
+        now = time.monotonic()
+        self.phases[phase] = now - self.__last_mark
+        self.__last_mark = now
+
+    def log_phases(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in self.phases.items())
+        logger.info(f"Server initialized in {(self.__last_mark - self.started) * 1000:.1f} ms ({phases})")
+
+    def warm_up(self, tasks: dict):
+        """
+        在后台线程中并行执行预热任务，全部成功后状态变为 READY；
+        失败的任务按 WARM_UP_RETRY_DELAYS 退避重试，期间状态为 DEGRADED
+        :param tasks: {名称: 无参数函数}
+        """
+        self.state = WARMING if tasks else READY
+        if not tasks:
+            self.ready_at = time.monotonic()
+            return
+        logger.info(f"Warming up {', '.join(tasks)} in the background")
+        for name in tasks:
+            self.warmups[name] = {"state": "pending", "attempts": 0, "seconds": None, "error": None}
+        for name, func in tasks.items():
+            threading.Thread(target=self._run, args=(name, func), name=f"warm-up-{name}", daemon=True).start()
+
+    def _run(self, name: str, func):
+        status = self.warmups[name]
+        while not self.__stopped.is_set():
+            status["attempts"] += 1
+            begin = time.monotonic()
+            try:
+                func()
+            except Exception as e:
+                status["state"], status["error"] = "failed", str(e)
+                delay = WARM_UP_RETRY_DELAYS[min(status["attempts"], len(WARM_UP_RETRY_DELAYS)) - 1]
+                logger.warning(f"Warm-up of {name} failed after {(time.monotonic() - begin) * 1000:.1f} ms "
+                               f"(attempt {status['attempts']}), retrying in {delay}s: {e}")
+                with self.__lock:
+                    if self.state == WARMING:
+                        self.state = DEGRADED
+                self.__stopped.wait(delay)
+                continue
+            status["state"], status["error"] = "ok", None
+            status["seconds"] = time.monotonic() - begin
+            logger.info(f"Warm-up of {name} finished in {status['seconds'] * 1000:.1f} ms")
+            with self.__lock:
+                if self.state in (WARMING, DEGRADED) and all(w["state"] == "ok" for w in self.warmups.values()):
+                    self.state = READY
+                    self.ready_at = time.monotonic()
+                    logger.info(f"Server ready {(self.ready_at - self.started) * 1000:.1f} ms after start")
+            return
+
+    @property
+    def ready(self) -> bool:
+        return self.state == READY
+
+    def stop(self):
+        self.state = STOPPED
+        self.__stopped.set()
+
+    def to_dict(self) -> dict:
+        return {"state": self.state,
+                "ready_after_ms": round((self.ready_at - self.started) * 1000, 3) if self.ready_at else None,
+                "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+                "warmups": {name: dict(w, seconds=None if w["seconds"] is None else round(w["seconds"] * 1000, 3))
+                            for name, w in self.warmups.items()}}
@@ -0,0 +1,91 @@
+import itertools
+import math
+
+from Utils.color_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class TimerWheel:
+    """
+    分层时间轮，用于大量连接的超时管理。
+    第 L 层每个槽覆盖 slots**L 个刻度，添加与取消定时器都是 O(1)；
+    推进时只处理到期的槽，高层的槽在低层转满一圈时才下放(cascade)到低层。
+    非线程安全，应只在事件循环线程中使用
+    """
+
+    def __init__(self, now: float, tick: float = 1.0, slots: int = 64, levels: int = 4):
+        """
+        :param now: 当前时间(time.monotonic())
+        :param tick: 每个刻度的时长(秒)，定时器精度不高于一个刻度
+        :param slots: 每层的槽数
+        :param levels: 层数，可表示的最长超时为 tick * slots**levels
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.__wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.__spans = [slots ** level for level in range(levels + 1)]
+        self.__current = int(now / tick)
+        self.__locations = {}  # {handle: (level, slot)}
+        self.__handles = itertools.count(1)
+
+    def __len__(self):
+        return len(self.__locations)
+
+    def schedule(self, deadline: float, callback, *args) -> int:
+        """
+        :param deadline: 到期时间(与构造时的 now 同一时钟)
+        :return: 定时器句柄，用于 cancel
+        """
+        handle = next(self.__handles)
+        expires = max(math.ceil(deadline / self.tick), self.__current + 1)
+        self._place(handle, (expires, callback, args))
+        return handle
+
+    def cancel(self, handle: int) -> bool:
+        location = self.__locations.pop(handle, None)
+        if location is None:
+            return False
+        del self.__wheels[location[0]][location[1]][handle]
+        return True
+
+    def _place(self, handle: int, entry: tuple):
+        # 超出最高层范围的定时器先放在最高层，下放时会重新计算
+        delta = min(entry[0] - self.__current, self.__spans[self.levels] - 1)
+        level = 0
+        while delta >= self.__spans[level + 1]:
+            level += 1
+        slot = ((self.__current + delta) // self.__spans[level]) % self.slots
+        self.__wheels[level][slot][handle] = entry
+        self.__locations[handle] = (level, slot)
+
+    def advance(self, now: float) -> int:
+        """
+        推进到 now，依次调用所有到期定时器的回调
+        :return: 触发的定时器数量
+        """
+        target = int(now / self.tick)
+        fired = 0
+        while self.__current < target:
+            self.__current += 1
+            for level in range(1, self.levels):
+                if self.__current % self.__spans[level]:
+                    break
+                slot = (self.__current // self.__spans[level]) % self.slots
+                bucket, self.__wheels[level][slot] = self.__wheels[level][slot], {}
+                for handle, entry in bucket.items():
+                    self._place(handle, entry)
+            slot = self.__current % self.slots
+            bucket, self.__wheels[0][slot] = self.__wheels[0][slot], {}
+            for handle, (expires, callback, args) in bucket.items():
+                if expires > self.__current:  # 超出范围的定时器还没到期
+                    self._place(handle, (expires, callback, args))
+                    continue
+                del self.__locations[handle]
+                fired += 1
+                try:
+                    callback(*args)
+                except Exception as e:
+                    logger.error(f"Error in timer callback {callback}: {e}", exc_info=True)
+        return fired
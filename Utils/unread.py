@@ -0,0 +1,273 @@
+"""
+未读消息数：在内存中按 (用户, 会话) 维护未读数，消息投递时加一、收到已读回执时清零，不需要 COUNT 查询。
+变化以增量记录，由后台线程定期合并成一次 update_unread 调用批量写入数据库；
+用户的未读数在登录或推送需要角标时从数据库载入(数据库中的值加上尚未写入的增量)，之后常驻内存直到过期或被淘汰。
+集群模式下每个接收方只由负责其推送的节点计数，写入数据库的是增量，多个节点的写入可以叠加。
+"""
+import collections
+import itertools
+import threading
+import time
+
+from Utils.color_logger import get_logger
+from Utils.metrics import registry
+
+logger = get_logger(__name__)
+
+UNREAD_STRIPES = 64  # 按用户分段加锁，投递线程之间互不阻塞
+EVICT_SCAN = 8  # 淘汰时最多检查的最久未访问用户数(有未写入变化的用户不能淘汰)
+LOAD_ATTEMPTS = 5  # 载入期间恰好有批量写入时重新载入的次数
+FLUSH_ATTEMPTS = 30  # 同一批变化连续写入失败的次数上限，超过后丢弃，避免一条坏数据让之后的写入永远失败
+
+UNREAD_FLUSH = registry.histogram("betterfly_unread_flush_seconds", "Time spent writing a batch of unread changes")
+
+
+def unread_conversation(from_id: int, to_id: int, is_group: bool) -> tuple[int, int]:
+    """
+    :return: 一条消息在接收方看来所属的会话 (is_group, conv_id)：私聊为发送方用户id，群聊为群组id
+    """
+    if is_group:
+        return 1, to_id
+    return 0, from_id
+
+
+def valid_conversation(conversation) -> bool:
+    """:return: 会话是否为 (0 或 1, 整数id)，其他值无法写入数据库"""
+    is_group, conv_id = conversation
+    return is_group in (0, 1) and isinstance(conv_id, int) and not isinstance(conv_id, bool)
+
+
+class _UserUnread:
+    __slots__ = ("counts", "pending", "loaded_at")
+
+    def __init__(self):
+        self.counts = {}  # {会话: 未读数}，仅在已载入时有效
+        self.pending = {}  # {会话: [是否清零, 增量]}，尚未写入数据库的变化
+        self.loaded_at = None  # 上次从数据库载入的时间，None 表示只记录了增量
+
+
+class _Stripe:
+    __slots__ = ("lock", "users", "dirty")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = collections.OrderedDict()  # {user_id: _UserUnread}，按访问顺序排列
+        self.dirty = set()  # 有未写入变化的用户
+
+
+class UnreadCounters:
+    def __init__(self, db_operator, capacity: int = 100000, ttl: float = 300.0, flush_interval: float = 1.0):
+        """
+        :param db_operator: 数据库操作类，批量写入线程用它创建连接
+        :param capacity: 常驻内存的用户数上限，超过后淘汰最久未访问且没有未写入变化的用户
+        :param ttl: 已载入的未读数过期时间(秒)，过期后再次使用时重新载入(集群中其他节点可能计入了新消息)
+        :param flush_interval: 批量写入数据库的间隔(秒)
+        """
+        self.db_operator = db_operator
+        self.capacity = capacity
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.__stripes = [_Stripe() for _ in range(UNREAD_STRIPES)]
+        # 批量写入的序号：写入开始与提交后各加一，奇数表示正在写入。
+        # 载入时数据库中的值与内存中的增量必须来自同一次写入的前后，否则同一个增量会被算两次或漏掉
+        self.__epoch = 0
+        self.__epoch_cond = threading.Condition()
+        self.__failures = 0  # 连续写入失败的次数
+        self.__stopping = threading.Event()
+        self.__thread = threading.Thread(target=self._flush_worker, name="unread-flusher", daemon=True)
+
+        # 统计信息
+        self.loads = 0
+        self.flushed = 0
+        self.flush_errors = 0
+
+    def start(self):
+        self.__thread.start()
+
+    def _stripe(self, user_id: int) -> _Stripe:
+        return self.__stripes[user_id % UNREAD_STRIPES]
+
+    def _touch(self, stripe: _Stripe, user_id: int) -> _UserUnread:
+        """取出用户的记录并标记为最近访问，需持有 stripe.lock"""
+        entry = stripe.users.get(user_id)
+        if entry is None:
+            entry = stripe.users[user_id] = _UserUnread()
+            self._evict(stripe)
+        else:
+            stripe.users.move_to_end(user_id)
+        return entry
+
+    def _evict(self, stripe: _Stripe):
+        limit = max(1, self.capacity // UNREAD_STRIPES)
+        if len(stripe.users) <= limit:
+            return
+        for user_id in list(itertools.islice(stripe.users, EVICT_SCAN)):
+            if len(stripe.users) <= limit:
+                break
+            if user_id not in stripe.dirty:
+                del stripe.users[user_id]
+
+    # ---------- 计数 ----------
+
+    def add(self, user_ids, conversation: tuple[int, int], amount: int = 1):
+        """若干接收方的同一会话各收到 amount 条消息"""
+        for user_id in user_ids:
+            stripe = self._stripe(user_id)
+            with stripe.lock:
+                entry = self._touch(stripe, user_id)
+                if entry.loaded_at is not None:
+                    entry.counts[conversation] = entry.counts.get(conversation, 0) + amount
+                change = entry.pending.get(conversation)
+                if change is None:
+                    entry.pending[conversation] = [False, amount]
+                else:
+                    change[1] += amount
+                stripe.dirty.add(user_id)
+
+    def clear(self, user_id: int, conversation: tuple[int, int]) -> bool:
+        """
+        用户已读一个会话
+        :return: 该会话此前是否有(已知的)未读消息
+        """
+        stripe = self._stripe(user_id)
+        with stripe.lock:
+            entry = self._touch(stripe, user_id)
+            had_unread = entry.counts.pop(conversation, 0) > 0 or entry.loaded_at is None
+            entry.pending[conversation] = [True, 0]
+            stripe.dirty.add(user_id)
+        return had_unread
+
+    # ---------- 读取 ----------
+
+    def summary(self, user_id: int, db=None, refresh: bool = False) -> dict[tuple[int, int], int]:
+        """
+        :param db: 可复用的数据库操作对象，不指定时新建
+        :param refresh: 是否忽略内存中未过期的值，重新从数据库载入(登录时)
+        :return: {(is_group, conv_id): 未读数}，只包含有未读消息的会话
+        """
+        stripe = self._stripe(user_id)
+        if not refresh:
+            with stripe.lock:
+                entry = stripe.users.get(user_id)
+                if entry is not None and entry.loaded_at is not None and time.monotonic() - entry.loaded_at < self.ttl:
+                    stripe.users.move_to_end(user_id)
+                    return dict(entry.counts)
+        return self._load(user_id, db if db is not None else self.db_operator())
+
+    def total(self, user_id: int, db=None) -> int:
+        """:return: 用户所有会话的未读数之和(推送角标)"""
+        return sum(self.summary(user_id, db).values())
+
+    def _load(self, user_id: int, db) -> dict:
+        stripe = self._stripe(user_id)
+        for attempt in range(LOAD_ATTEMPTS):
+            with self.__epoch_cond:
+                self.__epoch_cond.wait_for(lambda: self.__epoch % 2 == 0)
+                epoch = self.__epoch
+            rows = db.queryUnread(user_id)
+            with stripe.lock:
+                if self.__epoch != epoch and attempt < LOAD_ATTEMPTS - 1:
+                    continue  # 查询期间有一批变化写入了数据库，无法区分查到的值是否已包含它们
+                counts = {(int(row[0]), row[1]): row[2] for row in rows}
+                entry = self._touch(stripe, user_id)
+                for conversation, (reset, delta) in entry.pending.items():
+                    counts[conversation] = delta if reset else counts.get(conversation, 0) + delta
+                entry.counts = {conversation: n for conversation, n in counts.items() if n > 0}
+                entry.loaded_at = time.monotonic()
+                self.loads += 1
+                return dict(entry.counts)
+        return {}
+
+    # ---------- 批量写入 ----------
+
+    def flush(self, db=None) -> int:
+        """
+        把所有未写入的变化合并成一次数据库调用，失败时变化放回内存，下次重试；
+        连续失败 FLUSH_ATTEMPTS 次后丢弃这一批，无效的会话在写入前丢弃
+        :return: 写入的 (用户, 会话) 数
+        """
+        with self.__epoch_cond:
+            self.__epoch += 1
+        changes = []
+        try:
+            for stripe in self.__stripes:
+                with stripe.lock:
+                    for user_id in stripe.dirty:
+                        entry = stripe.users[user_id]
+                        changes.extend((user_id, conversation, reset, delta)
+                                       for conversation, (reset, delta) in entry.pending.items())
+                        entry.pending = {}
+                        if entry.loaded_at is None:  # 只记录了增量的用户写入后不再需要保留
+                            del stripe.users[user_id]
+                    stripe.dirty.clear()
+            invalid = [change for change in changes if not valid_conversation(change[1])]
+            if invalid:
+                logger.warning(f"Dropping {len(invalid)} unread changes with invalid conversations: {invalid[:5]}")
+                changes = [change for change in changes if valid_conversation(change[1])]
+            if changes:
+                start = time.perf_counter()
+                try:
+                    (db if db is not None else self.db_operator()).updateUnread(
+                        [(user_id, is_group, conv_id, reset, delta)
+                         for user_id, (is_group, conv_id), reset, delta in changes])
+                except Exception:
+                    self.flush_errors += 1
+                    self.__failures += 1
+                    if self.__failures >= FLUSH_ATTEMPTS:
+                        self.__failures = 0
+                        logger.error(f"Dropping {len(changes)} unread changes after {FLUSH_ATTEMPTS} failed writes")
+                    else:
+                        self._restore(changes)
+                    raise
+                self.__failures = 0
+                UNREAD_FLUSH.observe(time.perf_counter() - start)
+                self.flushed += len(changes)
+            return len(changes)
+        finally:
+            with self.__epoch_cond:
+                self.__epoch += 1
+                self.__epoch_cond.notify_all()
+
+    def _restore(self, changes: list):
+        """写入失败的变化放回内存，写入期间产生的新变化在它们之后"""
+        for user_id, conversation, reset, delta in changes:
+            stripe = self._stripe(user_id)
+            with stripe.lock:
+                entry = stripe.users.get(user_id)
+                if entry is None:
+                    entry = stripe.users[user_id] = _UserUnread()
+                newer = entry.pending.get(conversation)
+                if newer is None:
+                    entry.pending[conversation] = [reset, delta]
+                elif not newer[0]:
+                    entry.pending[conversation] = [reset, delta + newer[1]]
+                stripe.dirty.add(user_id)
+
+    def _flush_worker(self):
+        while not self.__stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write unread counters: {e}", exc_info=True)
+
+    def stop(self):
+        """停止批量写入线程，并写入剩余的变化"""
+        self.__stopping.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+        try:
+            count = self.flush()
+            if count:
+                logger.info(f"Wrote {count} pending unread counter changes")
+        except Exception as e:
+            logger.error(f"Failed to write unread counters on shutdown: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        """:return: 常驻用户数、待写入的用户数与累计载入/写入次数，可在任意线程调用"""
+        return {
+            "users": sum(len(stripe.users) for stripe in self.__stripes),
+            "dirty": sum(len(stripe.dirty) for stripe in self.__stripes),
+            "loads": self.loads,
+            "flushed": self.flushed,
+            "flush_errors": self.flush_errors,
+        }
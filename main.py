@@ -1,16 +1,42 @@
+import argparse
+import time
+
 import Utils.Server
 from Utils.color_logger import get_logger
 path = "./Config/config.json"
 logger = get_logger(__name__)
+RESTART_DELAYS = (1, 2, 5, 10, 30)  # 连续异常退出后的重启间隔(秒)
+STABLE_RUN = 60  # 运行超过该时间(秒)后再异常退出，重启间隔从头计算
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Betterfly server")
+    parser.add_argument("--takeover", action="store_true",
+                        help="从正在运行的旧进程接管所有连接(平滑重启)，旧进程交接完成后自动退出")
+    args = parser.parse_args()
+    takeover = args.takeover
+    failures = 0
     while True:
+        started = time.monotonic()
+        server = None
         try:
-            server = Utils.Server.EpollChatServer(path)
+            current, takeover = takeover, False  # 之后的异常重启不再接管
+            server = Utils.Server.EpollChatServer(path, takeover=current)
             server.run()
+            if server.handed_off:
+                logger.info("Connections handed off to the new process, exiting")
+                break
         except KeyboardInterrupt as e:
-            server.shutdown()
+            if server is not None:
+                server.shutdown()
             logger.info(f"Server Closed", exc_info=True)
             break
         except Exception as e:
             logger.error(f"Unhandled exception in main: {e}", exc_info=True)
+        # 启动失败(如端口被占用)或异常退出后退避重启，避免快速循环重建所有子系统
+        failures = 1 if time.monotonic() - started >= STABLE_RUN else failures + 1
+        delay = RESTART_DELAYS[min(failures, len(RESTART_DELAYS)) - 1]
+        logger.warning(f"Restarting server in {delay}s (consecutive failure {failures})")
+        try:
+            time.sleep(delay)
+        except KeyboardInterrupt:
+            break